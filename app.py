@@ -1,25 +1,43 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, make_response
 from flask_cors import CORS
 import jwt
 import datetime
-import bcrypt
 import sqlite3
 import uuid
-import smtplib
 import os
 import atexit
+import click
 import time
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from functools import wraps
-from threading import Lock, Thread
-from apscheduler.schedulers.background import BackgroundScheduler
+import queue
+import math
+import hashlib
+import bisect
+import base64
+import codecs
+import csv
+import html
+import io
+import json
+import re
+import shutil
+import zlib
+from abc import ABC, abstractmethod
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+import sys
+import traceback
+from collections import Counter as _StackCounter
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import partial, wraps
+from threading import BoundedSemaphore, Event, Lock, Thread, get_ident
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
 app.config['SECRET_KEY'] = 'your-secret-key-here'  # Change this in production
-app.config['DATABASE'] = 'mavrick.db'
+app.config['DATABASE'] = os.environ.get('DATABASE', 'mavrick.db')
 
 # Email configuration (update with your email service details)
 app.config['MAIL_SERVER'] = 'smtp.gmail.com'
@@ -27,52 +45,1281 @@ app.config['MAIL_PORT'] = 587
 app.config['MAIL_USE_TLS'] = True
 app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME', 'your-email@gmail.com')
 app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD', 'your-app-password')
+app.config['MAIL_SENDER'] = os.environ.get('MAIL_SENDER', '')   # From address; MAIL_USERNAME if empty
 
-# Database lock to prevent concurrent access issues
-db_lock = Lock()
+# Metrics and profiling settings
+app.config['PROFILING_ENABLED'] = False   # allow per-request sampling via the X-Profile header
+app.config['PROFILE_INTERVAL'] = 0.005    # seconds between stack samples
+app.config['PROFILE_HISTORY'] = 50        # profiles kept for /api/metrics/profiles
 
-# Database initialization with connection pooling
-def get_db():
-    conn = sqlite3.connect(app.config['DATABASE'])
-    conn.row_factory = sqlite3.Row
-    return conn
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
 
-def init_db():
+def _format_labels(labels, extra=None):
+    items = list(labels) + (list(extra) if extra else [])
+    if not items:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in items)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(items, escaped)) + '}'
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = [(key, list(counts), total, count) for key, (counts, total, count) in self._series.items()]
+        for key, counts, total, count in sorted(snapshot):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+class MetricsRegistry:
+    """Process-local metrics rendered in the Prometheus text exposition format.
+
+    Counters and histograms are updated inline; gauges come from collector
+    callbacks evaluated at scrape time, returning (name, help, [(labels, value)]).
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help):
+        metric = Counter(name, help)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, func):
+        self._collectors.append(func)
+        return func
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collect in self._collectors:
+            try:
+                gauges = collect()
+            except Exception as e:
+                print(f"Error collecting metrics: {e}")
+                continue
+            for name, help, samples in gauges:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} gauge")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(sorted(labels.items()))} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+REQUEST_SECONDS = metrics.histogram('finguard_request_duration_seconds', 'Request latency by route, method and status.')
+DB_WAIT_SECONDS = metrics.histogram('finguard_db_wait_seconds', 'Time spent waiting to check out a pooled connection.')
+DB_HOLD_SECONDS = metrics.histogram('finguard_db_hold_seconds', 'Time a pooled connection was held executing SQL.')
+HASH_SECONDS = metrics.histogram('finguard_hash_seconds', 'bcrypt job latency including pool queueing.')
+SMTP_SECONDS = metrics.histogram('finguard_smtp_send_seconds', 'Time to hand one message to the SMTP server.')
+JOB_SECONDS = metrics.histogram('finguard_job_duration_seconds', 'Background job run time.',
+                                buckets=DEFAULT_BUCKETS + (30.0, 60.0, 300.0))
+ERRORS_TOTAL = metrics.counter('finguard_errors_total', 'Errors swallowed by background components.')
+HASH_REJECTED_TOTAL = metrics.counter('finguard_hash_rejected_total', 'Requests shed because the hashing pool was full.')
+
+# Wrap a scheduler job so its run time is recorded under the given name
+def instrument_job(name, func):
+    @wraps(func)
+    def run(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            JOB_SECONDS.observe(time.perf_counter() - started, job=name)
+    return run
+
+class RequestSampler:
+    """Samples one thread's Python stack at a fixed interval.
+
+    Used for opt-in per-request profiling: cheap enough to leave compiled in,
+    and the collapsed stacks it returns can be fed to any flame-graph tool.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = 0
+        self._stacks = _StackCounter()
+        self._stopping = Event()
+        self._thread = Thread(target=self._run, name='request-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = [f"{f.f_code.co_name} ({os.path.basename(f.f_code.co_filename)}:{lineno})"
+                     for f, lineno in traceback.walk_stack(frame)]
+            self._stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self, top=25):
+        self._stopping.set()
+        self._thread.join()
+        return {
+            'samples': self.samples,
+            'interval': self.interval,
+            'stacks': [{'stack': stack, 'count': count} for stack, count in self._stacks.most_common(top)],
+        }
+
+recent_profiles = deque(maxlen=app.config['PROFILE_HISTORY'])
+
+# Database connection pool settings
+app.config['DB_POOL_SIZE'] = 8            # read connections kept open per database file
+app.config['DB_POOL_TIMEOUT'] = 5.0       # seconds to wait for a free read connection
+app.config['DB_BUSY_TIMEOUT_MS'] = 5000
+app.config['DB_CACHE_SIZE_KB'] = 16000
+app.config['DB_MMAP_SIZE'] = 256 * 1024 * 1024
+
+class ConnectionPool:
+    """Bounded pool of SQLite connections with a dedicated writer.
+
+    Readers check out one of up to ``size`` WAL-mode connections, so they never
+    queue behind a write. Writes share a single connection guarded by a lock,
+    which matches SQLite's one-writer model without serializing readers.
+    """
+
+    def __init__(self, database, size=8, timeout=5.0, busy_timeout_ms=5000,
+                 cache_size_kb=16000, mmap_size=256 * 1024 * 1024):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+
+        self._readers = queue.LifoQueue(maxsize=size)
+        self._opened = 0
+        self._open_lock = Lock()
+        self._write_lock = Lock()
+        self._writer = None
+
+        self._stats_lock = Lock()
+        self._stats = {
+            'read_checkouts': 0,
+            'write_checkouts': 0,
+            'read_wait_seconds': 0.0,
+            'write_wait_seconds': 0.0,
+            'max_read_wait_seconds': 0.0,
+            'max_write_wait_seconds': 0.0,
+            'timeouts': 0,
+        }
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, timeout=self.busy_timeout_ms / 1000.0,
+                               check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        conn.execute(f"PRAGMA cache_size={-int(self.cache_size_kb)}")
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def _record(self, kind, waited):
+        DB_WAIT_SECONDS.observe(waited, mode=kind)
+        with self._stats_lock:
+            self._stats[f'{kind}_checkouts'] += 1
+            self._stats[f'{kind}_wait_seconds'] += waited
+            if waited > self._stats[f'max_{kind}_wait_seconds']:
+                self._stats[f'max_{kind}_wait_seconds'] = waited
+
+    def _acquire_reader(self):
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._open_lock:
+            if self._opened < self.size:
+                self._opened += 1
+                grow = True
+            else:
+                grow = False
+        if grow:
+            try:
+                return self._connect()
+            except Exception:
+                with self._open_lock:
+                    self._opened -= 1
+                raise
+
+        try:
+            return self._readers.get(timeout=self.timeout)
+        except queue.Empty:
+            with self._stats_lock:
+                self._stats['timeouts'] += 1
+            raise RuntimeError('Timed out waiting for a database connection')
+
+    @contextmanager
+    def read(self):
+        started = time.perf_counter()
+        conn = self._acquire_reader()
+        checked_out = time.perf_counter()
+        self._record('read', checked_out - started)
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._readers.put(conn)
+            DB_HOLD_SECONDS.observe(time.perf_counter() - checked_out, mode='read')
+
+    @contextmanager
+    def write(self):
+        started = time.perf_counter()
+        with self._write_lock:
+            checked_out = time.perf_counter()
+            self._record('write', checked_out - started)
+            if self._writer is None:
+                self._writer = self._connect()
+            conn = self._writer
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                DB_HOLD_SECONDS.observe(time.perf_counter() - checked_out, mode='write')
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['pool_size'] = self.size
+        stats['open_readers'] = self._opened
+        stats['idle_readers'] = self._readers.qsize()
+        return stats
+
+    def close(self):
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._open_lock:
+            self._opened = 0
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+_pools = {}
+_pools_lock = Lock()
+
+def get_pool(database=None):
+    database = database or app.config['DATABASE']
+    pool = _pools.get(database)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(database)
+            if pool is None:
+                pool = ConnectionPool(
+                    database,
+                    size=app.config['DB_POOL_SIZE'],
+                    timeout=app.config['DB_POOL_TIMEOUT'],
+                    busy_timeout_ms=app.config['DB_BUSY_TIMEOUT_MS'],
+                    cache_size_kb=app.config['DB_CACHE_SIZE_KB'],
+                    mmap_size=app.config['DB_MMAP_SIZE'],
+                )
+                _pools[database] = pool
+    return pool
+
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+# Check out a pooled connection: read-only by default, or the single writer
+# (committed on success, rolled back on error) with write=True. Pass user_id
+# for the database holding that user's rows, or database for a specific file;
+# with neither it is DATABASE.
+def get_db(write=False, user_id=None, database=None):
+    if user_id is not None:
+        database = shard_router.database(user_id)
+    pool = get_pool(database)
+    return pool.write() if write else pool.read()
+
+# Sharding settings. Each user's rows (users, sessions, reset codes and the
+# ledger tables) live in one database chosen by the user's bucket, so writes
+# for different users can commit on different files in parallel. The email
+# directory, the bucket map, revocations, the outbox and the audit log stay in
+# DATABASE. Buckets not in the map live in DATABASE, so an unsharded
+# deployment is a single file. DATABASE_SHARDS is the layout `flask reshard`
+# moves users to.
+app.config['DATABASE_SHARDS'] = [path for path in os.environ.get('DATABASE_SHARDS', '').split(',') if path]
+
+SHARD_BUCKETS = 4096        # fixed: resharding reassigns whole buckets, never rehashes users
+SHARD_ID_STRIDE = 1 << 40   # ledger ids per database, so moved rows keep their ids
+
+def user_bucket(user_id):
+    return zlib.crc32(user_id.encode('utf-8')) % SHARD_BUCKETS
+
+class ShardRouter:
+    """Maps user ids to the database holding their rows.
+
+    The shard_map table in DATABASE says which database holds each bucket.
+    It is read once per process; `flask reshard` runs with the app stopped,
+    so workers see a new layout when they restart.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._main = None
+        self._buckets = None
+
+    def _load(self):
+        with self._lock:
+            main = app.config['DATABASE']
+            if self._buckets is None or self._main != main:
+                buckets = [main] * SHARD_BUCKETS
+                with get_db() as conn:
+                    for bucket, database in conn.execute("SELECT bucket, database FROM shard_map"):
+                        buckets[bucket] = database
+                self._main, self._buckets = main, buckets
+            return self._buckets
+
+    def buckets(self):
+        """The database of every bucket, indexed by bucket."""
+        if self._buckets is None or self._main != app.config['DATABASE']:
+            return self._load()
+        return self._buckets
+
+    def database(self, user_id):
+        return self.buckets()[user_bucket(user_id)]
+
+    def databases(self):
+        """Every database holding user rows, DATABASE first."""
+        return list(dict.fromkeys([app.config['DATABASE']] + self.buckets()))
+
+    def group(self, user_ids):
+        """Split user ids into {database: [user_id, ...]}."""
+        groups = {}
+        for user_id in user_ids:
+            groups.setdefault(self.database(user_id), []).append(user_id)
+        return groups
+
+    def reload(self):
+        with self._lock:
+            self._buckets = None
+
+    def reset_after_fork(self):
+        self._lock = Lock()
+        self._buckets = None
+
+    def stats(self):
+        counts = {}
+        for database in self.buckets():
+            counts[database] = counts.get(database, 0) + 1
+        return {'buckets': counts}
+
+shard_router = ShardRouter()
+
+# Databases that need the schema: DATABASE, every mapped shard, and any
+# configured shard not holding users yet
+def known_databases():
+    return list(dict.fromkeys(shard_router.databases() + app.config['DATABASE_SHARDS']))
+
+# Resolve an email to its user id through the directory in DATABASE
+def lookup_user_id(email):
+    with get_db() as conn:
+        row = conn.execute("SELECT user_id FROM user_directory WHERE email=?", (email,)).fetchone()
+    return row['user_id'] if row else None
+
+def create_user(user_id, name, email, hashed_password):
+    """Claim the email in the directory, then create the user on their shard.
+
+    Raises sqlite3.IntegrityError if the email is already taken. The claim
+    commits first, so two shards can never both hold a user for one email;
+    it is released again if the user row cannot be written, or by
+    `flask repair-directory` if the process died in between.
+    """
+    with get_db(write=True) as conn:
+        conn.execute("INSERT INTO user_directory (email, user_id) VALUES (?, ?)", (email, user_id))
     try:
-        with db_lock:
-            conn = get_db()
-            c = conn.cursor()
-            
-            # Create users table
-            c.execute('''CREATE TABLE IF NOT EXISTS users
-                        (id TEXT PRIMARY KEY, 
-                         name TEXT NOT NULL, 
-                         email TEXT UNIQUE NOT NULL, 
-                         password TEXT NOT NULL,
-                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-            
-            # Create password_reset_tokens table
-            c.execute('''CREATE TABLE IF NOT EXISTS password_reset_tokens
-                        (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                         email TEXT NOT NULL,
-                         token TEXT NOT NULL,
-                         expires_at TIMESTAMP NOT NULL,
-                         used INTEGER DEFAULT 0)''')
-            
-            # Create sessions table for tracking active users
-            c.execute('''CREATE TABLE IF NOT EXISTS sessions
-                        (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                         user_id TEXT NOT NULL,
-                         token TEXT NOT NULL,
-                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                         expires_at TIMESTAMP NOT NULL,
-                         FOREIGN KEY (user_id) REFERENCES users (id))''')
-            
+        with get_db(write=True, user_id=user_id) as conn:
+            conn.execute("INSERT INTO users (id, name, email, password, updated_at) VALUES (?, ?, ?, ?, ?)",
+                         (user_id, name, email, hashed_password, epoch_now()))
+    except Exception:
+        with get_db(write=True) as conn:
+            conn.execute("DELETE FROM user_directory WHERE email=? AND user_id=?", (email, user_id))
+        raise
+
+# (email, user_id) claims whose user row is missing from the database the
+# user's bucket maps to
+def _orphan_claims(claims):
+    present = set()
+    for database, user_ids in shard_router.group([user_id for _, user_id in claims]).items():
+        with get_db(database=database) as conn:
+            present.update(row[0] for row in conn.execute(
+                f"SELECT id FROM users WHERE id IN ({','.join('?' * len(user_ids))})", user_ids))
+    return [claim for claim in claims if claim[1] not in present]
+
+def find_orphan_claims(batch_size=500):
+    orphans = []
+    last = ''
+    while True:
+        with get_db() as conn:
+            claims = [tuple(row) for row in conn.execute(
+                "SELECT email, user_id FROM user_directory WHERE email > ? ORDER BY email LIMIT ?",
+                (last, batch_size))]
+        if not claims:
+            return orphans
+        orphans.extend(_orphan_claims(claims))
+        last = claims[-1][0]
+
+def repair_user_directory(grace=60, dry_run=False):
+    """Release directory claims that have no user row; return those claims.
+
+    create_user and provisioning commit the claim before the user row, so a
+    process that dies in between leaves the email taken by nobody. A live
+    signup holds a claim without a user only for a moment, so claims still
+    orphaned after `grace` seconds are released.
+    """
+    orphans = find_orphan_claims()
+    if orphans and grace:
+        time.sleep(grace)
+        orphans = _orphan_claims(orphans)
+    if orphans and not dry_run:
+        with get_db(write=True) as conn:
+            conn.executemany("DELETE FROM user_directory WHERE email=? AND user_id=?", orphans)
+    return orphans
+
+@app.cli.command('repair-directory')
+@click.option('--grace', default=60, help='Seconds a claim must stay orphaned before it is released.')
+@click.option('--dry-run', is_flag=True, help='Only list the orphaned claims.')
+def repair_directory_command(grace, dry_run):
+    """Free emails claimed by signups that died before creating the user."""
+    orphans = repair_user_directory(grace, dry_run)
+    for email, user_id in orphans:
+        print(f"{email}: {user_id}")
+    print(f"{len(orphans)} orphaned claims{' found' if dry_run else ' released'}")
+
+def epoch_now():
+    return int(time.time())
+
+# Schema migrations, applied in order and tracked with PRAGMA user_version.
+# Each one runs in its own transaction, so a failure leaves the database at the
+# last fully applied version.
+def _migration_initial_schema(c):
+    # Create users table
+    c.execute('''CREATE TABLE IF NOT EXISTS users
+                (id TEXT PRIMARY KEY, 
+                 name TEXT NOT NULL, 
+                 email TEXT UNIQUE NOT NULL, 
+                 password TEXT NOT NULL,
+                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    
+    # Create password_reset_tokens table
+    c.execute('''CREATE TABLE IF NOT EXISTS password_reset_tokens
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 email TEXT NOT NULL,
+                 token TEXT NOT NULL,
+                 expires_at TIMESTAMP NOT NULL,
+                 used INTEGER DEFAULT 0)''')
+    
+    # Create sessions table for tracking active users
+    c.execute('''CREATE TABLE IF NOT EXISTS sessions
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 user_id TEXT NOT NULL,
+                 token TEXT NOT NULL,
+                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                 expires_at TIMESTAMP NOT NULL,
+                 FOREIGN KEY (user_id) REFERENCES users (id))''')
+    
+    # Create email_outbox table drained by the mail dispatcher
+    c.execute('''CREATE TABLE IF NOT EXISTS email_outbox
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 recipient TEXT NOT NULL,
+                 subject TEXT NOT NULL,
+                 body TEXT NOT NULL,
+                 status TEXT NOT NULL DEFAULT 'pending',
+                 attempts INTEGER NOT NULL DEFAULT 0,
+                 created_at TIMESTAMP NOT NULL,
+                 next_attempt_at TIMESTAMP NOT NULL,
+                 sent_at TIMESTAMP,
+                 last_error TEXT)''')
+
+def _migration_users_avatar(c):
+    # Older databases were created with an avatar column; bring new ones in line
+    columns = [row[1] for row in c.execute("PRAGMA table_info(users)")]
+    if 'avatar' not in columns:
+        c.execute("ALTER TABLE users ADD COLUMN avatar TEXT")
+
+def _migration_epoch_timestamps(c):
+    # Token, session and outbox timestamps were local-time strings; store them as
+    # integer epoch seconds so expiry checks are plain integer comparisons
+    def to_epoch(column):
+        return f"CAST(strftime('%s', {column}, 'utc') AS INTEGER)"
+    
+    c.execute('''CREATE TABLE password_reset_tokens_new
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 email TEXT NOT NULL,
+                 token TEXT NOT NULL,
+                 expires_at INTEGER NOT NULL,
+                 used INTEGER NOT NULL DEFAULT 0)''')
+    c.execute(f'''INSERT INTO password_reset_tokens_new (id, email, token, expires_at, used)
+                 SELECT id, email, token, {to_epoch('expires_at')}, COALESCE(used, 0)
+                 FROM password_reset_tokens''')
+    c.execute("DROP TABLE password_reset_tokens")
+    c.execute("ALTER TABLE password_reset_tokens_new RENAME TO password_reset_tokens")
+    
+    c.execute('''CREATE TABLE sessions_new
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 user_id TEXT NOT NULL,
+                 token TEXT NOT NULL,
+                 created_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+                 expires_at INTEGER NOT NULL,
+                 FOREIGN KEY (user_id) REFERENCES users (id))''')
+    # sessions.created_at came from CURRENT_TIMESTAMP, which is already UTC
+    c.execute(f'''INSERT INTO sessions_new (id, user_id, token, created_at, expires_at)
+                 SELECT id, user_id, token, CAST(strftime('%s', created_at) AS INTEGER), {to_epoch('expires_at')}
+                 FROM sessions''')
+    c.execute("DROP TABLE sessions")
+    c.execute("ALTER TABLE sessions_new RENAME TO sessions")
+    
+    c.execute('''CREATE TABLE email_outbox_new
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 recipient TEXT NOT NULL,
+                 subject TEXT NOT NULL,
+                 body TEXT NOT NULL,
+                 status TEXT NOT NULL DEFAULT 'pending',
+                 attempts INTEGER NOT NULL DEFAULT 0,
+                 created_at INTEGER NOT NULL,
+                 next_attempt_at INTEGER NOT NULL,
+                 sent_at INTEGER,
+                 last_error TEXT)''')
+    c.execute(f'''INSERT INTO email_outbox_new
+                 SELECT id, recipient, subject, body, status, attempts, {to_epoch('created_at')},
+                        {to_epoch('next_attempt_at')}, {to_epoch('sent_at')}, last_error
+                 FROM email_outbox''')
+    c.execute("DROP TABLE email_outbox")
+    c.execute("ALTER TABLE email_outbox_new RENAME TO email_outbox")
+
+def _migration_auth_indexes(c):
+    # verify_otp: equality on email, token and used, then a range on expires_at
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_reset_tokens_lookup
+                 ON password_reset_tokens (email, token, used, expires_at)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_reset_tokens_expires
+                 ON password_reset_tokens (expires_at)''')
+    # logout deletes by token; cleanup deletes by expires_at
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_token ON sessions (token)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions (user_id)")
+    # mail dispatcher claims pending rows in next_attempt_at order
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_email_outbox_pending
+                 ON email_outbox (status, next_attempt_at)''')
+
+def _migration_outbox_retention_index(c):
+    # The reaper purges delivered/failed outbox rows by age
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_email_outbox_created
+                 ON email_outbox (status, created_at)''')
+
+def _migration_incremental_vacuum(c):
+    # auto_vacuum only takes effect after a full VACUUM, which cannot run inside
+    # a transaction; afterwards the reaper releases free pages incrementally
+    c.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    c.execute("VACUUM")
+
+def _migration_revoked_tokens(c):
+    # Shared source of truth for the in-memory revocation filter; every worker
+    # replays new rows in id order
+    c.execute('''CREATE TABLE IF NOT EXISTS revoked_tokens
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 jti TEXT UNIQUE NOT NULL,
+                 expires_at INTEGER NOT NULL)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_revoked_tokens_expires ON revoked_tokens (expires_at)")
+
+def _migration_transactions(c):
+    # Amounts are integer minor units (cents) so sums are exact
+    c.execute('''CREATE TABLE IF NOT EXISTS transactions
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 user_id TEXT NOT NULL,
+                 posted_at INTEGER NOT NULL,
+                 amount_cents INTEGER NOT NULL,
+                 currency TEXT NOT NULL DEFAULT 'USD',
+                 description TEXT NOT NULL DEFAULT '',
+                 category TEXT NOT NULL DEFAULT 'uncategorized',
+                 merchant TEXT,
+                 created_at INTEGER NOT NULL,
+                 FOREIGN KEY (user_id) REFERENCES users (id))''')
+    # Serves keyset pagination: equality on user_id, then (posted_at, id) order
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_transactions_user_posted
+                 ON transactions (user_id, posted_at, id)''')
+
+def _migration_statement_imports(c):
+    # Imported rows carry a hash of the statement line, so re-uploading an
+    # overlapping statement skips rows already in the ledger. Rows created
+    # through the API have no hash and are never deduplicated.
+    c.execute("ALTER TABLE transactions ADD COLUMN content_hash TEXT")
+    c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_user_hash
+                 ON transactions (user_id, content_hash) WHERE content_hash IS NOT NULL''')
+    # One row per upload, updated after every committed batch
+    c.execute('''CREATE TABLE IF NOT EXISTS statement_imports
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 user_id TEXT NOT NULL,
+                 format TEXT NOT NULL,
+                 status TEXT NOT NULL DEFAULT 'running',
+                 rows_read INTEGER NOT NULL DEFAULT 0,
+                 rows_inserted INTEGER NOT NULL DEFAULT 0,
+                 rows_duplicate INTEGER NOT NULL DEFAULT 0,
+                 rows_rejected INTEGER NOT NULL DEFAULT 0,
+                 error TEXT,
+                 started_at INTEGER NOT NULL,
+                 updated_at INTEGER NOT NULL,
+                 finished_at INTEGER,
+                 FOREIGN KEY (user_id) REFERENCES users (id))''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_statement_imports_user ON statement_imports (user_id, id)")
+
+def _migration_transaction_summaries(c):
+    # Per-user, per-month totals for the dashboard, kept current by triggers so
+    # every write path (API, statement import, manual SQL) maintains them in the
+    # same transaction as the ledger row. Currency is part of the key because
+    # amounts in different currencies cannot be summed.
+    c.execute('''CREATE TABLE IF NOT EXISTS transaction_summaries
+                (user_id TEXT NOT NULL,
+                 month TEXT NOT NULL,
+                 category TEXT NOT NULL,
+                 currency TEXT NOT NULL,
+                 total_cents INTEGER NOT NULL,
+                 txn_count INTEGER NOT NULL,
+                 PRIMARY KEY (user_id, month, category, currency)) WITHOUT ROWID''')
+    for statement in TRANSACTION_SUMMARY_TRIGGERS:
+        c.execute(statement)
+    rebuild_transaction_summaries(c)
+
+def _migration_transaction_alerts(c):
+    # Transactions the fraud scorer flagged. Rescoring replaces a user's alerts
+    # for the rescored range, and alerts go with their transaction.
+    c.execute('''CREATE TABLE IF NOT EXISTS transaction_alerts
+                (transaction_id INTEGER PRIMARY KEY,
+                 user_id TEXT NOT NULL,
+                 score REAL NOT NULL,
+                 reasons TEXT NOT NULL,
+                 amount_zscore REAL NOT NULL,
+                 velocity INTEGER NOT NULL,
+                 new_merchant INTEGER NOT NULL,
+                 scored_at INTEGER NOT NULL,
+                 FOREIGN KEY (transaction_id) REFERENCES transactions (id))''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_transaction_alerts_user ON transaction_alerts (user_id, transaction_id)")
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_transactions_alert_delete AFTER DELETE ON transactions
+                 BEGIN DELETE FROM transaction_alerts WHERE transaction_id = OLD.id; END''')
+
+def _migration_user_versions(c):
+    # row_version changes with every write to data the user reads back
+    # (profile, password, ledger, alerts); conditional GETs derive ETags from it
+    c.execute("ALTER TABLE users ADD COLUMN row_version INTEGER NOT NULL DEFAULT 1")
+    c.execute("ALTER TABLE users ADD COLUMN updated_at INTEGER NOT NULL DEFAULT 0")
+    c.execute("UPDATE users SET updated_at=?", (epoch_now(),))
+    # Workers poll for users changed since their last sync
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_updated ON users (updated_at)")
+
+def _migration_shard_directory(c):
+    # Only read in DATABASE: the owner of every email (login, signup and
+    # forgot-password find users through it, whichever shard they are on), the
+    # database holding each user bucket, and each shard's ledger id range
+    c.execute('''CREATE TABLE IF NOT EXISTS user_directory
+                (email TEXT PRIMARY KEY,
+                 user_id TEXT NOT NULL) WITHOUT ROWID''')
+    c.execute("INSERT OR IGNORE INTO user_directory (email, user_id) SELECT email, id FROM users")
+    c.execute('''CREATE TABLE IF NOT EXISTS shard_map
+                (bucket INTEGER PRIMARY KEY,
+                 database TEXT NOT NULL)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS shard_id_ranges
+                (database TEXT PRIMARY KEY,
+                 base INTEGER NOT NULL)''')
+
+# (version, description, function, runs inside a transaction)
+MIGRATIONS = [
+    (1, 'initial auth schema', _migration_initial_schema, True),
+    (2, 'users.avatar column', _migration_users_avatar, True),
+    (3, 'epoch-second timestamps', _migration_epoch_timestamps, True),
+    (4, 'auth table indexes', _migration_auth_indexes, True),
+    (5, 'outbox retention index', _migration_outbox_retention_index, True),
+    (6, 'incremental auto_vacuum', _migration_incremental_vacuum, False),
+    (7, 'revoked_tokens table', _migration_revoked_tokens, True),
+    (8, 'transactions ledger', _migration_transactions, True),
+    (9, 'statement imports', _migration_statement_imports, True),
+    (10, 'transaction summaries', _migration_transaction_summaries, True),
+    (11, 'transaction alerts', _migration_transaction_alerts, True),
+    (12, 'user row versions', _migration_user_versions, True),
+    (13, 'user directory and shard map', _migration_shard_directory, True),
+]
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(conn):
+    applied = []
+    for version, description, migration, transactional in MIGRATIONS:
+        if version <= schema_version(conn):
+            continue
+        if not transactional:
+            migration(conn.cursor())
+            conn.execute(f"PRAGMA user_version={version}")
+            applied.append((version, description))
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            migration(conn.cursor())
+            conn.execute(f"PRAGMA user_version={version}")
             conn.commit()
-            conn.close()
-            print("Database initialized successfully")
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append((version, description))
+    return applied
+
+def init_db():
+    try:
+        # DATABASE first: it holds the shard map that names the other files
+        with get_db(write=True) as conn:
+            for version, description in migrate(conn):
+                print(f"Applied migration {version}: {description}")
+        for database in known_databases()[1:]:
+            with get_db(write=True, database=database) as conn:
+                for version, description in migrate(conn):
+                    print(f"Applied migration {version} to {database}: {description}")
+        print("Database initialized successfully")
     except Exception as e:
         print(f"Error initializing database: {e}")
+        ERRORS_TOTAL.inc(component='init_db')
+
+# Hot queries and the index each should use, checked by explain-queries
+AUTH_QUERY_PLANS = [
+    ("SELECT user_id FROM user_directory WHERE email=?", ('a@example.com',), 'PRIMARY KEY'),
+    ("UPDATE password_reset_tokens SET used=1 WHERE email=? AND token=? AND expires_at > ? AND used=0",
+     ('a@example.com', 'ABCDEF', 0), 'idx_reset_tokens_lookup'),
+    ("DELETE FROM sessions WHERE token=?", ('token',), 'idx_sessions_token'),
+    ("DELETE FROM sessions WHERE expires_at < ?", (0,), 'idx_sessions_expires'),
+    ("DELETE FROM password_reset_tokens WHERE expires_at < ?", (0,), 'idx_reset_tokens_expires'),
+    ("SELECT * FROM transactions WHERE user_id=? AND (posted_at, id) < (?, ?) ORDER BY posted_at DESC, id DESC LIMIT ?",
+     ('user', 0, 0, 50), 'idx_transactions_user_posted'),
+    ("SELECT * FROM transaction_summaries WHERE user_id=? ORDER BY month, category",
+     ('user',), 'PRIMARY KEY'),
+]
+
+def explain_auth_queries(conn):
+    results = []
+    for sql, params, index in AUTH_QUERY_PLANS:
+        plan = ' | '.join(row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params))
+        results.append((sql, plan, index in plan))
+    return results
+
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """Apply pending schema migrations and requeue emails a crash left unsent.
+
+    This is prepare_database() with progress output: run it before any worker
+    of the deployment starts.
+    """
+    def apply(database):
+        with get_db(write=True, database=database) as conn:
+            for version, description in migrate(conn):
+                print(f"Applied migration {version} to {database}: {description}")
+            print(f"{database}: schema is at version {schema_version(conn)}")
+    
+    # DATABASE first: it holds the shard map that names the other files
+    apply(app.config['DATABASE'])
+    for database in known_databases()[1:]:
+        apply(database)
+    released = mail_dispatcher.release_stale_claims()
+    if released:
+        print(f"Requeued {released} emails left in 'sending'")
+
+@app.cli.command('explain-queries')
+def explain_queries_command():
+    """Show EXPLAIN QUERY PLAN for the hot auth queries; exit 1 if any misses its index."""
+    with get_db() as conn:
+        results = explain_auth_queries(conn)
+    for sql, plan, uses_index in results:
+        print(f"{'OK  ' if uses_index else 'SCAN'} {sql}\n     {plan}")
+    if not all(uses_index for _, _, uses_index in results):
+        raise SystemExit(1)
+
+# Rows that move with their user, in copy order: (table, rows of the users in
+# the temp table `moving`, whether row ids are kept). Ledger ids are kept,
+# which is safe because each database allocates them from its own range;
+# session and reset-code ids are internal and reassigned.
+# transaction_summaries is not copied: the ledger triggers rebuild it on the
+# target as the transactions land, and run it down on the source.
+SHARDED_TABLES = [
+    ('users', "id IN moving", True),
+    ('sessions', "user_id IN moving", False),
+    ('password_reset_tokens', "email IN (SELECT email FROM main.users WHERE id IN moving)", False),
+    ('statement_imports', "user_id IN moving", True),
+    ('transactions', "user_id IN moving", True),
+    ('transaction_alerts', "user_id IN moving", True),
+]
+
+def plan_shards(current, targets):
+    """Assign every bucket to one of `targets`, moving as few as possible.
+
+    Each target keeps up to its even share of the buckets it already holds;
+    the rest go to whichever target has fewest, so going from N to N+1 shards
+    moves about 1/(N+1) of the users.
+    """
+    share = -(-SHARD_BUCKETS // len(targets))
+    counts = {database: 0 for database in targets}
+    plan = [None] * SHARD_BUCKETS
+    for bucket, database in enumerate(current):
+        if database in counts and counts[database] < share:
+            plan[bucket] = database
+            counts[database] += 1
+    for bucket in range(SHARD_BUCKETS):
+        if plan[bucket] is None:
+            database = min(targets, key=lambda name: (counts[name], targets.index(name)))
+            plan[bucket] = database
+            counts[database] += 1
+    return plan
+
+# Migrate a database about to receive users and give it its own ledger id
+# range; DATABASE keeps the range starting at zero
+def _prepare_shard(database):
+    with get_db(write=True, database=database) as conn:
+        migrate(conn)
+    if database == app.config['DATABASE']:
+        return
+    with get_db(write=True) as conn:
+        row = conn.execute("SELECT base FROM shard_id_ranges WHERE database=?", (database,)).fetchone()
+        if row:
+            base = row['base']
+        else:
+            base = (conn.execute("SELECT COUNT(*) FROM shard_id_ranges").fetchone()[0] + 1) * SHARD_ID_STRIDE
+            conn.execute("INSERT INTO shard_id_ranges (database, base) VALUES (?, ?)", (database, base))
+    with get_db(write=True, database=database) as conn:
+        for table in ('statement_imports', 'transactions'):
+            if not conn.execute("UPDATE sqlite_sequence SET seq = max(seq, ?) WHERE name=?", (base, table)).rowcount:
+                conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table, base))
+
+def _move_buckets(source, target, buckets):
+    """Move the users of `buckets` from source to target, one bucket per transaction.
+
+    Each bucket is copied and deleted in one transaction across the attached
+    files and then remapped. WAL makes that commit atomic per file, not across
+    both, so a crash can leave a bucket's rows on both sides; the copy is
+    INSERT OR IGNORE, so running reshard again finishes the move.
+    """
+    conn = sqlite3.connect(source, timeout=app.config['DB_BUSY_TIMEOUT_MS'] / 1000.0, isolation_level=None)
+    try:
+        conn.execute("ATTACH DATABASE ? AS dest", (target,))
+        conn.execute("CREATE TEMP TABLE moving (id TEXT PRIMARY KEY)")
+        columns = {}
+        for table, _, keep_ids in SHARDED_TABLES:
+            columns[table] = ', '.join(row[1] for row in conn.execute(f"PRAGMA main.table_info({table})")
+                                       if keep_ids or row[1] != 'id')
+        moved = 0
+        for bucket, user_ids in buckets.items():
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM moving")
+                conn.executemany("INSERT INTO moving (id) VALUES (?)", [(user_id,) for user_id in user_ids])
+                for table, where, _ in SHARDED_TABLES:
+                    conn.execute(f"""INSERT OR IGNORE INTO dest.{table} ({columns[table]})
+                                     SELECT {columns[table]} FROM main.{table} WHERE {where}""")
+                for table, where, _ in reversed(SHARDED_TABLES):
+                    conn.execute(f"DELETE FROM main.{table} WHERE {where}")
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            with get_db(write=True) as main:
+                main.execute("INSERT OR REPLACE INTO shard_map (bucket, database) VALUES (?, ?)", (bucket, target))
+            moved += len(user_ids)
+        return moved
+    finally:
+        conn.close()
+
+def reshard(targets, dry_run=False):
+    """Move users so their buckets are spread over `targets`; return {(source, target): users}.
+
+    Run it with the app stopped: workers cache the shard map, and users are
+    unavailable while their bucket moves.
+    """
+    current = list(shard_router.buckets())
+    plan = plan_shards(current, targets)
+    moves = {}
+    for bucket, (source, target) in enumerate(zip(current, plan)):
+        if source != target:
+            moves.setdefault(source, {}).setdefault(target, {})[bucket] = []
+    
+    # One pass over each source's users sorts them into the buckets that move
+    for source, by_target in moves.items():
+        target_of = {bucket: target for target, buckets in by_target.items() for bucket in buckets}
+        with get_db(database=source) as conn:
+            for (user_id,) in conn.execute("SELECT id FROM users"):
+                bucket = user_bucket(user_id)
+                if bucket in target_of:
+                    by_target[target_of[bucket]][bucket].append(user_id)
+    
+    if not dry_run:
+        for target in targets:
+            _prepare_shard(target)
+    moved = {}
+    for source, by_target in moves.items():
+        for target, buckets in by_target.items():
+            buckets = {bucket: user_ids for bucket, user_ids in buckets.items() if user_ids}
+            if dry_run:
+                moved[(source, target)] = sum(len(user_ids) for user_ids in buckets.values())
+            else:
+                moved[(source, target)] = _move_buckets(source, target, buckets)
+    
+    if not dry_run:
+        # Buckets that stay put are written too, so the map no longer depends on the defaults
+        with get_db(write=True) as conn:
+            conn.executemany("INSERT OR REPLACE INTO shard_map (bucket, database) VALUES (?, ?)", enumerate(plan))
+        shard_router.reload()
+    return moved
+
+@app.cli.command('reshard')
+@click.option('--shards', default=None, help='Comma-separated database files (default DATABASE_SHARDS).')
+@click.option('--dry-run', is_flag=True, help='Only report how many users would move.')
+def reshard_command(shards, dry_run):
+    """Spread users over a new set of shard databases. Run it with the app stopped."""
+    targets = [path for path in shards.split(',') if path] if shards else app.config['DATABASE_SHARDS']
+    if not targets:
+        raise click.UsageError('No shards given: pass --shards or set DATABASE_SHARDS')
+    started = time.perf_counter()
+    moved = reshard(list(dict.fromkeys(targets)), dry_run)
+    for (source, target), users in sorted(moved.items()):
+        print(f"{source} -> {target}: {users} users{' would move' if dry_run else ''}")
+    print(f"{sum(moved.values())} users in {time.perf_counter() - started:.2f}s")
+
+# Authenticated-user cache settings
+app.config['USER_CACHE_MAX_ENTRIES'] = 10000
+app.config['USER_CACHE_TTL'] = 60         # seconds a cached token -> user row stays valid
+app.config['USER_SYNC_SECONDS'] = 2       # how often workers drop rows other workers changed
+
+class UserCache:
+    """Bounded LRU/TTL cache mapping bearer tokens to user rows and claims.
+
+    A hit skips both the JWT decode and the users lookup. Entries never outlive
+    the token's own ``exp`` claim, and a secondary index by user id lets
+    password resets drop every token cached for that user.
+    """
+
+    def __init__(self, max_entries=10000, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._by_user = {}
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _drop(self, token):
+        user, _, _ = self._entries.pop(token)
+        tokens = self._by_user.get(user['id'])
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._by_user[user['id']]
+
+    def get(self, token):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+            user, claims, expires_at = entry
+            if expires_at <= now:
+                self._drop(token)
+                self.misses += 1
+                self.evictions += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return user, claims
+
+    def put(self, token, user, claims):
+        expires_at = min(time.time() + self.ttl, claims['exp'])
+        with self._lock:
+            if token in self._entries:
+                self._drop(token)
+            self._entries[token] = (user, claims, expires_at)
+            self._by_user.setdefault(user['id'], set()).add(token)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate_token(self, token):
+        with self._lock:
+            if token in self._entries:
+                self._drop(token)
+                self.invalidations += 1
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for token in list(self._by_user.get(user_id, ())):
+                self._drop(token)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+_user_cache = None
+_user_cache_lock = Lock()
+
+def get_user_cache():
+    global _user_cache
+    if _user_cache is None:
+        with _user_cache_lock:
+            if _user_cache is None:
+                _user_cache = UserCache(
+                    max_entries=app.config['USER_CACHE_MAX_ENTRIES'],
+                    ttl=app.config['USER_CACHE_TTL'],
+                )
+    return _user_cache
+
+# Record a write to data the user reads back, in the caller's write transaction:
+# bumps users.row_version (and so every ETag built from it). Callers drop the
+# user's cached rows with invalidate_cached_users once that transaction has
+# committed; dropping them earlier lets a concurrent request re-cache the old
+# row. Other workers drop theirs on their next sync_user_changes, so their
+# 304s are at most USER_SYNC_SECONDS stale.
+def bump_user_version(conn, user_ids):
+    conn.executemany("UPDATE users SET row_version = row_version + 1, updated_at = ? WHERE id = ?",
+                     [(epoch_now(), user_id) for user_id in user_ids])
+
+def invalidate_cached_users(user_ids):
+    cache = get_user_cache()
+    for user_id in user_ids:
+        cache.invalidate_user(user_id)
+
+_user_sync_since = None
+
+def sync_user_changes():
+    global _user_sync_since
+    try:
+        now = epoch_now()
+        since = now if _user_sync_since is None else _user_sync_since
+        # One second of overlap catches writes committed within the second of the last sync
+        cache = get_user_cache()
+        for database in shard_router.databases():
+            with get_db(database=database) as conn:
+                rows = conn.execute("SELECT id FROM users WHERE updated_at >= ?", (since - 1,)).fetchall()
+            for row in rows:
+                cache.invalidate_user(row['id'])
+        _user_sync_since = now
+    except Exception as e:
+        print(f"Error syncing user changes: {e}")
+        ERRORS_TOTAL.inc(component='user_sync')
+
+# Token revocation settings
+app.config['REVOCATION_CAPACITY'] = 100000        # expected revoked-but-unexpired tokens
+app.config['REVOCATION_ERROR_RATE'] = 0.001       # filter false-positive rate at capacity
+app.config['REVOCATION_SYNC_SECONDS'] = 2         # how often workers pick up other workers' revocations
+app.config['REVOCATION_LOAD_CHUNK'] = 10000
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings using double hashing of one blake2b digest."""
+
+    def __init__(self, capacity, error_rate):
+        capacity = max(1, capacity)
+        self.capacity = capacity
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self._bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+class RevocationList:
+    """Revoked token ids, answered from a Bloom filter with the database as backstop.
+
+    A filter miss means "not revoked" with no I/O. Only a filter hit is
+    confirmed against revoked_tokens. Each worker replays rows it has not yet
+    seen by id, so revocations made elsewhere reach it within
+    REVOCATION_SYNC_SECONDS.
+    """
+
+    def __init__(self):
+        self._filter = None
+        self._last_id = 0
+        self._lock = Lock()
+        self.checks = 0
+        self.filter_hits = 0
+        self.confirmed = 0
+
+    def _new_filter(self, minimum):
+        capacity = max(app.config['REVOCATION_CAPACITY'], 2 * minimum)
+        return BloomFilter(capacity, app.config['REVOCATION_ERROR_RATE'])
+
+    def _replay(self, bloom, after_id):
+        # Read new rows in id-ordered chunks so a large backlog never holds one long read
+        chunk = app.config['REVOCATION_LOAD_CHUNK']
+        now = epoch_now()
+        while True:
+            with get_db() as conn:
+                rows = conn.execute("""SELECT id, jti, expires_at FROM revoked_tokens
+                                       WHERE id > ? ORDER BY id LIMIT ?""", (after_id, chunk)).fetchall()
+            for row in rows:
+                if row['expires_at'] > now:
+                    bloom.add(row['jti'])
+            if rows:
+                after_id = rows[-1]['id']
+            if len(rows) < chunk:
+                return after_id
+
+    def load(self):
+        """Rebuild the filter from scratch, dropping tokens that have since expired."""
+        bloom = self._new_filter(0)
+        last_id = self._replay(bloom, 0)
+        if bloom.count > bloom.capacity:
+            bloom = self._new_filter(bloom.count)
+            last_id = self._replay(bloom, 0)
+        with self._lock:
+            # Catch up on rows committed during the rebuild: a revoke() in that
+            # window added its jti to the filter being replaced
+            self._last_id = self._replay(bloom, last_id)
+            self._filter = bloom
+
+    def sync(self):
+        if self._filter is None:
+            self.load()
+            return
+        with self._lock:
+            self._last_id = self._replay(self._filter, self._last_id)
+            overfull = self._filter.count > self._filter.capacity
+        if overfull:
+            self.load()
+
+    def reset_after_fork(self):
+        self._lock = Lock()
+
+    def revoke(self, jti, expires_at):
+        if not jti:
+            return
+        with get_db(write=True) as conn:
+            conn.execute("INSERT OR IGNORE INTO revoked_tokens (jti, expires_at) VALUES (?, ?)",
+                         (jti, int(expires_at)))
+        if self._filter is None:
+            self.load()
+        # Setting bits is read-modify-write on the shared bytearray, which
+        # sync() also writes under the lock
+        with self._lock:
+            self._filter.add(jti)
+
+    def is_revoked(self, jti):
+        # Tokens issued before jti was added cannot be revoked; they expire normally
+        if not jti:
+            return False
+        if self._filter is None:
+            self.load()
+        self.checks += 1
+        if jti not in self._filter:
+            return False
+        self.filter_hits += 1
+        with get_db() as conn:
+            row = conn.execute("SELECT 1 FROM revoked_tokens WHERE jti=?", (jti,)).fetchone()
+        if row:
+            self.confirmed += 1
+        return row is not None
+
+    def stats(self):
+        bloom = self._filter
+        return {
+            'entries': bloom.count if bloom else 0,
+            'capacity': bloom.capacity if bloom else 0,
+            'checks': self.checks,
+            'filter_hits': self.filter_hits,
+            'confirmed': self.confirmed,
+            'false_positives': self.filter_hits - self.confirmed,
+        }
+
+revocations = RevocationList()
+
+def sync_revocations():
+    try:
+        revocations.sync()
+    except Exception as e:
+        print(f"Error syncing token revocations: {e}")
+        ERRORS_TOTAL.inc(component='revocation_sync')
 
 # Token required decorator
 def token_required(f):
@@ -88,17 +1335,31 @@ def token_required(f):
             if token.startswith('Bearer '):
                 token = token[7:]
                 
-            data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
-            
-            with db_lock:
-                conn = get_db()
-                c = conn.cursor()
-                c.execute("SELECT * FROM users WHERE id=?", (data['user_id'],))
-                current_user = c.fetchone()
-                conn.close()
+            cache = get_user_cache()
+            cached = cache.get(token)
             
-            if not current_user:
-                return jsonify({'message': 'Invalid token'}), 401
+            if cached is None:
+                data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+                
+                # Checked before the users lookup so revoked tokens cost no query
+                if revocations.is_revoked(data.get('jti')):
+                    return jsonify({'message': 'Token has been revoked'}), 401
+                
+                with get_db(user_id=data['user_id']) as conn:
+                    c = conn.cursor()
+                    c.execute("SELECT * FROM users WHERE id=?", (data['user_id'],))
+                    current_user = c.fetchone()
+                
+                if not current_user:
+                    return jsonify({'message': 'Invalid token'}), 401
+                
+                cache.put(token, current_user, data)
+            else:
+                # Another worker may have revoked the token since it was cached
+                current_user, data = cached
+                if revocations.is_revoked(data.get('jti')):
+                    cache.invalidate_token(token)
+                    return jsonify({'message': 'Token has been revoked'}), 401
                 
         except jwt.ExpiredSignatureError:
             return jsonify({'message': 'Token has expired'}), 401
@@ -109,109 +1370,1093 @@ def token_required(f):
         
     return decorated
 
+# Conditional GET for authenticated reads whose body depends only on the
+# user's own data. Stack it under @token_required: the ETag is built from the
+# cached user row's row_version, so an unchanged poll is answered 304 before
+# the view runs, with no query and no serialization. Writes that change what
+# such a route returns must call bump_user_version.
+def conditional_get(f):
+    @wraps(f)
+    def decorated(current_user, *args, **kwargs):
+        etag = hashlib.blake2b(f"{current_user['id']}:{current_user['row_version']}:{request.full_path}".encode('utf-8'),
+                               digest_size=8).hexdigest()
+        updated_at = current_user['updated_at']
+        
+        # If-None-Match wins over If-Modified-Since when both are sent
+        if request.if_none_match:
+            fresh = request.if_none_match.contains_weak(etag)
+        elif request.if_modified_since and updated_at:
+            fresh = request.if_modified_since.timestamp() >= updated_at
+        else:
+            fresh = False
+        
+        if fresh:
+            response = Response(status=304)
+        else:
+            response = make_response(f(current_user, *args, **kwargs))
+            if response.status_code != 200:
+                return response
+        
+        response.set_etag(etag, weak=True)
+        if updated_at:
+            response.last_modified = updated_at
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Authorization')
+        return response
+    
+    return decorated
+
 # Helper function to generate JWT token
 def generate_token(user_id):
     payload = {
         'user_id': user_id,
-        'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=24)
+        'jti': uuid.uuid4().hex,
+        'exp': datetime.datetime.utcnow() + datetime.timedelta(seconds=app.config['TOKEN_TTL_SECONDS'])
     }
     return jwt.encode(payload, app.config['SECRET_KEY'], algorithm="HS256")
 
-# Function to send email with OTP
+# Password hashing settings
+app.config['BCRYPT_ROUNDS'] = 12
+# Both limits are for the whole host: multi-process servers split them
+# between their workers (see share_hashing_pool)
+app.config['HASH_WORKERS'] = os.cpu_count() or 1
+app.config['HASH_QUEUE_LIMIT'] = 4 * (os.cpu_count() or 1)   # in-flight hash jobs before rejecting
+app.config['HASH_RETRY_AFTER'] = 1        # seconds suggested to clients when saturated
+
+class HashingBusy(Exception):
+    """Raised when the hashing pool is saturated and the request should be shed."""
+
+# bcrypt is imported inside the pool workers, keeping it off the import path
+def _hash_password(password, rounds):
+    import bcrypt
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+def _check_password(password, hashed):
+    import bcrypt
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+_hash_executor = None
+_hash_slots = None
+_hash_lock = Lock()
+
+def _get_hash_executor():
+    global _hash_executor, _hash_slots
+    if _hash_executor is None:
+        with _hash_lock:
+            if _hash_executor is None:
+                _hash_slots = BoundedSemaphore(app.config['HASH_QUEUE_LIMIT'])
+                _hash_executor = ProcessPoolExecutor(max_workers=app.config['HASH_WORKERS'])
+    return _hash_executor, _hash_slots
+
+def shutdown_hash_executor():
+    global _hash_executor, _hash_slots
+    with _hash_lock:
+        if _hash_executor is not None:
+            _hash_executor.shutdown(wait=False, cancel_futures=True)
+            _hash_executor = None
+            _hash_slots = None
+
+# Run fn in the hashing pool, rejecting immediately instead of queueing when
+# HASH_QUEUE_LIMIT jobs are already in flight
+def _run_hash_job(fn, *args):
+    executor, slots = _get_hash_executor()
+    if not slots.acquire(blocking=False):
+        HASH_REJECTED_TOTAL.inc()
+        raise HashingBusy()
+    started = time.perf_counter()
+    try:
+        future = executor.submit(fn, *args)
+    except Exception:
+        slots.release()
+        raise
+    future.add_done_callback(lambda _: slots.release())
+    try:
+        return future.result()
+    except BrokenProcessPool:
+        shutdown_hash_executor()
+        raise
+    finally:
+        HASH_SECONDS.observe(time.perf_counter() - started, op=fn.__name__.lstrip('_'))
+
+# Give each of `workers` server processes its share of the host's hashing
+# pool and admission limit, so running more workers never admits more bcrypt
+# work than the host has cores for. Call before the workers start hashing.
+def share_hashing_pool(workers):
+    if workers > 1:
+        app.config['HASH_WORKERS'] = max(1, app.config['HASH_WORKERS'] // workers)
+        app.config['HASH_QUEUE_LIMIT'] = max(1, app.config['HASH_QUEUE_LIMIT'] // workers)
+
+def hash_password(password):
+    return _run_hash_job(_hash_password, password, app.config['BCRYPT_ROUNDS'])
+
+def check_password(password, hashed):
+    return _run_hash_job(_check_password, password, hashed)
+
+def hashing_busy_response():
+    response = jsonify({'success': False, 'message': 'Server is busy, please try again shortly'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(app.config['HASH_RETRY_AFTER'])
+    return response
+
+# Outbound mail queue settings
+app.config['MAIL_TIMEOUT'] = 30           # seconds for SMTP socket operations
+app.config['MAIL_BATCH_SIZE'] = 50        # outbox rows claimed per dispatcher pass
+app.config['MAIL_MAX_ATTEMPTS'] = 5
+app.config['MAIL_RETRY_BACKOFF'] = 30     # seconds, doubled after every failed attempt
+app.config['MAIL_POLL_INTERVAL'] = 5      # seconds the dispatcher sleeps when idle
+app.config['MAIL_IDLE_DISCONNECT'] = 60   # close the SMTP connection after this many idle seconds
+
+OTP_EMAIL_SUBJECT = 'Your Mavrick Verification Code'
+
+def render_otp_email(otp):
+    body = f"""
+    <html>
+    <body>
+        <h2>Your Mavrick Verification Code</h2>
+        <p>Hello there,</p>
+        <p>Your verification code for Mavrick is:</p>
+        <div style="background: #f8f9fa; padding: 15px; text-align: center; font-size: 28px; 
+                    font-weight: bold; letter-spacing: 5px; color: #d62246; border-radius: 8px; 
+                    margin: 15px 0; border: 1px dashed #e1e5eb;">
+            {otp}
+        </div>
+        <p>Enter this code to complete your authentication process.</p>
+        <p>This code will expire in 10 minutes.</p>
+        <p>If you didn't request this code, please ignore this email.</p>
+        <p>Thanks,<br/>The Mavrick Team</p>
+        <div style="font-size: 12px; color: #7f8c8d; text-align: center; margin-top: 15px;">
+            <i class="fas fa-shield-alt"></i> Protect your verification code. Never share it with anyone.
+        </div>
+    </body>
+    </html>
+    """
+    return body
+
+def build_message(recipient, subject, body):
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    sender = app.config['MAIL_SENDER'] or app.config['MAIL_USERNAME']
+    if not sender:
+        # smtplib would fail later with an opaque IndexError
+        raise ValueError("No sender address: set MAIL_SENDER or MAIL_USERNAME")
+    msg = MIMEMultipart()
+    msg['From'] = sender
+    msg['To'] = recipient
+    msg['Subject'] = subject
+    msg.attach(MIMEText(body, 'html'))
+    return msg
+
+def open_smtp_connection():
+    import smtplib
+    server = smtplib.SMTP(app.config['MAIL_SERVER'], app.config['MAIL_PORT'],
+                          timeout=app.config['MAIL_TIMEOUT'])
+    if app.config['MAIL_USE_TLS']:
+        server.starttls()
+    if app.config['MAIL_USERNAME'] and app.config['MAIL_PASSWORD']:
+        server.login(app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
+    return server
+
+# Function to send email with OTP synchronously over a one-off connection
 def send_otp_email(email, otp):
     try:
-        # Create message
-        msg = MIMEMultipart()
-        msg['From'] = app.config['MAIL_USERNAME']
-        msg['To'] = email
-        msg['Subject'] = 'Your Mavrick Verification Code'
-        
-        # Email body
-        body = f"""
-        <html>
-        <body>
-            <h2>Your Mavrick Verification Code</h2>
-            <p>Hello there,</p>
-            <p>Your verification code for Mavrick is:</p>
-            <div style="background: #f8f9fa; padding: 15px; text-align: center; font-size: 28px; 
-                        font-weight: bold; letter-spacing: 5px; color: #d62246; border-radius: 8px; 
-                        margin: 15px 0; border: 1px dashed #e1e5eb;">
-                {otp}
-            </div>
-            <p>Enter this code to complete your authentication process.</p>
-            <p>This code will expire in 10 minutes.</p>
-            <p>If you didn't request this code, please ignore this email.</p>
-            <p>Thanks,<br/>The Mavrick Team</p>
-            <div style="font-size: 12px; color: #7f8c8d; text-align: center; margin-top: 15px;">
-                <i class="fas fa-shield-alt"></i> Protect your verification code. Never share it with anyone.
-            </div>
-        </body>
-        </html>
-        """
-        
-        msg.attach(MIMEText(body, 'html'))
+        msg = build_message(email, OTP_EMAIL_SUBJECT, render_otp_email(otp))
         
         # Send email
-        server = smtplib.SMTP(app.config['MAIL_SERVER'], app.config['MAIL_PORT'])
-        server.starttls()
-        server.login(app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
+        server = open_smtp_connection()
         server.send_message(msg)
         server.quit()
         
         return True
     except Exception as e:
         print(f"Error sending email: {e}")
+        ERRORS_TOTAL.inc(component='smtp')
         return False
 
-# Clean up expired tokens (run this periodically)
-def cleanup_expired_tokens():
-    try:
-        with db_lock:
-            conn = get_db()
+# Queue an email in the outbox using the caller's write connection, so it is
+# committed atomically with whatever produced it
+def enqueue_email(conn, recipient, subject, body):
+    now = epoch_now()
+    conn.execute("""INSERT INTO email_outbox (recipient, subject, body, created_at, next_attempt_at)
+                    VALUES (?, ?, ?, ?, ?)""", (recipient, subject, body, now, now))
+
+class MailDispatcher:
+    """Background sender that drains the email_outbox table.
+
+    A single worker thread keeps one authenticated SMTP connection open across
+    batches, reconnects when the server drops it and retries failed messages
+    with exponential backoff until MAIL_MAX_ATTEMPTS is reached.
+    """
+
+    def __init__(self):
+        self._wakeup = Event()
+        self._stopping = Event()
+        self._thread = None
+        self._server = None
+        self._last_used = 0.0
+        self._stats_lock = Lock()
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.send_seconds = 0.0
+        self.max_send_seconds = 0.0
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = Thread(target=self._run, name='mail-dispatcher', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self._disconnect()
+
+    def notify(self):
+        self._wakeup.set()
+
+    def reset_after_fork(self):
+        # The worker thread and SMTP socket belong to the parent process
+        self._wakeup = Event()
+        self._stopping = Event()
+        self._stats_lock = Lock()
+        self._thread = None
+        self._server = None
+
+    def release_stale_claims(self):
+        # Rows left in 'sending' by a process that died mid-batch go back to the
+        # queue; only call this before any dispatcher in the deployment starts
+        try:
+            with get_db(write=True) as conn:
+                return conn.execute("UPDATE email_outbox SET status='pending' WHERE status='sending'").rowcount
+        except Exception as e:
+            print(f"Error releasing stale email claims: {e}")
+            ERRORS_TOTAL.inc(component='mail_outbox')
+            return 0
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                batch = self._claim_batch()
+            except Exception as e:
+                print(f"Error reading email outbox: {e}")
+                ERRORS_TOTAL.inc(component='mail_outbox')
+                batch = []
+
+            released = False
+            for row in batch:
+                try:
+                    self._deliver(row)
+                except Exception as e:
+                    # Recording the outcome failed (e.g. database is locked):
+                    # requeue the row rather than leave it claimed. Delivery is
+                    # at-least-once, so a sent message may go out again.
+                    print(f"Error updating email outbox: {e}")
+                    ERRORS_TOTAL.inc(component='mail_outbox')
+                    self._release(row)
+                    released = True
+            # After a failed outbox write, wait a poll interval before reclaiming
+            if batch and not released:
+                continue
+
+            if self._server is not None and time.monotonic() - self._last_used > app.config['MAIL_IDLE_DISCONNECT']:
+                self._disconnect()
+            self._wakeup.wait(app.config['MAIL_POLL_INTERVAL'])
+            self._wakeup.clear()
+        self._disconnect()
+
+    def _claim_batch(self):
+        now = epoch_now()
+        with get_db(write=True) as conn:
             c = conn.cursor()
-            now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            c.execute("DELETE FROM password_reset_tokens WHERE expires_at < ?", (now,))
-            c.execute("DELETE FROM sessions WHERE expires_at < ?", (now,))
-            conn.commit()
-            conn.close()
-        print("Expired tokens cleaned up successfully")
-    except Exception as e:
-        print(f"Error cleaning up expired tokens: {e}")
+            # Every worker process runs a dispatcher: take the database write
+            # lock before reading, so no two of them claim the same rows
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("""SELECT * FROM email_outbox WHERE status='pending' AND next_attempt_at <= ?
+                         ORDER BY id LIMIT ?""", (now, app.config['MAIL_BATCH_SIZE']))
+            batch = c.fetchall()
+            c.executemany("UPDATE email_outbox SET status='sending' WHERE id=?",
+                          [(row['id'],) for row in batch])
+        return batch
 
-# Routes
-@app.route('/api/login', methods=['POST'])
-def login():
-    try:
-        data = request.get_json()
-        email = data.get('email')
-        password = data.get('password')
-        
-        if not email or not password:
-            return jsonify({'success': False, 'message': 'Email and password are required'}), 400
-            
-        with db_lock:
-            conn = get_db()
+    def _release(self, row):
+        try:
+            with get_db(write=True) as conn:
+                conn.execute("UPDATE email_outbox SET status='pending' WHERE id=? AND status='sending'",
+                             (row['id'],))
+        except Exception as e:
+            # Still claimed; release_stale_claims requeues it on the next start
+            print(f"Error releasing email claim: {e}")
+            ERRORS_TOTAL.inc(component='mail_outbox')
+
+    def _connect(self):
+        if self._server is None:
+            self._server = open_smtp_connection()
+        return self._server
+
+    def _disconnect(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                pass
+            self._server = None
+
+    def _send(self, msg):
+        import smtplib
+        try:
+            self._connect().send_message(msg)
+        except (smtplib.SMTPServerDisconnected, ConnectionError, OSError):
+            # The kept-alive connection went stale; reconnect once and retry
+            self._server = None
+            self._connect().send_message(msg)
+        self._last_used = time.monotonic()
+
+    def _deliver(self, row):
+        started = time.perf_counter()
+        try:
+            self._send(build_message(row['recipient'], row['subject'], row['body']))
+        except Exception as e:
+            print(f"Error sending email: {e}")
+            ERRORS_TOTAL.inc(component='smtp')
+            self._disconnect()
+            self._record_failure(row, e)
+            return
+
+        elapsed = time.perf_counter() - started
+        SMTP_SECONDS.observe(elapsed)
+        with self._stats_lock:
+            self.sent += 1
+            self.send_seconds += elapsed
+            self.max_send_seconds = max(self.max_send_seconds, elapsed)
+        with get_db(write=True) as conn:
+            conn.execute("UPDATE email_outbox SET status='sent', attempts=attempts+1, sent_at=? WHERE id=?",
+                         (epoch_now(), row['id']))
+
+    def _record_failure(self, row, error):
+        attempts = row['attempts'] + 1
+        if attempts >= app.config['MAIL_MAX_ATTEMPTS']:
+            status, delay = 'failed', 0
+            with self._stats_lock:
+                self.failed += 1
+        else:
+            status, delay = 'pending', app.config['MAIL_RETRY_BACKOFF'] * (2 ** (attempts - 1))
+            with self._stats_lock:
+                self.retried += 1
+        next_attempt_at = epoch_now() + delay
+        with get_db(write=True) as conn:
+            conn.execute("""UPDATE email_outbox SET status=?, attempts=?, next_attempt_at=?, last_error=?
+                            WHERE id=?""", (status, attempts, next_attempt_at, str(error)[:500], row['id']))
+
+    def stats(self):
+        with get_db() as conn:
             c = conn.cursor()
-            c.execute("SELECT * FROM users WHERE email=?", (email,))
-            user = c.fetchone()
-            conn.close()
-        
-        if not user:
-            return jsonify({'success': False, 'message': 'Invalid email or password'}), 401
-            
-        # Verify password
-        if bcrypt.checkpw(password.encode('utf-8'), user['password'].encode('utf-8')):
-            token = generate_token(user['id'])
-            
-            # Store session
-            with db_lock:
-                conn = get_db()
-                c = conn.cursor()
-                expires_at = (datetime.datetime.now() + datetime.timedelta(hours=24)).strftime('%Y-%m-%d %H:%M:%S')
-                c.execute("INSERT INTO sessions (user_id, token, expires_at) VALUES (?, ?, ?)",
-                         (user['id'], token, expires_at))
-                conn.commit()
-                conn.close()
+            c.execute("SELECT COUNT(*) FROM email_outbox WHERE status IN ('pending', 'sending')")
+            depth = c.fetchone()[0]
+        with self._stats_lock:
+            return {
+                'queue_depth': depth,
+                'sent': self.sent,
+                'failed': self.failed,
+                'retried': self.retried,
+                'avg_send_seconds': self.send_seconds / self.sent if self.sent else 0.0,
+                'max_send_seconds': self.max_send_seconds,
+                'connected': self._server is not None,
+            }
+
+mail_dispatcher = MailDispatcher()
+
+# Session and OTP storage settings
+app.config['SESSION_BACKEND'] = os.environ.get('SESSION_BACKEND', 'sqlite')   # sqlite, memory or redis
+app.config['REDIS_URL'] = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+app.config['REDIS_KEY_PREFIX'] = 'finguard:'
+app.config['MEMORY_STORE_SHARDS'] = 16
+app.config['TOKEN_TTL_SECONDS'] = 24 * 3600
+app.config['OTP_TTL_SECONDS'] = 10 * 60
+
+class SessionStore(ABC):
+    """Where issued login tokens are recorded until they expire or log out."""
+
+    @abstractmethod
+    def add(self, token, user_id, ttl):
+        pass
+
+    @abstractmethod
+    def delete(self, token):
+        pass
+
+    def purge_expired(self):
+        return 0
+
+class OtpStore(ABC):
+    """Where password-reset codes live until they are used or expire."""
+
+    @abstractmethod
+    def add(self, email, code, ttl):
+        pass
+
+    @abstractmethod
+    def consume(self, email, code):
+        """Atomically mark a live code as used; return True if it was valid."""
+
+    def purge_expired(self):
+        return 0
+
+class SqliteSessionStore(SessionStore):
+    # Sessions live on their user's shard. Expired rows are removed in batches
+    # by cleanup_expired_tokens.
+
+    @staticmethod
+    def _owner(token):
+        # Session tokens are this app's JWTs, so the owning user is in the payload;
+        # the signature was already checked by whoever handed the token over
+        try:
+            return jwt.decode(token, options={'verify_signature': False}).get('user_id')
+        except jwt.InvalidTokenError:
+            return None
+
+    def add(self, token, user_id, ttl):
+        with get_db(write=True, user_id=user_id) as conn:
+            conn.execute("INSERT INTO sessions (user_id, token, expires_at) VALUES (?, ?, ?)",
+                         (user_id, token, epoch_now() + ttl))
+
+    def delete(self, token):
+        user_id = self._owner(token)
+        if user_id is None:
+            return
+        with get_db(write=True, user_id=user_id) as conn:
+            conn.execute("DELETE FROM sessions WHERE token=?", (token,))
+
+class SqliteOtpStore(OtpStore):
+    # Codes live on the shard of the user the email belongs to
+
+    def add(self, email, code, ttl):
+        user_id = lookup_user_id(email)
+        if user_id is None:
+            return
+        with get_db(write=True, user_id=user_id) as conn:
+            conn.execute("INSERT INTO password_reset_tokens (email, token, expires_at) VALUES (?, ?, ?)",
+                         (email, code, epoch_now() + ttl))
+
+    def consume(self, email, code):
+        user_id = lookup_user_id(email)
+        if user_id is None:
+            return False
+        # One conditional UPDATE, so of two workers checking the same code only
+        # one sees a changed row
+        with get_db(write=True, user_id=user_id) as conn:
+            c = conn.execute("""UPDATE password_reset_tokens SET used=1
+                                WHERE email=? AND token=? AND expires_at > ? AND used=0""",
+                             (email, code, epoch_now()))
+            return c.rowcount > 0
+
+class _ShardedTtlDict:
+    """Dict split across independently locked shards, with lazy expiry on read."""
+
+    def __init__(self, shards=16):
+        self._shards = [({}, Lock()) for _ in range(shards)]
+
+    def _shard(self, key):
+        return self._shards[hash(key) % len(self._shards)]
+
+    def set(self, key, value, ttl):
+        data, lock = self._shard(key)
+        with lock:
+            data[key] = (value, time.time() + ttl)
+
+    def pop(self, key):
+        data, lock = self._shard(key)
+        with lock:
+            entry = data.pop(key, None)
+        if entry is None or entry[1] <= time.time():
+            return None
+        return entry[0]
+
+    def purge_expired(self):
+        removed = 0
+        now = time.time()
+        for data, lock in self._shards:
+            with lock:
+                expired = [key for key, (_, expires_at) in data.items() if expires_at <= now]
+                for key in expired:
+                    del data[key]
+            removed += len(expired)
+        return removed
+
+    def __len__(self):
+        return sum(len(data) for data, _ in self._shards)
+
+class MemorySessionStore(SessionStore):
+    # Process-local; use the redis backend when several workers must share sessions
+
+    def __init__(self, shards=16):
+        self._sessions = _ShardedTtlDict(shards)
+
+    def add(self, token, user_id, ttl):
+        self._sessions.set(token, user_id, ttl)
+
+    def delete(self, token):
+        self._sessions.pop(token)
+
+    def purge_expired(self):
+        return self._sessions.purge_expired()
+
+class MemoryOtpStore(OtpStore):
+
+    def __init__(self, shards=16):
+        self._codes = _ShardedTtlDict(shards)
+
+    def add(self, email, code, ttl):
+        self._codes.set((email, code), True, ttl)
+
+    def consume(self, email, code):
+        return self._codes.pop((email, code)) is not None
+
+    def purge_expired(self):
+        return self._codes.purge_expired()
+
+class RedisSessionStore(SessionStore):
+    # Expiry is handled by Redis key TTLs
+
+    def __init__(self, client, prefix='finguard:'):
+        self._redis = client
+        self._prefix = prefix + 'session:'
+
+    def add(self, token, user_id, ttl):
+        self._redis.set(self._prefix + token, user_id, ex=ttl)
+
+    def delete(self, token):
+        self._redis.delete(self._prefix + token)
+
+class RedisOtpStore(OtpStore):
+
+    def __init__(self, client, prefix='finguard:'):
+        self._redis = client
+        self._prefix = prefix + 'otp:'
+
+    def add(self, email, code, ttl):
+        self._redis.set(f"{self._prefix}{email}:{code}", 1, ex=ttl)
+
+    def consume(self, email, code):
+        # DEL is atomic, so only one concurrent verify can win a given code
+        return self._redis.delete(f"{self._prefix}{email}:{code}") == 1
+
+def _redis_client():
+    import redis
+    return redis.Redis.from_url(app.config['REDIS_URL'])
+
+_stores = {}
+_stores_lock = Lock()
+
+def _build_stores(backend):
+    if backend == 'sqlite':
+        return SqliteSessionStore(), SqliteOtpStore()
+    if backend == 'memory':
+        shards = app.config['MEMORY_STORE_SHARDS']
+        return MemorySessionStore(shards), MemoryOtpStore(shards)
+    if backend == 'redis':
+        client = _redis_client()
+        prefix = app.config['REDIS_KEY_PREFIX']
+        return RedisSessionStore(client, prefix), RedisOtpStore(client, prefix)
+    raise ValueError(f"Unknown SESSION_BACKEND: {backend}")
+
+def _get_stores():
+    backend = app.config['SESSION_BACKEND']
+    stores = _stores.get(backend)
+    if stores is None:
+        with _stores_lock:
+            stores = _stores.get(backend)
+            if stores is None:
+                stores = _stores[backend] = _build_stores(backend)
+    return stores
+
+def get_session_store():
+    return _get_stores()[0]
+
+def get_otp_store():
+    return _get_stores()[1]
+
+# Rate limiting settings: route -> {scope: (requests, per seconds)}
+app.config['RATE_LIMIT_ENABLED'] = True
+app.config['RATE_LIMIT_BACKEND'] = os.environ.get('RATE_LIMIT_BACKEND', 'memory')   # memory or redis
+app.config['RATE_LIMIT_EVICT_SECONDS'] = 60
+app.config['RATE_LIMITS'] = {
+    'login': {'ip': (20, 60), 'email': (5, 60)},
+    'forgot_password': {'ip': (5, 300), 'email': (3, 900)},
+    'verify_otp': {'ip': (10, 60), 'email': (5, 600)},
+}
+
+RATE_LIMITED_TOTAL = metrics.counter('finguard_rate_limited_total', 'Requests rejected by the rate limiter.')
+
+class MemoryRateLimiter:
+    """Token buckets in sharded dicts, one (tokens, updated_at, full_at) tuple per key.
+
+    A bucket that would have refilled completely carries no information, so
+    evict_idle() can drop it and the next hit starts from a fresh full bucket.
+    """
+
+    def __init__(self, shards=16):
+        self._shards = [({}, Lock()) for _ in range(shards)]
+
+    def hit(self, key, limit, period):
+        """Take one token; return 0 if allowed, else seconds until one is available."""
+        rate = limit / period
+        now = time.monotonic()
+        data, lock = self._shards[hash(key) % len(self._shards)]
+        with lock:
+            entry = data.get(key)
+            tokens = limit if entry is None else min(limit, entry[0] + (now - entry[1]) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            data[key] = (tokens, now, now + (limit - tokens) / rate)
+        return 0 if allowed else (1 - tokens) / rate
+
+    def evict_idle(self):
+        removed = 0
+        now = time.monotonic()
+        for data, lock in self._shards:
+            with lock:
+                idle = [key for key, (_, _, full_at) in data.items() if full_at <= now]
+                for key in idle:
+                    del data[key]
+            removed += len(idle)
+        return removed
+
+    def __len__(self):
+        return sum(len(data) for data, _ in self._shards)
+
+class RedisRateLimiter:
+    """Fixed-window counters shared by every process pointed at the same Redis."""
+
+    def __init__(self, client, prefix='finguard:'):
+        self._redis = client
+        self._prefix = prefix + 'ratelimit:'
+
+    def hit(self, key, limit, period):
+        now = time.time()
+        window = int(now // period)
+        redis_key = f"{self._prefix}{key}:{window}"
+        pipe = self._redis.pipeline()
+        pipe.incr(redis_key)
+        pipe.expire(redis_key, int(period) + 1)
+        count = pipe.execute()[0]
+        if count <= limit:
+            return 0
+        return (window + 1) * period - now
+
+    def evict_idle(self):
+        return 0
+
+_rate_limiter = None
+_rate_limiter_lock = Lock()
+
+def get_rate_limiter():
+    global _rate_limiter
+    if _rate_limiter is None:
+        with _rate_limiter_lock:
+            if _rate_limiter is None:
+                if app.config['RATE_LIMIT_BACKEND'] == 'redis':
+                    _rate_limiter = RedisRateLimiter(_redis_client(), app.config['REDIS_KEY_PREFIX'])
+                else:
+                    _rate_limiter = MemoryRateLimiter()
+    return _rate_limiter
+
+def evict_rate_limits():
+    try:
+        get_rate_limiter().evict_idle()
+    except Exception as e:
+        print(f"Error evicting rate limit buckets: {e}")
+        ERRORS_TOTAL.inc(component='rate_limiter')
+
+# Throttle a route by client IP and by the email in its JSON body, using the
+# limits in app.config['RATE_LIMITS'][name]. Runs before the view, so rejected
+# requests never reach the database or the hashing pool.
+def rate_limited(name):
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if not app.config['RATE_LIMIT_ENABLED']:
+                return f(*args, **kwargs)
+            
+            limits = app.config['RATE_LIMITS'].get(name, {})
+            data = request.get_json(silent=True) or {}
+            email = data.get('email') if isinstance(data, dict) else None
+            keys = {
+                'ip': request.remote_addr or 'unknown',
+                'email': email.strip().lower() if isinstance(email, str) and email.strip() else None,
+            }
+            
+            limiter = get_rate_limiter()
+            for scope, (limit, period) in limits.items():
+                if keys.get(scope) is None:
+                    continue
+                retry_after = limiter.hit(f"{name}:{scope}:{keys[scope]}", limit, period)
+                if retry_after:
+                    RATE_LIMITED_TOTAL.inc(route=name, scope=scope)
+                    audit('rate_limited', email=keys['email'], route=name, scope=scope)
+                    response = jsonify({'success': False, 'message': 'Too many requests, please try again later'})
+                    response.status_code = 429
+                    response.headers['Retry-After'] = str(max(1, int(math.ceil(retry_after))))
+                    return response
+            
+            return f(*args, **kwargs)
+        
+        return decorated
+    
+    return decorator
+
+# Security audit log settings
+app.config['AUDIT_ENABLED'] = True
+app.config['AUDIT_BUFFER_SIZE'] = 100000     # events held in memory; the oldest are dropped beyond this
+app.config['AUDIT_FLUSH_INTERVAL'] = 1.0     # seconds between writer flushes
+app.config['AUDIT_BATCH_SIZE'] = 5000        # events per write transaction
+app.config['AUDIT_RETENTION_MONTHS'] = 0     # monthly partitions kept by the reaper; 0 keeps all
+
+AUDIT_EVENTS_TOTAL = metrics.counter('finguard_audit_events_total', 'Security audit events recorded, by event.')
+AUDIT_DROPPED_TOTAL = metrics.counter('finguard_audit_dropped_total', 'Audit events dropped because the buffer was full.')
+
+AUDIT_COLUMNS = "id, created_at, event, user_id, email, ip, user_agent, detail"
+
+def audit_partition(created_at):
+    """Monthly (UTC) partition table an event timestamp belongs to."""
+    return 'audit_events_' + datetime.datetime.fromtimestamp(created_at, datetime.timezone.utc).strftime('%Y%m')
+
+class AuditLog:
+    """Append-only security event trail with buffered, batched writes.
+
+    record() only appends a tuple to a bounded deque, so a request pays
+    microseconds rather than a synchronous INSERT. A writer thread drains the
+    buffer every AUDIT_FLUSH_INTERVAL and inserts each batch with one
+    executemany into monthly tables (audit_events_YYYYMM), which triggers make
+    append-only. Old months are dropped whole, never deleted row by row.
+    """
+
+    def __init__(self):
+        self._buffer = deque(maxlen=app.config['AUDIT_BUFFER_SIZE'])
+        self._wakeup = Event()
+        self._stopping = Event()
+        self._thread = None
+        self._partitions = set()
+        self._stats_lock = Lock()
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = Thread(target=self._run, name='audit-writer', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    def reset_after_fork(self):
+        # Events buffered in the parent were never this worker's to write
+        self._buffer = deque(maxlen=app.config['AUDIT_BUFFER_SIZE'])
+        self._wakeup = Event()
+        self._stopping = Event()
+        self._stats_lock = Lock()
+        self._thread = None
+
+    def record(self, event, user_id=None, email=None, ip=None, user_agent=None, detail=None):
+        buffer = self._buffer
+        if len(buffer) == buffer.maxlen:
+            self._count_dropped(1)
+        buffer.append((time.time(), event, user_id, email, ip, user_agent, detail))
+        if len(buffer) >= app.config['AUDIT_BATCH_SIZE']:
+            self._wakeup.set()
+
+    def _count_dropped(self, count):
+        with self._stats_lock:
+            self.dropped += count
+        AUDIT_DROPPED_TOTAL.inc(count)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(app.config['AUDIT_FLUSH_INTERVAL'])
+            self._wakeup.clear()
+            self.flush()
+
+    def _ensure_partition(self, conn, table):
+        if table in self._partitions:
+            return
+        conn.execute(f'''CREATE TABLE IF NOT EXISTS {table}
+                        (id INTEGER PRIMARY KEY,
+                         created_at REAL NOT NULL,
+                         event TEXT NOT NULL,
+                         user_id TEXT,
+                         email TEXT,
+                         ip TEXT,
+                         user_agent TEXT,
+                         detail TEXT)''')
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_user ON {table} (user_id, created_at)")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_email ON {table} (email, created_at)")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_created ON {table} (created_at)")
+        for action in ('UPDATE', 'DELETE'):
+            conn.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_{table}_no_{action.lower()}
+                             BEFORE {action} ON {table}
+                             BEGIN SELECT RAISE(ABORT, 'audit log is append-only'); END""")
+        self._partitions.add(table)
+
+    def flush(self):
+        """Write everything buffered so far, AUDIT_BATCH_SIZE events per transaction."""
+        buffer = self._buffer
+        while buffer:
+            batch = []
+            try:
+                for _ in range(app.config['AUDIT_BATCH_SIZE']):
+                    batch.append(buffer.popleft())
+            except IndexError:
+                pass
+            
+            by_table = {}
+            for created_at, event, user_id, email, ip, user_agent, detail in batch:
+                by_table.setdefault(audit_partition(created_at), []).append(
+                    (created_at, event, user_id, email, ip, user_agent,
+                     json.dumps(detail, separators=(',', ':')) if detail else None))
+            try:
+                with get_db(write=True) as conn:
+                    for table, rows in by_table.items():
+                        self._ensure_partition(conn, table)
+                        conn.executemany(f"""INSERT INTO {table}
+                                             (created_at, event, user_id, email, ip, user_agent, detail)
+                                             VALUES (?, ?, ?, ?, ?, ?, ?)""", rows)
+            except Exception as e:
+                # Put the batch back for the next flush, oldest first. Events
+                # recorded meanwhile may have filled the buffer; as in record(),
+                # the oldest are the ones dropped.
+                print(f"Error writing audit events: {e}")
+                ERRORS_TOTAL.inc(component='audit_log')
+                self._partitions.clear()
+                room = max(0, buffer.maxlen - len(buffer))
+                if room < len(batch):
+                    self._count_dropped(len(batch) - room)
+                    batch = batch[len(batch) - room:]
+                buffer.extendleft(reversed(batch))
+                return
+            
+            for _, event, *_ in batch:
+                AUDIT_EVENTS_TOTAL.inc(event=event)
+            with self._stats_lock:
+                self.written += len(batch)
+                self.batches += 1
+
+    def partitions(self, conn):
+        rows = conn.execute("""SELECT name FROM sqlite_master
+                               WHERE type='table' AND name GLOB 'audit_events_[0-9]*'
+                               ORDER BY name DESC""").fetchall()
+        return [row[0] for row in rows]
+
+    def query(self, user_id=None, email=None, since=None, until=None, limit=100):
+        """Newest-first events, optionally for one user or email and a [since, until) range.
+
+        Only the monthly partitions overlapping the range are read, newest
+        first, each through its (user_id|email, created_at) or created_at
+        index, stopping once `limit` events are found.
+        """
+        since = since or 0
+        until = until or 2 ** 62
+        first, last = audit_partition(since), audit_partition(min(until, 253402300799))
+        events = []
+        with get_db() as conn:
+            for table in self.partitions(conn):
+                if table > last or table < first:
+                    continue
+                where, params = "created_at >= ? AND created_at < ?", [since, until]
+                if user_id is not None:
+                    where, params = "user_id = ? AND " + where, [user_id] + params
+                elif email is not None:
+                    where, params = "email = ? AND " + where, [email] + params
+                rows = conn.execute(f"""SELECT {AUDIT_COLUMNS} FROM {table} WHERE {where}
+                                        ORDER BY created_at DESC, id DESC LIMIT ?""",
+                                    params + [limit - len(events)]).fetchall()
+                events.extend(rows)
+                if len(events) >= limit:
+                    break
+        return events
+
+    def drop_expired_partitions(self, months):
+        """Drop whole months older than the newest `months` (the current month included)."""
+        if not months:
+            return []
+        now = datetime.datetime.now(datetime.timezone.utc)
+        month_index = now.year * 12 + now.month - 1 - (months - 1)
+        cutoff = f"audit_events_{month_index // 12:04d}{month_index % 12 + 1:02d}"
+        with get_db(write=True) as conn:
+            expired = [table for table in self.partitions(conn) if table < cutoff]
+            for table in expired:
+                conn.execute(f"DROP TABLE {table}")
+        self._partitions.difference_update(expired)
+        return expired
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'buffered': len(self._buffer),
+                'written': self.written,
+                'dropped': self.dropped,
+                'batches': self.batches,
+            }
+
+audit_log = AuditLog()
+
+# Record a security event from a request handler; costs one deque append
+def audit(event, user_id=None, email=None, **detail):
+    if not app.config['AUDIT_ENABLED']:
+        return
+    user_agent = request.headers.get('User-Agent')
+    audit_log.record(event, user_id, email, request.remote_addr,
+                     user_agent[:200] if user_agent else None, detail or None)
+
+def serialize_audit_event(row):
+    return {
+        'id': row['id'],
+        'at': datetime.datetime.fromtimestamp(row['created_at'], datetime.timezone.utc).isoformat(),
+        'event': row['event'],
+        'userId': row['user_id'],
+        'email': row['email'],
+        'ip': row['ip'],
+        'userAgent': row['user_agent'],
+        'detail': json.loads(row['detail']) if row['detail'] else None,
+    }
+
+# Expired-row reaper settings
+app.config['REAPER_INTERVAL_MINUTES'] = 5
+app.config['REAPER_BATCH_SIZE'] = 500     # rows deleted per write transaction
+app.config['REAPER_BATCH_PAUSE'] = 0.01   # seconds to yield the writer between batches
+app.config['REAPER_TIME_BUDGET'] = 2.0    # seconds per run; leftovers wait for the next run
+app.config['REAPER_VACUUM_PAGES'] = 256   # free pages released per run via incremental_vacuum
+app.config['OUTBOX_RETENTION'] = 24 * 3600  # seconds to keep sent/failed outbox rows
+
+# (table, WHERE clause, parameter builder); every clause is served by an index
+REAPER_TARGETS = [
+    ('password_reset_tokens', "expires_at < ?", lambda now: (now,)),
+    ('sessions', "expires_at < ?", lambda now: (now,)),
+    ('revoked_tokens', "expires_at < ?", lambda now: (now,)),
+    ('email_outbox', "status IN ('sent', 'failed') AND created_at < ?",
+     lambda now: (now - app.config['OUTBOX_RETENTION'],)),
+]
+
+reaper_stats = {
+    'runs': 0,
+    'rows_deleted': 0,
+    'last_run': None,
+}
+_reaper_stats_lock = Lock()
+
+def get_reaper_stats():
+    with _reaper_stats_lock:
+        return dict(reaper_stats)
+
+# Clean up expired tokens (run this periodically). Deletes in small rowid
+# batches, each in its own short write transaction, so live requests only ever
+# wait for one batch rather than the whole purge.
+def cleanup_expired_tokens():
+    started = time.perf_counter()
+    deadline = started + app.config['REAPER_TIME_BUDGET']
+    batch_size = app.config['REAPER_BATCH_SIZE']
+    deleted = {}
+    batches = 0
+    finished = True
+    try:
+        now = epoch_now()
+        # Every database has every table; the ones a file does not use are empty
+        databases = shard_router.databases()
+        for database in databases:
+            for table, where, params in REAPER_TARGETS:
+                deleted.setdefault(table, 0)
+                while True:
+                    if time.perf_counter() >= deadline:
+                        finished = False
+                        break
+                    with get_db(write=True, database=database) as conn:
+                        c = conn.cursor()
+                        c.execute(f"""DELETE FROM {table} WHERE rowid IN
+                                      (SELECT rowid FROM {table} WHERE {where} LIMIT ?)""",
+                                  params(now) + (batch_size,))
+                        count = c.rowcount
+                    batches += 1
+                    deleted[table] += count
+                    if count < batch_size:
+                        break
+                    time.sleep(app.config['REAPER_BATCH_PAUSE'])
+                if not finished:
+                    break
+            if not finished:
+                break
+        
+        # Backends without native expiry sweep their own expired entries
+        deleted['session_store'] = get_session_store().purge_expired()
+        deleted['otp_store'] = get_otp_store().purge_expired()
+        
+        # Audit history is retired a month at a time
+        deleted['audit_partitions'] = len(audit_log.drop_expired_partitions(app.config['AUDIT_RETENTION_MONTHS']))
+        
+        if finished:
+            for database in databases:
+                with get_db(write=True, database=database) as conn:
+                    conn.execute(f"PRAGMA incremental_vacuum({int(app.config['REAPER_VACUUM_PAGES'])})")
+        
+        print(f"Expired tokens cleaned up successfully: {deleted}")
+    except Exception as e:
+        print(f"Error cleaning up expired tokens: {e}")
+        ERRORS_TOTAL.inc(component='reaper')
+    
+    run = {
+        'finished_at': epoch_now(),
+        'duration_seconds': time.perf_counter() - started,
+        'batches': batches,
+        'deleted': deleted,
+        'completed': finished,
+    }
+    with _reaper_stats_lock:
+        reaper_stats['runs'] += 1
+        reaper_stats['rows_deleted'] += sum(deleted.values())
+        reaper_stats['last_run'] = run
+    return run
+
+# Routes
+@app.route('/api/login', methods=['POST'])
+@rate_limited('login')
+def login():
+    try:
+        data = request.get_json()
+        email = data.get('email')
+        password = data.get('password')
+        
+        if not email or not password:
+            return jsonify({'success': False, 'message': 'Email and password are required'}), 400
+            
+        user = None
+        user_id = lookup_user_id(email)
+        if user_id:
+            with get_db(user_id=user_id) as conn:
+                c = conn.cursor()
+                c.execute("SELECT * FROM users WHERE id=?", (user_id,))
+                user = c.fetchone()
+        
+        if not user:
+            audit('login_failure', email=email, reason='unknown_email')
+            return jsonify({'success': False, 'message': 'Invalid email or password'}), 401
+            
+        # Verify password
+        if check_password(password, user['password']):
+            token = generate_token(user['id'])
+            
+            # Store session
+            get_session_store().add(token, user['id'], app.config['TOKEN_TTL_SECONDS'])
+            audit('login_success', user['id'], email)
             
             return jsonify({
                 'success': True,
@@ -225,11 +2470,30 @@ def login():
                 }
             })
         else:
+            audit('login_failure', user['id'], email, reason='bad_password')
             return jsonify({'success': False, 'message': 'Invalid email or password'}), 401
             
+    except HashingBusy:
+        return hashing_busy_response()
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
+# Password rules for new accounts, shared by signup and bulk provisioning:
+# returns why the password is rejected, or None
+def password_error(password):
+    if len(password) < 12:
+        return 'Password must be at least 12 characters'
+    
+    # Check for uppercase, lowercase, number, and special character
+    has_upper = any(c.isupper() for c in password)
+    has_lower = any(c.islower() for c in password)
+    has_digit = any(c.isdigit() for c in password)
+    has_special = any(not c.isalnum() for c in password)
+    
+    if not (has_upper and has_lower and has_digit and has_special):
+        return 'Password does not meet complexity requirements'
+    return None
+
 @app.route('/api/signup', methods=['POST'])
 def signup():
     try:
@@ -242,52 +2506,30 @@ def signup():
             return jsonify({'success': False, 'message': 'All fields are required'}), 400
             
         # Validate password strength
-        if len(password) < 12:
-            return jsonify({'success': False, 'message': 'Password must be at least 12 characters'}), 400
-            
-        # Check for uppercase, lowercase, number, and special character
-        has_upper = any(c.isupper() for c in password)
-        has_lower = any(c.islower() for c in password)
-        has_digit = any(c.isdigit() for c in password)
-        has_special = any(not c.isalnum() for c in password)
-        
-        if not (has_upper and has_lower and has_digit and has_special):
-            return jsonify({'success': False, 'message': 'Password does not meet complexity requirements'}), 400
+        message = password_error(password)
+        if message:
+            return jsonify({'success': False, 'message': message}), 400
 
         # Check if user already exists
-        with db_lock:
-            conn = get_db()
-            c = conn.cursor()
-            c.execute("SELECT * FROM users WHERE email=?", (email,))
-            existing_user = c.fetchone()
-            
-            if existing_user:
-                conn.close()
-                return jsonify({'success': False, 'message': 'User already exists with this email'}), 409
-                
-            # Hash password
-            hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-            
-            # Create user
-            user_id = str(uuid.uuid4())
+        if lookup_user_id(email):
+            return jsonify({'success': False, 'message': 'User already exists with this email'}), 409
             
-            c.execute("INSERT INTO users (id, name, email, password) VALUES (?, ?, ?, ?)",
-                     (user_id, name, email, hashed_password))
-            
-            conn.commit()
-            conn.close()
+        # Hash password outside of any database lock
+        hashed_password = hash_password(password)
+        
+        # Create user; the directory's key catches a concurrent signup for the same email
+        user_id = str(uuid.uuid4())
+        
+        try:
+            create_user(user_id, name, email, hashed_password)
+        except sqlite3.IntegrityError:
+            return jsonify({'success': False, 'message': 'User already exists with this email'}), 409
         
         token = generate_token(user_id)
         
         # Store session
-        with db_lock:
-            conn = get_db()
-            c = conn.cursor()
-            expires_at = (datetime.datetime.now() + datetime.timedelta(hours=24)).strftime('%Y-%m-%d %H:%M:%S')
-            c.execute("INSERT INTO sessions (user_id, token, expires_at) VALUES (?, ?, ?)",
-                     (user_id, token, expires_at))
-            conn.commit()
-            conn.close()
+        get_session_store().add(token, user_id, app.config['TOKEN_TTL_SECONDS'])
+        audit('signup', user_id, email)
         
         return jsonify({
             'success': True,
@@ -301,6 +2543,8 @@ def signup():
             }
         }), 201
         
+    except HashingBusy:
+        return hashing_busy_response()
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
@@ -316,35 +2560,27 @@ def social_login(provider):
         email = f"user_{user_id[:8]}@{provider}.com"
         
         # Check if user already exists
-        with db_lock:
-            conn = get_db()
-            c = conn.cursor()
-            c.execute("SELECT * FROM users WHERE email=?", (email,))
-            user = c.fetchone()
-            
-            if not user:
-                # Create a new user for social login (no password)
-                c.execute("INSERT INTO users (id, name, email, password) VALUES (?, ?, ?, ?)",
-                         (user_id, name, email, ''))
-                conn.commit()
-            else:
-                user_id = user['id']
-                name = user['name']
-                email = user['email']
-            
-            conn.close()
+        existing_id = lookup_user_id(email)
+        user = None
+        if existing_id:
+            with get_db(user_id=existing_id) as conn:
+                c = conn.cursor()
+                c.execute("SELECT * FROM users WHERE id=?", (existing_id,))
+                user = c.fetchone()
+        
+        if not user:
+            # Create a new user for social login (no password)
+            create_user(user_id, name, email, '')
+        else:
+            user_id = user['id']
+            name = user['name']
+            email = user['email']
         
         token = generate_token(user_id)
         
         # Store session
-        with db_lock:
-            conn = get_db()
-            c = conn.cursor()
-            expires_at = (datetime.datetime.now() + datetime.timedelta(hours=24)).strftime('%Y-%m-%d %H:%M:%S')
-            c.execute("INSERT INTO sessions (user_id, token, expires_at) VALUES (?, ?, ?)",
-                     (user_id, token, expires_at))
-            conn.commit()
-            conn.close()
+        get_session_store().add(token, user_id, app.config['TOKEN_TTL_SECONDS'])
+        audit('login_success', user_id, email, provider=provider)
         
         return jsonify({
             'success': True,
@@ -363,6 +2599,7 @@ def social_login(provider):
         return jsonify({'success': False, 'message': str(e)}), 500
 
 @app.route('/api/forgot-password', methods=['POST'])
+@rate_limited('forgot_password')
 def forgot_password():
     try:
         data = request.get_json()
@@ -372,44 +2609,34 @@ def forgot_password():
             return jsonify({'success': False, 'message': 'Valid email is required'}), 400
             
         # Check if user exists
-        with db_lock:
-            conn = get_db()
-            c = conn.cursor()
-            c.execute("SELECT * FROM users WHERE email=?", (email,))
-            user = c.fetchone()
-            
-            if not user:
-                # For security reasons, don't reveal if the email exists or not
-                conn.close()
-                return jsonify({
-                    'success': True,
-                    'data': {
-                        'message': 'If this email is registered, you will receive a verification code'
-                    }
-                })
-            
-            # Generate OTP
-            otp = str(uuid.uuid4())[:6].upper()
-            expires_at = (datetime.datetime.now() + datetime.timedelta(minutes=10)).strftime('%Y-%m-%d %H:%M:%S')
-            
-            # Store OTP in database
-            c.execute("INSERT INTO password_reset_tokens (email, token, expires_at) VALUES (?, ?, ?)",
-                     (email, otp, expires_at))
+        user_id = lookup_user_id(email)
             
-            conn.commit()
-            conn.close()
+        if not user_id:
+            # For security reasons, don't reveal if the email exists or not
+            audit('otp_unknown_email', email=email)
+            return jsonify({
+                'success': True,
+                'data': {
+                    'message': 'If this email is registered, you will receive a verification code'
+                }
+            })
         
-        # Send OTP via email
-        email_sent = send_otp_email(email, otp)
+        # Generate and store OTP
+        otp = str(uuid.uuid4())[:6].upper()
+        get_otp_store().add(email, otp, app.config['OTP_TTL_SECONDS'])
         
-        if not email_sent:
-            return jsonify({'success': False, 'message': 'Failed to send verification email'}), 500
+        # Queue the OTP email; the dispatcher sends it
+        with get_db(write=True) as conn:
+            enqueue_email(conn, email, OTP_EMAIL_SUBJECT, render_otp_email(otp))
+        
+        mail_dispatcher.notify()
+        audit('otp_issued', user_id, email)
         
         return jsonify({
             'success': True,
             'data': {
                 'message': 'Verification code sent to your email',
-                'expiresIn': 600
+                'expiresIn': app.config['OTP_TTL_SECONDS']
             }
         })
         
@@ -417,6 +2644,7 @@ def forgot_password():
         return jsonify({'success': False, 'message': str(e)}), 500
 
 @app.route('/api/verify-otp', methods=['POST'])
+@rate_limited('verify_otp')
 def verify_otp():
     try:
         data = request.get_json()
@@ -426,24 +2654,10 @@ def verify_otp():
         if not otp or len(otp) != 6:
             return jsonify({'success': False, 'message': 'Valid OTP is required'}), 400
             
-        with db_lock:
-            conn = get_db()
-            c = conn.cursor()
-            
-            # Check if OTP is valid and not expired
-            now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            c.execute("SELECT * FROM password_reset_tokens WHERE email=? AND token=? AND expires_at > ? AND used=0",
-                     (email, otp, now))
-            token_data = c.fetchone()
-            
-            if not token_data:
-                conn.close()
-                return jsonify({'success': False, 'message': 'Invalid or expired OTP'}), 400
-                
-            # Mark OTP as used
-            c.execute("UPDATE password_reset_tokens SET used=1 WHERE id=?", (token_data['id'],))
-            conn.commit()
-            conn.close()
+        # Check that the OTP is valid and unexpired, and mark it used
+        if not get_otp_store().consume(email, otp):
+            audit('otp_failed', email=email)
+            return jsonify({'success': False, 'message': 'Invalid or expired OTP'}), 400
         
         # Generate a temporary token for password reset
         temp_token = jwt.encode(
@@ -451,6 +2665,7 @@ def verify_otp():
             app.config['SECRET_KEY'],
             algorithm="HS256"
         )
+        audit('otp_verified', email=email)
         
         return jsonify({
             'success': True,
@@ -489,25 +2704,30 @@ def reset_password():
                 return jsonify({'success': False, 'message': 'Invalid token'}), 400
                 
         except jwt.ExpiredSignatureError:
+            audit('password_reset_failed', reason='expired_token')
             return jsonify({'success': False, 'message': 'Token has expired'}), 400
         except jwt.InvalidTokenError:
+            audit('password_reset_failed', reason='invalid_token')
             return jsonify({'success': False, 'message': 'Invalid token'}), 400
             
         # Hash new password
-        hashed_password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        hashed_password = hash_password(new_password)
         
         # Update password
-        with db_lock:
-            conn = get_db()
+        user_id = lookup_user_id(email)
+        if not user_id:
+            return jsonify({'success': False, 'message': 'User not found'}), 404
+        
+        with get_db(write=True, user_id=user_id) as conn:
             c = conn.cursor()
-            c.execute("UPDATE users SET password=? WHERE email=?", (hashed_password, email))
-            
-            if c.rowcount == 0:
-                conn.close()
+            c.execute("UPDATE users SET password=? WHERE id=?", (hashed_password, user_id))
+            if not c.rowcount:
                 return jsonify({'success': False, 'message': 'User not found'}), 404
-                
-            conn.commit()
-            conn.close()
+            bump_user_version(conn, [user_id])
+        
+        # Drop any cached sessions that were authenticated with the old password
+        invalidate_cached_users([user_id])
+        audit('password_reset', user_id, email)
         
         return jsonify({
             'success': True,
@@ -516,11 +2736,14 @@ def reset_password():
             }
         })
         
+    except HashingBusy:
+        return hashing_busy_response()
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
 @app.route('/api/user', methods=['GET'])
 @token_required
+@conditional_get
 def get_user(current_user):
     try:
         return jsonify({
@@ -544,36 +2767,1953 @@ def logout(current_user):
         if token and token.startswith('Bearer '):
             token = token[7:]
             
-            with db_lock:
-                conn = get_db()
-                c = conn.cursor()
-                c.execute("DELETE FROM sessions WHERE token=?", (token,))
-                conn.commit()
-                conn.close()
+            get_session_store().delete(token)
+            
+            # Revoke the token everywhere, not just in this worker's cache
+            payload = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+            revocations.revoke(payload.get('jti'), payload['exp'])
+            get_user_cache().invalidate_token(token)
         
+        audit('logout', current_user['id'], current_user['email'])
         return jsonify({'success': True, 'message': 'Logged out successfully'})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
+# The signed-in user's own security events, newest first; events reach the
+# table within AUDIT_FLUSH_INTERVAL
+@app.route('/api/audit', methods=['GET'])
+@token_required
+def list_audit_events(current_user):
+    try:
+        try:
+            limit = max(1, min(int(request.args.get('limit', 50)), 500))
+            since = _timestamp_arg('from', None)
+            until = _timestamp_arg('to', None)
+        except ValueError:
+            return jsonify({'success': False, 'message': 'Invalid limit, from or to'}), 400
+        
+        rows = audit_log.query(user_id=current_user['id'], since=since, until=until, limit=limit)
+        return jsonify({'success': True, 'data': {'events': [serialize_audit_event(row) for row in rows]}})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.cli.command('audit-log')
+@click.option('--user', 'user_id', default=None, help='Only events for this user id.')
+@click.option('--email', default=None, help='Only events for this email address.')
+@click.option('--since', default=None, help='ISO date/datetime or epoch seconds.')
+@click.option('--until', default=None, help='ISO date/datetime or epoch seconds (exclusive).')
+@click.option('--limit', default=100, type=int)
+def audit_log_command(user_id, email, since, until, limit):
+    """Print security audit events as JSON lines, newest first."""
+    to_epoch = lambda value: int(value) if value.isdigit() else parse_timestamp(value)
+    rows = audit_log.query(user_id=user_id, email=email,
+                           since=to_epoch(since) if since else None,
+                           until=to_epoch(until) if until else None, limit=limit)
+    for row in rows:
+        print(json.dumps(serialize_audit_event(row)))
+
+# Uploads (statement imports, bulk provisioning) are parsed while they stream
+# in, never read whole
+def open_upload(stream):
+    # werkzeug hands over an unbuffered stream; buffering lets the format be
+    # sniffed with peek() and keeps reads at IMPORT_READ_SIZE
+    if isinstance(stream, io.RawIOBase):
+        return io.BufferedReader(stream, app.config['IMPORT_READ_SIZE'])
+    return stream
+
+def detect_upload_format(body, content_type, requested, content_types, sniff):
+    """Pick an upload's format: ?format=, else the Content-Type, else its first bytes.
+
+    content_types maps Content-Type fragments to the format they name, checked
+    in order; sniff gets the first bytes with any BOM and leading whitespace
+    stripped and returns a format.
+    """
+    formats = sorted(set(content_types.values()))
+    if requested:
+        requested = requested.lower()
+        if requested not in formats:
+            raise ValueError(f"format must be {' or '.join(formats)}")
+        return requested
+    content_type = (content_type or '').lower()
+    for fragment, upload_format in content_types.items():
+        if fragment in content_type:
+            return upload_format
+    head = body.peek(512)[:512] if hasattr(body, 'peek') else b''
+    return sniff(head.lstrip(b'\xef\xbb\xbf \t\r\n'))
+
+@contextmanager
+def upload_text(body):
+    """Decode a binary upload as UTF-8 text, BOM dropped and bad bytes replaced."""
+    text = io.TextIOWrapper(body, encoding='utf-8-sig', errors='replace', newline='')
+    try:
+        yield text
+    finally:
+        # Leave the request stream open for the WSGI server
+        text.detach()
+
+def csv_rows(reader):
+    """Yield (line number, row) for the non-blank rows left in a csv.reader."""
+    for row in reader:
+        if any(cell.strip() for cell in row):
+            yield reader.line_num, row
+
+def _normalize_header(name):
+    return re.sub(r'[\s_\-]', '', (name or '').lower())
+
+# Bulk provisioning settings
+app.config['ADMIN_EMAILS'] = [email.strip().lower() for email in os.environ.get('ADMIN_EMAILS', '').split(',')
+                              if email.strip()]
+app.config['PROVISION_MAX_ROWS'] = 10000       # rows accepted per admin upload; the CLI has no limit
+app.config['PROVISION_BATCH_SIZE'] = 500       # users hashed and written per batch
+app.config['PROVISION_WORKERS'] = os.cpu_count() or 1
+app.config['PROVISION_MAX_ERRORS'] = 1000      # row errors listed in the result
+
+PROVISIONED_USERS_TOTAL = metrics.counter('finguard_provisioned_users_total', 'Bulk-provisioned rows, by outcome.')
+
+# Admin-only routes: stack under @token_required. Admins are the accounts whose
+# email is listed in ADMIN_EMAILS.
+def admin_required(f):
+    @wraps(f)
+    def decorated(current_user, *args, **kwargs):
+        if current_user['email'].lower() not in app.config['ADMIN_EMAILS']:
+            return jsonify({'success': False, 'message': 'Admin access required'}), 403
+        return f(current_user, *args, **kwargs)
+    
+    return decorated
+
+def iter_provision_records(body, provision_format):
+    """Yield (line number, record) from an NDJSON or CSV upload one row at a time.
+
+    CSV needs a header row with name, email and password columns. A record
+    that cannot be read is yielded as None so it is reported, not fatal.
+    """
+    with upload_text(body) as text:
+        if provision_format == 'ndjson':
+            for number, line in enumerate(text, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                yield number, record if isinstance(record, dict) else None
+        else:
+            reader = csv.reader(text)
+            header = [_normalize_header(name) for name in next(reader, None) or []]
+            if not {'name', 'email', 'password'} <= set(header):
+                raise ValueError('CSV header needs name, email and password columns')
+            for number, row in csv_rows(reader):
+                yield number, dict(zip(header, row))
+
+def _sniff_provision(head):
+    return 'ndjson' if head.startswith(b'{') else 'csv'
+
+def detect_provision_format(body, content_type, requested=None):
+    return detect_upload_format(body, content_type, requested, {'json': 'ndjson', 'csv': 'csv'}, _sniff_provision)
+
+def _reject_provision_row(result, line, email, message):
+    result['failed'] += 1
+    PROVISIONED_USERS_TOTAL.inc(outcome='failed')
+    if len(result['errors']) < app.config['PROVISION_MAX_ERRORS']:
+        result['errors'].append({'line': line, 'email': email, 'message': message})
+
+def _provision_batch(executor, batch, result, audit_source):
+    """Hash and create one batch of validated (line, user_id, name, email, password) rows."""
+    reject = partial(_reject_provision_row, result)
+    
+    # Registered emails are dropped before paying for their hashes
+    with get_db() as conn:
+        taken = {row[0] for row in conn.execute(
+            f"SELECT email FROM user_directory WHERE email IN ({','.join('?' * len(batch))})",
+            [row[3] for row in batch])}
+    for line, _, _, email, _ in batch:
+        if email in taken:
+            reject(line, email, 'User already exists with this email')
+    batch = [row for row in batch if row[3] not in taken]
+    if not batch:
+        return
+    
+    rounds = app.config['BCRYPT_ROUNDS']
+    chunksize = max(1, len(batch) // (4 * app.config['PROVISION_WORKERS']))
+    hashes = list(executor.map(_hash_password, [row[4] for row in batch], [rounds] * len(batch),
+                               chunksize=chunksize))
+    
+    # Claim the emails in one directory transaction; a concurrent signup may
+    # have taken one since the check above
+    with get_db(write=True) as conn:
+        conn.executemany("INSERT OR IGNORE INTO user_directory (email, user_id) VALUES (?, ?)",
+                         [(email, user_id) for _, user_id, _, email, _ in batch])
+        owners = dict(conn.execute(
+            f"SELECT email, user_id FROM user_directory WHERE email IN ({','.join('?' * len(batch))})",
+            [row[3] for row in batch]).fetchall())
+    claimed = []
+    for row, hashed in zip(batch, hashes):
+        line, user_id, name, email, _ = row
+        if owners.get(email) == user_id:
+            claimed.append((line, user_id, name, email, hashed))
+        else:
+            reject(line, email, 'User already exists with this email')
+    
+    shards = {}
+    for row in claimed:
+        shards.setdefault(shard_router.database(row[1]), []).append(row)
+    now = epoch_now()
+    for database, rows in shards.items():
+        try:
+            with get_db(write=True, database=database) as conn:
+                conn.executemany("INSERT INTO users (id, name, email, password, updated_at) VALUES (?, ?, ?, ?, ?)",
+                                 [(user_id, name, email, hashed, now) for _, user_id, name, email, hashed in rows])
+        except sqlite3.Error as e:
+            with get_db(write=True) as conn:
+                conn.executemany("DELETE FROM user_directory WHERE email=? AND user_id=?",
+                                 [(email, user_id) for _, user_id, _, email, _ in rows])
+            for line, _, _, email, _ in rows:
+                reject(line, email, str(e))
+            continue
+        result['created'] += len(rows)
+        PROVISIONED_USERS_TOTAL.inc(len(rows), outcome='created')
+        if app.config['AUDIT_ENABLED']:
+            ip, user_agent, actor = audit_source
+            for _, user_id, _, email, _ in rows:
+                audit_log.record('user_provisioned', user_id, email, ip, user_agent, {'by': actor} if actor else None)
+
+def provision_users(records, max_rows=None, audit_source=(None, None, None)):
+    """Create accounts from (line, {name, email, password}) records.
+
+    Rows are checked with the same rules as signup. A bad row, or an email
+    that is already registered, is reported in the result and skipped; it
+    never fails the rest. Valid rows are hashed PROVISION_BATCH_SIZE at a
+    time across PROVISION_WORKERS processes and written with one
+    executemany per shard. No sessions are created. audit_source is
+    (ip, user agent, actor) for the audit events.
+    """
+    result = {'rows': 0, 'created': 0, 'failed': 0, 'errors': [], 'truncated': False}
+    batch_size = app.config['PROVISION_BATCH_SIZE']
+    seen = set()
+    batch = []
+    reject = partial(_reject_provision_row, result)
+    
+    with ProcessPoolExecutor(max_workers=app.config['PROVISION_WORKERS']) as executor:
+        for line, record in records:
+            if max_rows is not None and result['rows'] >= max_rows:
+                result['truncated'] = True
+                break
+            result['rows'] += 1
+            if record is None:
+                reject(line, None, 'Row is not a valid record')
+                continue
+            name, email, password = (record.get(field) for field in ('name', 'email', 'password'))
+            if not all(isinstance(value, str) for value in (name, email, password)):
+                reject(line, email if isinstance(email, str) else None, 'All fields are required')
+                continue
+            name, email = name.strip(), email.strip()
+            if not name or not email or not password:
+                reject(line, email or None, 'All fields are required')
+                continue
+            if '@' not in email:
+                reject(line, email, 'Valid email is required')
+                continue
+            message = password_error(password)
+            if message:
+                reject(line, email, message)
+                continue
+            if email in seen:
+                reject(line, email, 'Email appears earlier in this upload')
+                continue
+            seen.add(email)
+            batch.append((line, str(uuid.uuid4()), name, email, password))
+            if len(batch) >= batch_size:
+                _provision_batch(executor, batch, result, audit_source)
+                batch = []
+        if batch:
+            _provision_batch(executor, batch, result, audit_source)
+    result['errors'].sort(key=lambda error: error['line'])
+    return result
+
+# Create many accounts from an NDJSON or CSV body of name, email and password
+# (Content-Type application/x-ndjson or text/csv, or ?format=). Answers with
+# per-row errors; at most PROVISION_MAX_ROWS rows are read.
+@app.route('/api/admin/users/bulk', methods=['POST'])
+@token_required
+@admin_required
+def bulk_provision_users(current_user):
+    try:
+        body = open_upload(request.stream)
+        try:
+            provision_format = detect_provision_format(body, request.content_type, request.args.get('format'))
+            user_agent = request.headers.get('User-Agent')
+            result = provision_users(iter_provision_records(body, provision_format),
+                                     max_rows=app.config['PROVISION_MAX_ROWS'],
+                                     audit_source=(request.remote_addr, user_agent[:200] if user_agent else None,
+                                                   current_user['id']))
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+        
+        audit('bulk_provision', current_user['id'], current_user['email'],
+              rows=result['rows'], created=result['created'], failed=result['failed'])
+        return jsonify({'success': True, 'data': result})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.cli.command('provision-users')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'provision_format', type=click.Choice(['csv', 'ndjson']), default=None,
+              help='Input format (default: guessed from the file).')
+def provision_users_command(path, provision_format):
+    """Create accounts from an NDJSON or CSV file of name, email and password."""
+    started = time.perf_counter()
+    with open(path, 'rb') as body:
+        provision_format = detect_provision_format(body, None, provision_format)
+        result = provision_users(iter_provision_records(body, provision_format), audit_source=(None, 'cli', None))
+    audit_log.flush()
+    elapsed = time.perf_counter() - started
+    for error in result['errors']:
+        print(f"line {error['line']}: {error['email'] or '-'}: {error['message']}", file=sys.stderr)
+    print(f"{result['created']} created, {result['failed']} failed of {result['rows']} rows "
+          f"in {elapsed:.2f}s ({result['created'] / elapsed:.0f} users/s)")
+    if result['failed']:
+        raise SystemExit(1)
+
+# Transactions settings
+app.config['TRANSACTIONS_PAGE_SIZE'] = 50
+app.config['TRANSACTIONS_MAX_PAGE_SIZE'] = 500
+app.config['TRANSACTIONS_MAX_BATCH'] = 1000   # rows accepted per POST /api/transactions
+
+TRANSACTION_COLUMNS = "id, posted_at, amount_cents, currency, description, category, merchant"
+
+def parse_timestamp(value):
+    """Accept epoch seconds or an ISO 8601 date/datetime (naive means UTC)."""
+    if isinstance(value, bool):
+        raise ValueError('postedAt must be a date, datetime or epoch seconds')
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str) and value.strip():
+        parsed = datetime.datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+        return int(parsed.timestamp())
+    raise ValueError('postedAt must be a date, datetime or epoch seconds')
+
+def parse_amount_cents(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError('amount must be a number')
+    try:
+        amount = Decimal(str(value).strip())
+    except InvalidOperation:
+        raise ValueError('amount must be a number')
+    if not amount.is_finite():
+        raise ValueError('amount must be a number')
+    return int((amount * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+def parse_transaction(item):
+    """Validate one API transaction object into the ledger column values."""
+    if not isinstance(item, dict):
+        raise ValueError('Each transaction must be an object')
+    if 'postedAt' not in item or 'amount' not in item:
+        raise ValueError('postedAt and amount are required')
+    currency = str(item.get('currency') or 'USD').upper()
+    if len(currency) != 3:
+        raise ValueError('currency must be a 3-letter code')
+    return (
+        parse_timestamp(item['postedAt']),
+        parse_amount_cents(item['amount']),
+        currency,
+        str(item.get('description') or '')[:500],
+        str(item.get('category') or 'uncategorized')[:100],
+        str(item['merchant'])[:200] if item.get('merchant') else None,
+    )
+
+def insert_transactions(conn, user_id, rows):
+    """Insert parsed rows with one executemany on the caller's write connection.
+
+    The caller drops the user's cached rows with invalidate_cached_users after it commits.
+    """
+    now = epoch_now()
+    conn.executemany("""INSERT INTO transactions
+                        (user_id, posted_at, amount_cents, currency, description, category, merchant, created_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                     [(user_id,) + row + (now,) for row in rows])
+    bump_user_version(conn, [user_id])
+    return len(rows)
+
+def serialize_transaction(row):
+    return {
+        'id': row['id'],
+        'postedAt': datetime.datetime.fromtimestamp(row['posted_at'], datetime.timezone.utc).isoformat(),
+        'amount': row['amount_cents'] / 100,
+        'currency': row['currency'],
+        'description': row['description'],
+        'category': row['category'],
+        'merchant': row['merchant'],
+    }
+
+# Opaque pagination cursor: the (posted_at, id) of the last row on the page
+def encode_cursor(posted_at, row_id):
+    return base64.urlsafe_b64encode(f"{posted_at}:{row_id}".encode('ascii')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        posted_at, row_id = base64.urlsafe_b64decode(padded.encode('ascii')).decode('ascii').split(':')
+        return int(posted_at), int(row_id)
+    except (ValueError, UnicodeError):
+        raise ValueError('Invalid cursor')
+
+@app.route('/api/transactions', methods=['GET'])
+@token_required
+@conditional_get
+def list_transactions(current_user):
+    try:
+        try:
+            limit = int(request.args.get('limit', app.config['TRANSACTIONS_PAGE_SIZE']))
+        except ValueError:
+            return jsonify({'success': False, 'message': 'limit must be an integer'}), 400
+        limit = max(1, min(limit, app.config['TRANSACTIONS_MAX_PAGE_SIZE']))
+        
+        cursor = request.args.get('cursor')
+        
+        # Newest first. Seeking past the cursor's (posted_at, id) keeps each
+        # page an index range scan however deep into the history it is.
+        with get_db(user_id=current_user['id']) as conn:
+            c = conn.cursor()
+            if cursor:
+                try:
+                    posted_at, row_id = decode_cursor(cursor)
+                except ValueError as e:
+                    return jsonify({'success': False, 'message': str(e)}), 400
+                c.execute(f"""SELECT {TRANSACTION_COLUMNS} FROM transactions
+                              WHERE user_id=? AND (posted_at, id) < (?, ?)
+                              ORDER BY posted_at DESC, id DESC LIMIT ?""",
+                          (current_user['id'], posted_at, row_id, limit + 1))
+            else:
+                c.execute(f"""SELECT {TRANSACTION_COLUMNS} FROM transactions
+                              WHERE user_id=?
+                              ORDER BY posted_at DESC, id DESC LIMIT ?""",
+                          (current_user['id'], limit + 1))
+            rows = c.fetchall()
+        
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['posted_at'], rows[-1]['id']) if has_more else None
+        
+        return jsonify({
+            'success': True,
+            'data': {
+                'transactions': [serialize_transaction(row) for row in rows],
+                'nextCursor': next_cursor
+            }
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/api/transactions', methods=['POST'])
+@token_required
+def create_transactions(current_user):
+    try:
+        data = request.get_json()
+        items = data.get('transactions') if isinstance(data, dict) and 'transactions' in data else [data]
+        
+        if not isinstance(items, list) or not items:
+            return jsonify({'success': False, 'message': 'At least one transaction is required'}), 400
+        if len(items) > app.config['TRANSACTIONS_MAX_BATCH']:
+            return jsonify({'success': False, 'message': f"At most {app.config['TRANSACTIONS_MAX_BATCH']} transactions per request"}), 413
+        
+        rows = []
+        for index, item in enumerate(items):
+            try:
+                rows.append(parse_transaction(item))
+            except ValueError as e:
+                return jsonify({'success': False, 'message': f'Transaction {index}: {e}'}), 400
+        
+        # All rows commit together or not at all
+        with get_db(write=True, user_id=current_user['id']) as conn:
+            inserted = insert_transactions(conn, current_user['id'], rows)
+        invalidate_cached_users([current_user['id']])
+        
+        flagged = score_user_online(current_user['id'], min(row[0] for row in rows))
+        
+        return jsonify({
+            'success': True,
+            'data': {
+                'inserted': inserted,
+                'flagged': flagged
+            }
+        }), 201
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+# Statement import settings
+app.config['IMPORT_BATCH_SIZE'] = 2000        # rows per write transaction
+app.config['IMPORT_READ_SIZE'] = 64 * 1024    # bytes read from the upload at a time
+app.config['IMPORT_MAX_ERRORS'] = 20          # rejected-row messages kept for the response
+
+IMPORTED_ROWS_TOTAL = metrics.counter('finguard_imported_rows_total', 'Statement rows processed by import, by outcome.')
+
+# CSV header aliases, matched lowercased with spaces, underscores and dashes removed
+CSV_COLUMN_ALIASES = {
+    'postedAt': ('postedat', 'date', 'posted', 'postingdate', 'transactiondate', 'bookingdate'),
+    'amount': ('amount', 'transactionamount', 'value'),
+    'debit': ('debit', 'withdrawal', 'moneyout', 'paidout'),
+    'credit': ('credit', 'deposit', 'moneyin', 'paidin'),
+    'description': ('description', 'memo', 'details', 'narrative', 'transactiondescription'),
+    'merchant': ('merchant', 'payee', 'name', 'counterparty'),
+    'category': ('category',),
+    'currency': ('currency', 'currencycode'),
+    'reference': ('reference', 'ref', 'fitid', 'transactionid', 'id'),
+}
+
+OFX_TAG = re.compile(r'<(/?)([A-Za-z0-9.]+)>([^<]*)')
+OFX_DATE = re.compile(r'(\d{8})(\d{6})?(?:\.\d+)?(?:\[([+-]?\d+(?:\.\d+)?)(?::[^\]]*)?\])?')
+
+def _sniff_statement(head):
+    return 'ofx' if head.upper().startswith((b'OFXHEADER', b'<OFX>', b'<?XML')) else 'csv'
+
+def detect_statement_format(body, content_type, requested=None):
+    return detect_upload_format(body, content_type, requested, {'ofx': 'ofx', 'csv': 'csv'}, _sniff_statement)
+
+def parse_statement_amount(value):
+    """Bank-formatted amount ("$1,234.50", "(12.00)", "12.00-", "12.00 DR") as a Decimal."""
+    text = value.strip()
+    try:
+        # Plain numbers are the common case
+        return Decimal(text)
+    except InvalidOperation:
+        pass
+    negative = False
+    if text.startswith('(') and text.endswith(')'):
+        negative, text = True, text[1:-1]
+    if text.upper().endswith('DR'):
+        negative, text = True, text[:-2]
+    elif text.upper().endswith('CR'):
+        text = text[:-2]
+    text = text.strip()
+    if text.endswith('-'):
+        negative, text = True, text[:-1]
+    try:
+        amount = Decimal(re.sub(r'[^0-9.+-]', '', text))
+    except InvalidOperation:
+        raise ValueError('amount must be a number')
+    return -abs(amount) if negative else amount
+
+def csv_date_parser(date_format=None):
+    def parse(value):
+        value = value.strip()
+        if date_format:
+            parsed = datetime.datetime.strptime(value, date_format)
+            return int(parsed.replace(tzinfo=datetime.timezone.utc).timestamp())
+        if value.isdigit() and len(value) > 8:
+            return int(value)
+        return parse_timestamp(value)
+    return parse
+
+def parse_ofx_date(value):
+    """OFX DTPOSTED: YYYYMMDD[HHMMSS[.XXX]][[offset:TZ]], UTC when no offset."""
+    match = OFX_DATE.match(value.strip())
+    if not match:
+        raise ValueError(f'Invalid OFX date {value!r}')
+    parsed = datetime.datetime.strptime(match.group(1) + (match.group(2) or '000000'), '%Y%m%d%H%M%S')
+    offset = datetime.timedelta(hours=float(match.group(3) or 0))
+    return int(parsed.replace(tzinfo=datetime.timezone(offset)).timestamp())
+
+def parse_statement_row(raw, parse_date):
+    """Turn one CSV/OFX record of strings into ledger column values and its bank reference."""
+    item = dict(raw)
+    if not (raw.get('postedAt') or '').strip():
+        raise ValueError('date is required')
+    item['postedAt'] = parse_date(raw['postedAt'])
+    if (raw.get('amount') or '').strip():
+        item['amount'] = str(parse_statement_amount(raw['amount']))
+    elif (raw.get('debit') or '').strip() or (raw.get('credit') or '').strip():
+        credit = raw.get('credit') or ''
+        debit = raw.get('debit') or ''
+        amount = parse_statement_amount(credit) if credit.strip() else Decimal(0)
+        if debit.strip():
+            amount -= abs(parse_statement_amount(debit))
+        item['amount'] = str(amount)
+    else:
+        raise ValueError('amount is required')
+    return parse_transaction(item), (raw.get('reference') or '').strip()
+
+def statement_row_hash(row, reference):
+    return hashlib.sha256('\x1f'.join(map(str, row + (reference,))).encode('utf-8')).hexdigest()[:32]
+
+def iter_csv_statement(body):
+    """Yield (line number, record) from a CSV upload one row at a time."""
+    with upload_text(body) as text:
+        reader = csv.reader(text)
+        header = next(reader, None)
+        if not header:
+            return
+        columns = {}
+        for index, name in enumerate(header):
+            key = _normalize_header(name)
+            for field, aliases in CSV_COLUMN_ALIASES.items():
+                if key in aliases and field not in columns:
+                    columns[field] = index
+        if 'postedAt' not in columns or not columns.keys() & {'amount', 'debit', 'credit'}:
+            raise ValueError('CSV header needs a date column and an amount (or debit/credit) column')
+        for number, row in csv_rows(reader):
+            yield number, {field: row[index] for field, index in columns.items() if index < len(row)}
+
+def _ofx_tokens(body):
+    """Yield (closing, tag, text) from an OFX 1.x (SGML) or 2.x (XML) upload."""
+    read_size = app.config['IMPORT_READ_SIZE']
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    pending = ''
+    while True:
+        chunk = body.read(read_size)
+        pending += decoder.decode(chunk or b'', final=not chunk)
+        # Only scan up to the last '<', which may start a tag split across reads
+        cut = pending.rfind('<') if chunk else len(pending)
+        if cut <= 0:
+            if len(pending) > 16 * read_size:
+                raise ValueError('Not an OFX file')
+            cut = 0
+        for match in OFX_TAG.finditer(pending, 0, cut):
+            value = match.group(3).strip()
+            yield match.group(1) == '/', match.group(2).upper(), html.unescape(value) if '&' in value else value
+        pending = pending[cut:]
+        if not chunk:
+            break
+
+def iter_ofx_statement(body):
+    """Yield (transaction number, record) for each <STMTTRN> in an OFX upload."""
+    currency = ''
+    current = None
+    count = 0
+    for closing, tag, text in _ofx_tokens(body):
+        if tag == 'STMTTRN':
+            if not closing:
+                current = {}
+            elif current is not None:
+                count += 1
+                yield count, {
+                    'postedAt': current.get('DTPOSTED', ''),
+                    'amount': current.get('TRNAMT', ''),
+                    'currency': currency,
+                    'description': current.get('MEMO') or current.get('NAME', ''),
+                    'merchant': current.get('NAME', ''),
+                    'reference': current.get('FITID', ''),
+                }
+                current = None
+        elif closing or not text:
+            continue
+        elif tag == 'CURDEF':
+            currency = text
+        elif current is not None:
+            current[tag] = text
+
+def _save_import_progress(conn, import_id, counts, status='running', error=None):
+    now = epoch_now()
+    conn.execute("""UPDATE statement_imports
+                    SET status=?, rows_read=?, rows_inserted=?, rows_duplicate=?, rows_rejected=?,
+                        error=?, updated_at=?, finished_at=?
+                    WHERE id=?""",
+                 (status, counts['rows_read'], counts['rows_inserted'], counts['rows_duplicate'],
+                  counts['rows_rejected'], error, now, None if status == 'running' else now, import_id))
+
+def import_statement(user_id, import_id, records, parse_date):
+    """Stream parsed records into the ledger in IMPORT_BATCH_SIZE transactions.
+
+    Only the current batch is held in memory. Each batch is an INSERT OR IGNORE
+    against the (user_id, content_hash) index, so lines already imported are
+    counted as duplicates, and progress is saved in the same transaction.
+    Batches committed before a failure are kept; uploading the file again
+    resumes where it stopped.
+    """
+    batch_size = app.config['IMPORT_BATCH_SIZE']
+    max_errors = app.config['IMPORT_MAX_ERRORS']
+    counts = {'rows_read': 0, 'rows_inserted': 0, 'rows_duplicate': 0, 'rows_rejected': 0}
+    errors = []
+    batch = []
+    # Identical lines without a bank reference (two equal card payments on one
+    # day) are told apart by their occurrence count within the upload. The row
+    # includes the posting date, so counts stay per date whatever the file's
+    # order. The counts live in a private temporary database, which spills to
+    # disk, so memory stays flat however long the statement is.
+    occurrences = sqlite3.connect('')
+    occurrences.execute("CREATE TABLE seen (row_key TEXT PRIMARY KEY, count INTEGER NOT NULL) WITHOUT ROWID")
+    earliest = None
+    
+    def flush():
+        if not batch:
+            return
+        now = epoch_now()
+        with get_db(write=True, user_id=user_id) as conn:
+            c = conn.executemany("""INSERT OR IGNORE INTO transactions
+                                (user_id, posted_at, amount_cents, currency, description, category, merchant,
+                                 content_hash, created_at)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                             [(user_id,) + row + (now,) for row in batch])
+            # rowcount sums changes() per row, which skips ignored rows and trigger writes
+            inserted = c.rowcount
+            counts['rows_inserted'] += inserted
+            counts['rows_duplicate'] += len(batch) - inserted
+            _save_import_progress(conn, import_id, counts)
+            if inserted:
+                bump_user_version(conn, [user_id])
+        if inserted:
+            invalidate_cached_users([user_id])
+        IMPORTED_ROWS_TOTAL.inc(inserted, outcome='inserted')
+        IMPORTED_ROWS_TOTAL.inc(len(batch) - inserted, outcome='duplicate')
+        batch.clear()
+    
+    try:
+        for position, raw in records:
+            counts['rows_read'] += 1
+            try:
+                row, reference = parse_statement_row(raw, parse_date)
+            except ValueError as e:
+                counts['rows_rejected'] += 1
+                IMPORTED_ROWS_TOTAL.inc(outcome='rejected')
+                if len(errors) < max_errors:
+                    errors.append(f'Row {position}: {e}')
+                continue
+            if not reference:
+                count = occurrences.execute("""INSERT INTO seen (row_key, count) VALUES (?, 1)
+                                               ON CONFLICT (row_key) DO UPDATE SET count = count + 1
+                                               RETURNING count""",
+                                            (repr(row),)).fetchone()[0]
+                reference = f'#{count - 1}'
+            if earliest is None or row[0] < earliest:
+                earliest = row[0]
+            batch.append(row + (statement_row_hash(row, reference),))
+            if len(batch) >= batch_size:
+                flush()
+        flush()
+    except Exception as e:
+        with get_db(write=True, user_id=user_id) as conn:
+            _save_import_progress(conn, import_id, counts, 'failed', str(e))
+        raise
+    finally:
+        occurrences.close()
+    
+    with get_db(write=True, user_id=user_id) as conn:
+        _save_import_progress(conn, import_id, counts, 'completed')
+    if counts['rows_inserted']:
+        score_user_online(user_id, earliest)
+    return errors
+
+def serialize_import(row):
+    return {
+        'id': row['id'],
+        'format': row['format'],
+        'status': row['status'],
+        'rowsRead': row['rows_read'],
+        'inserted': row['rows_inserted'],
+        'duplicates': row['rows_duplicate'],
+        'rejected': row['rows_rejected'],
+        'error': row['error'],
+        'startedAt': row['started_at'],
+        'finishedAt': row['finished_at'],
+    }
+
+def get_import(user_id, import_id):
+    with get_db(user_id=user_id) as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM statement_imports WHERE id=? AND user_id=?", (import_id, user_id))
+        return c.fetchone()
+
+# Upload a bank statement as the raw request body (Content-Type text/csv or
+# application/x-ofx, or ?format=csv|ofx). The body is parsed as it arrives and
+# never held in memory whole; CSV dates other than ISO 8601 need ?dateFormat=
+# (strptime syntax, e.g. %m/%d/%Y). Progress is visible on
+# /api/transactions/imports while the upload runs.
+@app.route('/api/transactions/import', methods=['POST'])
+@token_required
+def import_transactions(current_user):
+    try:
+        body = open_upload(request.stream)
+        try:
+            statement_format = detect_statement_format(body, request.content_type, request.args.get('format'))
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+        
+        if statement_format == 'ofx':
+            records, parse_date = iter_ofx_statement(body), parse_ofx_date
+        else:
+            records, parse_date = iter_csv_statement(body), csv_date_parser(request.args.get('dateFormat'))
+        
+        now = epoch_now()
+        with get_db(write=True, user_id=current_user['id']) as conn:
+            c = conn.cursor()
+            c.execute("""INSERT INTO statement_imports (user_id, format, started_at, updated_at)
+                         VALUES (?, ?, ?, ?)""", (current_user['id'], statement_format, now, now))
+            import_id = c.lastrowid
+        
+        try:
+            errors = import_statement(current_user['id'], import_id, records, parse_date)
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'message': str(e),
+                'data': serialize_import(get_import(current_user['id'], import_id))
+            }), 400
+        
+        data = serialize_import(get_import(current_user['id'], import_id))
+        data['errors'] = errors
+        return jsonify({'success': True, 'data': data})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/api/transactions/imports', methods=['GET'])
+@token_required
+def list_imports(current_user):
+    try:
+        with get_db(user_id=current_user['id']) as conn:
+            c = conn.cursor()
+            c.execute("SELECT * FROM statement_imports WHERE user_id=? ORDER BY id DESC LIMIT 20",
+                      (current_user['id'],))
+            rows = c.fetchall()
+        
+        return jsonify({'success': True, 'data': {'imports': [serialize_import(row) for row in rows]}})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/api/transactions/imports/<int:import_id>', methods=['GET'])
+@token_required
+def get_import_status(current_user, import_id):
+    try:
+        row = get_import(current_user['id'], import_id)
+        if not row:
+            return jsonify({'success': False, 'message': 'Import not found'}), 404
+        
+        return jsonify({'success': True, 'data': serialize_import(row)})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+# Transaction export settings
+app.config['EXPORT_CHUNK_SIZE'] = 1000   # rows read per connection checkout
+
+EXPORT_CSV_HEADER = ['id', 'postedAt', 'amount', 'currency', 'description', 'category', 'merchant']
+
+def format_cents(cents):
+    return f"{'-' if cents < 0 else ''}{abs(cents) // 100}.{abs(cents) % 100:02d}"
+
+def iter_transaction_chunks(user_id, start, end):
+    """Yield a user's ledger rows in (posted_at, id) order, EXPORT_CHUNK_SIZE at a time.
+
+    Each chunk is a keyset range read on its own pooled checkout, so a slow
+    download never pins a reader or holds a WAL snapshot open.
+    """
+    chunk_size = app.config['EXPORT_CHUNK_SIZE']
+    posted_at, row_id = start, -1
+    while True:
+        with get_db(user_id=user_id) as conn:
+            c = conn.cursor()
+            c.execute(f"""SELECT {TRANSACTION_COLUMNS} FROM transactions
+                          WHERE user_id=? AND (posted_at, id) > (?, ?) AND posted_at < ?
+                          ORDER BY posted_at, id LIMIT ?""",
+                      (user_id, posted_at, row_id, end, chunk_size))
+            rows = c.fetchall()
+        if rows:
+            yield rows
+        if len(rows) < chunk_size:
+            return
+        posted_at, row_id = rows[-1]['posted_at'], rows[-1]['id']
+
+def render_csv_rows(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row['id'],
+                         datetime.datetime.fromtimestamp(row['posted_at'], datetime.timezone.utc).isoformat(),
+                         format_cents(row['amount_cents']), row['currency'], row['description'],
+                         row['category'], row['merchant'] or ''])
+    return buffer.getvalue()
+
+def render_ndjson_rows(rows):
+    return ''.join(json.dumps(serialize_transaction(row)) + '\n' for row in rows)
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def _timestamp_arg(name, default):
+    value = request.args.get(name)
+    if not value:
+        return default
+    return int(value) if value.isdigit() else parse_timestamp(value)
+
+# Download the full history as CSV or NDJSON (?format=), optionally limited to
+# ?from=/&to= (ISO dates or epoch seconds, to exclusive). The body is generated
+# chunk by chunk while it is sent, and gzipped on the fly when the client
+# accepts it, so memory stays flat however many rows the account has.
+@app.route('/api/transactions/export', methods=['GET'])
+@token_required
+def export_transactions(current_user):
+    try:
+        export_format = request.args.get('format', 'csv').lower()
+        if export_format not in ('csv', 'ndjson'):
+            return jsonify({'success': False, 'message': 'format must be csv or ndjson'}), 400
+        try:
+            start = _timestamp_arg('from', 0)
+            end = _timestamp_arg('to', 2 ** 62)
+        except ValueError:
+            return jsonify({'success': False, 'message': 'from and to must be dates, datetimes or epoch seconds'}), 400
+        
+        # Authenticated once here; the generator below runs after the view returns
+        user_id = current_user['id']
+        render = render_csv_rows if export_format == 'csv' else render_ndjson_rows
+        
+        def generate():
+            try:
+                if export_format == 'csv':
+                    yield (','.join(EXPORT_CSV_HEADER) + '\r\n').encode('utf-8')
+                for rows in iter_transaction_chunks(user_id, start, end):
+                    yield render(rows).encode('utf-8')
+            except Exception as e:
+                # Headers are already sent; the client sees a truncated body
+                print(f"Error exporting transactions for {user_id}: {e}")
+                ERRORS_TOTAL.inc(component='export')
+        
+        body = generate()
+        headers = {
+            'Content-Disposition': f'attachment; filename="transactions.{export_format}"',
+            'Vary': 'Accept-Encoding',
+        }
+        if request.accept_encodings['gzip'] > 0:
+            body = gzip_stream(body)
+            headers['Content-Encoding'] = 'gzip'
+        
+        mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+        return Response(body, mimetype=mimetype, headers=headers)
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+# Dashboard summaries: transaction_summaries holds (user_id, month, category,
+# currency) -> total, count, maintained by these triggers on every ledger write
+def _summary_upsert(row, sign):
+    return f"""INSERT INTO transaction_summaries (user_id, month, category, currency, total_cents, txn_count)
+               VALUES ({row}.user_id, strftime('%Y-%m', {row}.posted_at, 'unixepoch'), {row}.category,
+                       {row}.currency, {sign}{row}.amount_cents, {sign}1)
+               ON CONFLICT (user_id, month, category, currency) DO UPDATE
+               SET total_cents = total_cents + excluded.total_cents,
+                   txn_count = txn_count + excluded.txn_count;"""
+
+_SUMMARY_PRUNE = """DELETE FROM transaction_summaries
+                    WHERE user_id = OLD.user_id AND month = strftime('%Y-%m', OLD.posted_at, 'unixepoch')
+                      AND category = OLD.category AND currency = OLD.currency AND txn_count <= 0;"""
+
+TRANSACTION_SUMMARY_TRIGGERS = [
+    f"""CREATE TRIGGER IF NOT EXISTS trg_transactions_summary_insert AFTER INSERT ON transactions
+        BEGIN {_summary_upsert('NEW', '')} END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_transactions_summary_delete AFTER DELETE ON transactions
+        BEGIN {_summary_upsert('OLD', '-')} {_SUMMARY_PRUNE} END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_transactions_summary_update
+        AFTER UPDATE OF user_id, posted_at, amount_cents, category, currency ON transactions
+        BEGIN {_summary_upsert('OLD', '-')} {_SUMMARY_PRUNE} {_summary_upsert('NEW', '')} END""",
+]
+
+def rebuild_transaction_summaries(conn, user_id=None):
+    """Recompute summaries from the ledger, for every user or just one, in the caller's transaction."""
+    where, params = ("WHERE user_id=?", (user_id,)) if user_id else ("", ())
+    conn.execute(f"DELETE FROM transaction_summaries {where}", params)
+    c = conn.execute(f"""INSERT INTO transaction_summaries
+                         (user_id, month, category, currency, total_cents, txn_count)
+                         SELECT user_id, strftime('%Y-%m', posted_at, 'unixepoch'), category, currency,
+                                SUM(amount_cents), COUNT(*)
+                         FROM transactions {where}
+                         GROUP BY 1, 2, 3, 4""", params)
+    return c.rowcount
+
+def build_dashboard_summary(rows):
+    """Shape summary rows (ordered by month, category) into the Budget and Balance widgets."""
+    months = {}
+    for row in rows:
+        key = (row['month'], row['currency'])
+        entry = months.get(key)
+        if entry is None:
+            entry = months[key] = {'month': row['month'], 'currency': row['currency'],
+                                   'total_cents': 0, 'count': 0, 'categories': []}
+        entry['total_cents'] += row['total_cents']
+        entry['count'] += row['txn_count']
+        entry['categories'].append({
+            'category': row['category'],
+            'total': row['total_cents'] / 100,
+            'count': row['txn_count'],
+        })
+    
+    budget = []
+    balances = {}
+    for key in sorted(months):
+        entry = months[key]
+        balance = balances.setdefault(entry['currency'], {'currency': entry['currency'], 'cents': 0, 'history': []})
+        balance['cents'] += entry['total_cents']
+        balance['history'].append({'month': entry['month'], 'balance': balance['cents'] / 100})
+        budget.append({
+            'month': entry['month'],
+            'currency': entry['currency'],
+            'total': entry.pop('total_cents') / 100,
+            'count': entry['count'],
+            'categories': entry['categories'],
+        })
+    
+    return {
+        'budget': budget,
+        'balance': [{'currency': b['currency'], 'balance': b['cents'] / 100, 'history': b['history']}
+                    for b in sorted(balances.values(), key=lambda b: b['currency'])],
+    }
+
+# Everything the dashboard's Budget and Balance widgets show, read from the
+# summary table with one primary-key range scan
+@app.route('/api/dashboard/summary', methods=['GET'])
+@token_required
+@conditional_get
+def dashboard_summary(current_user):
+    try:
+        with get_db(user_id=current_user['id']) as conn:
+            c = conn.cursor()
+            c.execute("""SELECT month, category, currency, total_cents, txn_count
+                         FROM transaction_summaries WHERE user_id=?
+                         ORDER BY month, category""", (current_user['id'],))
+            rows = c.fetchall()
+        
+        return jsonify({'success': True, 'data': build_dashboard_summary(rows)})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.cli.command('rebuild-summaries')
+@click.option('--user', 'user_id', default=None, help='Only rebuild this user id.')
+def rebuild_summaries_command(user_id):
+    """Recompute transaction_summaries from the ledger, e.g. after a backfill."""
+    count = 0
+    for database in [shard_router.database(user_id)] if user_id else shard_router.databases():
+        with get_db(write=True, database=database) as conn:
+            count += rebuild_transaction_summaries(conn, user_id)
+    print(f"Rebuilt {count} summary rows")
+
+# Fraud scoring settings
+app.config['FRAUD_HISTORY_DAYS'] = 90        # history loaded ahead of the scored range
+app.config['FRAUD_ZSCORE_WINDOW'] = 30       # earlier transactions each amount is compared with
+app.config['FRAUD_MIN_HISTORY'] = 5          # transactions needed before amount/merchant signals count
+app.config['FRAUD_VELOCITY_SECONDS'] = 3600
+app.config['FRAUD_VELOCITY_LIMIT'] = 5       # transactions per FRAUD_VELOCITY_SECONDS considered normal
+app.config['FRAUD_ALERT_THRESHOLD'] = 0.5
+app.config['FRAUD_ONLINE_DAYS'] = 7          # furthest back a write rescores; older rows wait for the batch
+app.config['FRAUD_BATCH_ENABLED'] = True     # nightly run on the scheduler leader
+app.config['FRAUD_BATCH_HOUR'] = 3           # local hour of the nightly run
+app.config['FRAUD_BATCH_LOOKBACK_DAYS'] = 2  # posted-at range rescored each night, plus backdated inserts
+app.config['FRAUD_WORKERS'] = os.cpu_count() or 1
+app.config['FRAUD_USERS_PER_TASK'] = 200     # users scored per process-pool task
+
+# Each signal's contribution, combined as 1 - prod(1 - weight * risk)
+FRAUD_WEIGHTS = {'amount': 0.6, 'velocity': 0.5, 'new_merchant': 0.3}
+FRAUD_STD_FLOOR = 0.1   # log-amount std floor, so a run of identical amounts is not infinitely strict
+
+FRAUD_SCORE_SECONDS = metrics.histogram('finguard_fraud_score_seconds', 'Time to score one user online.')
+
+fraud_stats = {
+    'runs': 0,
+    'alerts': 0,
+    'last_run': None,
+}
+_fraud_stats_lock = Lock()
+
+def get_fraud_stats():
+    with _fraud_stats_lock:
+        return dict(fraud_stats)
+
+def fraud_params():
+    # Passed explicitly to pool workers, which may not share this process's config
+    return {
+        'history_seconds': app.config['FRAUD_HISTORY_DAYS'] * 86400,
+        'zscore_window': app.config['FRAUD_ZSCORE_WINDOW'],
+        'min_history': app.config['FRAUD_MIN_HISTORY'],
+        'velocity_seconds': app.config['FRAUD_VELOCITY_SECONDS'],
+        'velocity_limit': app.config['FRAUD_VELOCITY_LIMIT'],
+        'threshold': app.config['FRAUD_ALERT_THRESHOLD'],
+    }
+
+def score_transactions(posted_at, amount_cents, merchants, params):
+    """Vectorized risk signals for one user's transactions in (posted_at, id) order.
+
+    Every row is compared only with the rows before it, so its score does not
+    change as later transactions arrive. Returns NumPy arrays
+    (score, amount_zscore, velocity, new_merchant).
+    """
+    import numpy as np
+    
+    t = np.asarray(posted_at, dtype=np.int64)
+    cents = np.asarray(amount_cents, dtype=np.int64)
+    n = len(t)
+    index = np.arange(n)
+    
+    # z-score of each log amount against the previous FRAUD_ZSCORE_WINDOW, with
+    # the rolling mean and variance taken from prefix sums
+    x = np.log1p(np.abs(cents) / 100.0)
+    start = np.maximum(index - params['zscore_window'], 0)
+    sums = np.concatenate(([0.0], np.cumsum(x)))
+    squares = np.concatenate(([0.0], np.cumsum(x * x)))
+    count = index - start
+    mean = (sums[index] - sums[start]) / np.maximum(count, 1)
+    variance = np.maximum((squares[index] - squares[start]) / np.maximum(count, 1) - mean * mean, 0.0)
+    std = np.maximum(np.sqrt(variance), FRAUD_STD_FLOOR)
+    zscore = np.where(count >= params['min_history'], (x - mean) / std, 0.0)
+    
+    # Transactions in the trailing FRAUD_VELOCITY_SECONDS, this one included
+    velocity = index - np.searchsorted(t, t - params['velocity_seconds'], side='right') + 1
+    
+    # First appearance of a merchant once there is enough history to judge
+    names = np.asarray(merchants, dtype=str)
+    _, first = np.unique(names, return_index=True)
+    new_merchant = np.zeros(n, dtype=bool)
+    new_merchant[first] = True
+    new_merchant &= (names != '') & (index >= params['min_history'])
+    
+    limit = params['velocity_limit']
+    amount_risk = np.clip((zscore - 2.0) / 2.0, 0.0, 1.0) * (cents < 0)
+    velocity_risk = np.clip((velocity - limit) / limit, 0.0, 1.0)
+    score = 1.0 - ((1.0 - FRAUD_WEIGHTS['amount'] * amount_risk)
+                   * (1.0 - FRAUD_WEIGHTS['velocity'] * velocity_risk)
+                   * (1.0 - FRAUD_WEIGHTS['new_merchant'] * new_merchant))
+    return score, zscore, velocity, new_merchant
+
+def score_user(conn, user_id, since, params):
+    """Score a user's transactions posted since `since`; return (rows scored, alert rows)."""
+    rows = conn.execute("""SELECT id, posted_at, amount_cents, LOWER(TRIM(COALESCE(merchant, '')))
+                           FROM transactions WHERE user_id=? AND posted_at >= ?
+                           ORDER BY posted_at, id""",
+                        (user_id, since - params['history_seconds'])).fetchall()
+    if not rows:
+        return 0, []
+    import numpy as np
+    
+    ids, posted_at, amount_cents, merchants = zip(*rows)
+    score, zscore, velocity, new_merchant = score_transactions(posted_at, amount_cents, merchants, params)
+    
+    # The rows before `since` are history only
+    in_range = np.asarray(posted_at, dtype=np.int64) >= since
+    now = epoch_now()
+    alerts = []
+    for i in np.flatnonzero(in_range & (score >= params['threshold'])):
+        reasons = [name for name, hit in (('amount', zscore[i] >= 2.0 and amount_cents[i] < 0),
+                                          ('velocity', velocity[i] > params['velocity_limit']),
+                                          ('new_merchant', new_merchant[i])) if hit]
+        alerts.append((ids[i], user_id, round(float(score[i]), 4), ','.join(reasons),
+                       round(float(zscore[i]), 4), int(velocity[i]), int(new_merchant[i]), now))
+    return int(in_range.sum()), alerts
+
+def save_alerts(conn, users, alerts):
+    """Replace each (user_id, since) user's alerts for transactions posted since `since`.
+
+    Runs in the caller's write transaction. Users whose alerts come out
+    unchanged are left alone, so row_version (and with it the user's ETags)
+    only moves when what they read back does. Returns the changed user ids,
+    for the caller to pass to invalidate_cached_users after it commits.
+    """
+    by_user = {}
+    for alert in alerts:
+        by_user.setdefault(alert[1], []).append(alert)
+    changed = []
+    for user_id, since in users:
+        new = by_user.get(user_id, [])
+        old = conn.execute("""SELECT a.transaction_id, a.score, a.reasons
+                              FROM transaction_alerts a JOIN transactions t ON t.id = a.transaction_id
+                              WHERE a.user_id=? AND t.posted_at >= ?""", (user_id, since)).fetchall()
+        if {tuple(row) for row in old} == {(alert[0], alert[2], alert[3]) for alert in new}:
+            continue
+        conn.execute("""DELETE FROM transaction_alerts WHERE user_id=? AND transaction_id IN
+                        (SELECT id FROM transactions WHERE user_id=? AND posted_at >= ?)""",
+                     (user_id, user_id, since))
+        conn.executemany("""INSERT OR REPLACE INTO transaction_alerts
+                            (transaction_id, user_id, score, reasons, amount_zscore, velocity, new_merchant, scored_at)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)""", new)
+        changed.append(user_id)
+    bump_user_version(conn, changed)
+    return changed
+
+# Runs in a pool worker on its own read-only connection; users are (user_id, since) pairs
+def _score_user_chunk(database, users, params):
+    conn = sqlite3.connect(f'file:{database}?mode=ro', uri=True)
+    try:
+        scored = 0
+        alerts = []
+        for user_id, since in users:
+            count, user_alerts = score_user(conn, user_id, since, params)
+            scored += count
+            alerts.extend(user_alerts)
+        return scored, alerts
+    finally:
+        conn.close()
+
+# Score one user right after their transactions are written. Runs on the
+# request thread (one indexed range read plus NumPy) and never fails the write
+# that triggered it. Only the last FRAUD_ONLINE_DAYS are rescored, however far
+# back the new rows were posted; the nightly batch picks up the rest.
+def score_user_online(user_id, since):
+    started = time.perf_counter()
+    try:
+        params = fraud_params()
+        since = max(since, epoch_now() - app.config['FRAUD_ONLINE_DAYS'] * 86400)
+        with get_db(user_id=user_id) as conn:
+            _, alerts = score_user(conn, user_id, since, params)
+        with get_db(write=True, user_id=user_id) as conn:
+            changed = save_alerts(conn, [(user_id, since)], alerts)
+        invalidate_cached_users(changed)
+        return len(alerts)
+    except Exception as e:
+        print(f"Error scoring transactions for {user_id}: {e}")
+        ERRORS_TOTAL.inc(component='fraud_scoring')
+        return 0
+    finally:
+        FRAUD_SCORE_SECONDS.observe(time.perf_counter() - started)
+
+# Score every user with transactions posted since `since` (default: the last
+# FRAUD_BATCH_LOOKBACK_DAYS) across a process pool of FRAUD_WORKERS, writing
+# each chunk's alerts as it completes. Rows inserted since then with an older
+# posting date, which online scoring leaves alone, are rescored from the
+# earliest one.
+def run_fraud_batch(since=None, user_ids=None):
+    started = time.perf_counter()
+    if since is None:
+        since = epoch_now() - app.config['FRAUD_BATCH_LOOKBACK_DAYS'] * 86400
+    params = fraud_params()
+    scored = 0
+    alert_count = 0
+    try:
+        # A chunk's users share a shard, so each chunk reads and writes one file
+        if user_ids is None:
+            groups = {}
+            for database in shard_router.databases():
+                with get_db(database=database) as conn:
+                    groups[database] = [(user_id, min(since, earliest)) for user_id, earliest in conn.execute(
+                        """SELECT user_id, MIN(posted_at) FROM transactions
+                           WHERE posted_at >= ? OR created_at >= ? GROUP BY user_id""", (since, since))]
+            user_ids = [user_id for group in groups.values() for user_id, _ in group]
+        else:
+            groups = {database: [(user_id, since) for user_id in group]
+                      for database, group in shard_router.group(user_ids).items()}
+        
+        size = app.config['FRAUD_USERS_PER_TASK']
+        chunks = [(database, group[i:i + size]) for database, group in groups.items()
+                  for i in range(0, len(group), size)]
+        if chunks:
+            with ProcessPoolExecutor(max_workers=min(app.config['FRAUD_WORKERS'], len(chunks))) as executor:
+                futures = {executor.submit(_score_user_chunk, database, chunk, params): (database, chunk)
+                           for database, chunk in chunks}
+                for future in as_completed(futures):
+                    count, alerts = future.result()
+                    database, chunk = futures[future]
+                    with get_db(write=True, database=database) as conn:
+                        changed = save_alerts(conn, chunk, alerts)
+                    invalidate_cached_users(changed)
+                    scored += count
+                    alert_count += len(alerts)
+        
+        print(f"Fraud batch scored {scored} transactions for {len(user_ids)} users: {alert_count} alerts")
+    except Exception as e:
+        print(f"Error running fraud batch: {e}")
+        ERRORS_TOTAL.inc(component='fraud_batch')
+    
+    run = {
+        'finished_at': epoch_now(),
+        'duration_seconds': time.perf_counter() - started,
+        'users': len(user_ids or []),
+        'transactions': scored,
+        'alerts': alert_count,
+    }
+    with _fraud_stats_lock:
+        fraud_stats['runs'] += 1
+        fraud_stats['alerts'] += alert_count
+        fraud_stats['last_run'] = run
+    return run
+
+@app.route('/api/transactions/alerts', methods=['GET'])
+@token_required
+@conditional_get
+def list_alerts(current_user):
+    try:
+        with get_db(user_id=current_user['id']) as conn:
+            c = conn.cursor()
+            c.execute("""SELECT a.score, a.reasons, t.id, t.posted_at, t.amount_cents, t.currency,
+                                 t.description, t.category, t.merchant
+                          FROM transaction_alerts a JOIN transactions t ON t.id = a.transaction_id
+                          WHERE a.user_id=?
+                          ORDER BY a.transaction_id DESC LIMIT 100""", (current_user['id'],))
+            rows = c.fetchall()
+        
+        alerts = []
+        for row in rows:
+            alert = serialize_transaction(row)
+            alert['riskScore'] = row['score']
+            alert['reasons'] = row['reasons'].split(',') if row['reasons'] else []
+            alerts.append(alert)
+        
+        return jsonify({'success': True, 'data': {'alerts': alerts}})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.cli.command('score-transactions')
+@click.option('--days', default=None, type=int, help='Rescore transactions posted in the last N days (default FRAUD_BATCH_LOOKBACK_DAYS).')
+@click.option('--user', 'user_id', default=None, help='Only score this user id.')
+def score_transactions_command(days, user_id):
+    """Run the fraud batch now, e.g. after changing the scoring settings."""
+    since = epoch_now() - days * 86400 if days is not None else None
+    run = run_fraud_batch(since, [user_id] if user_id else None)
+    print(f"{run['users']} users, {run['transactions']} transactions, {run['alerts']} alerts "
+          f"in {run['duration_seconds']:.2f}s")
+
+# Backup settings
+app.config['BACKUP_ENABLED'] = True            # periodic snapshots on the scheduler leader
+app.config['BACKUP_DIR'] = os.environ.get('BACKUP_DIR')   # defaults to <DATABASE>.backups
+app.config['BACKUP_INTERVAL_MINUTES'] = 60
+app.config['BACKUP_PAGES_PER_STEP'] = 256      # pages copied per backup step
+app.config['BACKUP_STEP_PAUSE'] = 0.005        # seconds yielded to live requests between steps
+app.config['BACKUP_RETENTION'] = 24            # snapshots kept, newest first
+
+backup_stats = {
+    'runs': 0,
+    'failures': 0,
+    'last_run': None,
+}
+_backup_stats_lock = Lock()
+
+# Latencies of the last requests served by this process as (finished, seconds),
+# so a backup can compare requests served while it ran with those just before
+_recent_request_latencies = deque(maxlen=5000)
+
+def get_backup_stats():
+    with _backup_stats_lock:
+        return dict(backup_stats)
+
+def backup_dir():
+    return app.config['BACKUP_DIR'] or app.config['DATABASE'] + '.backups'
+
+def list_snapshots():
+    """Completed snapshot directories, oldest first."""
+    directory = backup_dir()
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if os.path.exists(os.path.join(directory, name, 'manifest.json')))
+
+def _latency_summary(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {'requests': 0, 'p50_ms': None, 'p95_ms': None}
+    pick = lambda pct: samples[min(len(samples) - 1, int(pct / 100.0 * len(samples)))] * 1000.0
+    return {'requests': len(samples), 'p50_ms': round(pick(50), 3), 'p95_ms': round(pick(95), 3)}
+
+def snapshot_database(database, path):
+    """Copy `database` to a gzip file at `path` with the online backup API.
+
+    The copy reads one WAL snapshot pinned by a read transaction on its own
+    connection, so writers are never blocked and their commits cannot restart
+    the copy. Pages are copied BACKUP_PAGES_PER_STEP at a time, pausing
+    between steps so the copy's I/O interleaves with live requests. Returns
+    the manifest entry, including the SHA-256 of the uncompressed file.
+    The entry keeps `database` as configured (the name the shard map uses)
+    and its absolute `path`, which is where a restore writes it back.
+    """
+    pause = app.config['BACKUP_STEP_PAUSE']
+    scratch = path + '.db'
+    steps = {'count': 0, 'pages': 0, 'slowest': 0.0, 'since': 0.0}
+    
+    def progress(status, remaining, total):
+        now = time.perf_counter()
+        steps['count'] += 1
+        steps['pages'] = total
+        steps['slowest'] = max(steps['slowest'], now - steps['since'])
+        if remaining:
+            time.sleep(pause)
+        steps['since'] = time.perf_counter()
+    
+    started = time.perf_counter()
+    source = sqlite3.connect(database, timeout=app.config['DB_BUSY_TIMEOUT_MS'] / 1000.0)
+    target = sqlite3.connect(scratch)
+    try:
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        steps['since'] = time.perf_counter()
+        source.backup(target, pages=app.config['BACKUP_PAGES_PER_STEP'], progress=progress)
+    finally:
+        source.close()
+        target.close()
+    
+    digest = hashlib.sha256()
+    def chunks():
+        with open(scratch, 'rb') as raw:
+            for chunk in iter(lambda: raw.read(1 << 20), b''):
+                digest.update(chunk)
+                yield chunk
+    try:
+        with open(path, 'wb') as out:
+            for data in gzip_stream(chunks()):
+                out.write(data)
+            out.flush()
+            os.fsync(out.fileno())
+        size = os.path.getsize(scratch)
+    finally:
+        os.remove(scratch)
+    
+    return {
+        'database': database,
+        'path': os.path.abspath(database),
+        'file': os.path.basename(path),
+        'sha256': digest.hexdigest(),
+        'bytes': size,
+        'compressed_bytes': os.path.getsize(path),
+        'pages': steps['pages'],
+        'steps': steps['count'],
+        'max_step_seconds': round(steps['slowest'], 6),
+        'duration_seconds': round(time.perf_counter() - started, 6),
+    }
+
+# Snapshot every database (DATABASE and each shard) into a new timestamped
+# directory under backup_dir(), then drop snapshots beyond BACKUP_RETENTION.
+# Each file is consistent on its own; shards are copied one after another.
+# The directory is written as <name>.partial and renamed when complete, so a
+# crashed run never looks like a snapshot.
+def run_backup():
+    started = time.perf_counter()
+    started_at = epoch_now()
+    name = datetime.datetime.fromtimestamp(started_at, datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    directory = os.path.join(backup_dir(), name)
+    entries = []
+    error = None
+    try:
+        os.makedirs(directory + '.partial')
+        for index, database in enumerate(shard_router.databases()):
+            path = os.path.join(directory + '.partial', f'{index:02d}-{os.path.basename(database)}.gz')
+            entries.append(snapshot_database(database, path))
+        with open(os.path.join(directory + '.partial', 'manifest.json'), 'w') as f:
+            json.dump({'created_at': started_at, 'databases': entries}, f, indent=2)
+        os.rename(directory + '.partial', directory)
+        
+        for expired in list_snapshots()[:-max(1, app.config['BACKUP_RETENTION'])]:
+            shutil.rmtree(expired, ignore_errors=True)
+        print(f"Backup {name} written: {len(entries)} databases")
+    except Exception as e:
+        error = str(e)
+        shutil.rmtree(directory + '.partial', ignore_errors=True)
+        print(f"Error running backup: {e}")
+        ERRORS_TOTAL.inc(component='backup')
+    
+    # Requests this process served during the copy against the ones just before
+    finished = time.perf_counter()
+    latencies = list(_recent_request_latencies)
+    before = _latency_summary(seconds for at, seconds in latencies if at < started)
+    during = _latency_summary(seconds for at, seconds in latencies if started <= at <= finished)
+    run = {
+        'snapshot': None if error else directory,
+        'error': error,
+        'finished_at': epoch_now(),
+        'duration_seconds': finished - started,
+        'bytes': sum(entry['bytes'] for entry in entries),
+        'compressed_bytes': sum(entry['compressed_bytes'] for entry in entries),
+        'max_step_seconds': max((entry['max_step_seconds'] for entry in entries), default=0.0),
+        'requests_before': before,
+        'requests_during': during,
+        'p95_slowdown_pct': round((during['p95_ms'] / before['p95_ms'] - 1) * 100, 1)
+                            if during['p95_ms'] and before['p95_ms'] else None,
+    }
+    with _backup_stats_lock:
+        backup_stats['runs'] += 1
+        backup_stats['failures'] += 1 if error else 0
+        backup_stats['last_run'] = run
+    return run
+
+def restore_snapshot(snapshot):
+    """Put every database in a snapshot back at its original path.
+
+    All files are decompressed and checked (SHA-256 and integrity_check)
+    before any live file is touched. Each replaced database, with its -wal
+    and -shm files, is kept alongside as <path>.pre-restore. Run it with the
+    app stopped. Returns the restored paths.
+    
+    Files go back to each entry's absolute path, so the working directory
+    does not matter; manifests written before paths were recorded fall back
+    to the database name as configured.
+    """
+    with open(os.path.join(snapshot, 'manifest.json')) as f:
+        manifest = json.load(f)
+    targets = [entry.get('path', entry['database']) for entry in manifest['databases']]
+    
+    restored = []
+    try:
+        for entry, database in zip(manifest['databases'], targets):
+            scratch = database + '.restore'
+            restored.append(scratch)
+            digest = hashlib.sha256()
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            with open(os.path.join(snapshot, entry['file']), 'rb') as raw, open(scratch, 'wb') as out:
+                for chunk in iter(lambda: raw.read(1 << 20), b''):
+                    data = decompressor.decompress(chunk)
+                    digest.update(data)
+                    out.write(data)
+                data = decompressor.flush()
+                digest.update(data)
+                out.write(data)
+                out.flush()
+                os.fsync(out.fileno())
+            if digest.hexdigest() != entry['sha256']:
+                raise ValueError(f"{entry['file']}: checksum mismatch")
+            check = sqlite3.connect(scratch)
+            try:
+                result = check.execute("PRAGMA integrity_check").fetchone()[0]
+            finally:
+                check.close()
+            if result != 'ok':
+                raise ValueError(f"{entry['file']}: integrity check failed: {result}")
+    except Exception:
+        for scratch in restored:
+            if os.path.exists(scratch):
+                os.remove(scratch)
+        raise
+    
+    # A leftover -wal would be replayed over the restored file, so it moves too
+    close_pools()
+    for database in targets:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(database + suffix):
+                os.replace(database + suffix, database + '.pre-restore' + suffix)
+        os.replace(database + '.restore', database)
+    shard_router.reload()
+    return targets
+
+@app.cli.command('backup')
+@click.option('--list', 'list_only', is_flag=True, help='List existing snapshots instead.')
+def backup_command(list_only):
+    """Write a snapshot of every database now, or list the snapshots."""
+    if list_only:
+        for snapshot in list_snapshots():
+            with open(os.path.join(snapshot, 'manifest.json')) as f:
+                manifest = json.load(f)
+            size = sum(entry['compressed_bytes'] for entry in manifest['databases'])
+            print(f"{os.path.basename(snapshot)}  {len(manifest['databases'])} databases  {size} bytes")
+        return
+    run = run_backup()
+    if run['error']:
+        raise SystemExit(1)
+    print(f"{run['snapshot']}: {run['bytes']} bytes -> {run['compressed_bytes']} compressed "
+          f"in {run['duration_seconds']:.2f}s (longest step {run['max_step_seconds'] * 1000:.1f} ms)")
+
+@app.cli.command('restore-backup')
+@click.argument('snapshot')
+def restore_backup_command(snapshot):
+    """Restore SNAPSHOT (a name from 'flask backup --list', a path, or 'latest'). Run it with the app stopped."""
+    snapshots = list_snapshots()
+    if snapshot == 'latest':
+        if not snapshots:
+            raise click.UsageError(f'No snapshots in {backup_dir()}')
+        snapshot = snapshots[-1]
+    elif not os.path.isdir(snapshot):
+        snapshot = os.path.join(backup_dir(), snapshot)
+    try:
+        databases = restore_snapshot(snapshot)
+    except (OSError, ValueError) as e:
+        raise click.ClickException(str(e))
+    for database in databases:
+        print(f"Restored {database} (previous copy kept as {database}.pre-restore)")
+
+# Per-request timing, plus an opt-in stack sampler for requests sent with
+# "X-Profile: 1" while PROFILING_ENABLED is set
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if app.config['PROFILING_ENABLED'] and request.headers.get('X-Profile') == '1':
+        g.sampler = RequestSampler(get_ident(), app.config['PROFILE_INTERVAL']).start()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    REQUEST_SECONDS.observe(elapsed, route=route, method=request.method, status=response.status_code)
+    _recent_request_latencies.append((time.perf_counter(), elapsed))
+    
+    sampler = g.pop('sampler', None)
+    if sampler is not None:
+        profile = sampler.stop()
+        profile.update({
+            'id': uuid.uuid4().hex,
+            'route': route,
+            'method': request.method,
+            'status': response.status_code,
+            'duration_seconds': elapsed,
+            'timestamp': datetime.datetime.now().isoformat(),
+        })
+        recent_profiles.append(profile)
+        response.headers['X-Profile-Id'] = profile['id']
+    return response
+
+@metrics.collector
+def collect_component_gauges():
+    gauges = []
+    pools = list(_pools.values())
+    for key in ('open_readers', 'idle_readers', 'pool_size', 'timeouts'):
+        gauges.append((f'finguard_db_pool_{key}', f'Connection pool {key.replace("_", " ")}.',
+                       [({'database': pool.database}, pool.stats()[key]) for pool in pools]))
+    cache = get_user_cache().stats()
+    for key in ('entries', 'hits', 'misses', 'evictions', 'invalidations'):
+        gauges.append((f'finguard_user_cache_{key}', f'Authenticated-user cache {key}.', [({}, cache[key])]))
+    mail = mail_dispatcher.stats()
+    gauges.append(('finguard_mail_queue_depth', 'Outbox messages waiting to be sent.', [({}, mail['queue_depth'])]))
+    gauges.append(('finguard_mail_sent', 'Messages sent by this process.', [({}, mail['sent'])]))
+    gauges.append(('finguard_mail_failed', 'Messages that exhausted their retries.', [({}, mail['failed'])]))
+    revoked = revocations.stats()
+    gauges.append(('finguard_revocation_filter_entries', 'Revoked token ids in the filter.', [({}, revoked['entries'])]))
+    gauges.append(('finguard_revocation_false_positives', 'Filter hits not confirmed by the database.',
+                   [({}, revoked['false_positives'])]))
+    reaper = get_reaper_stats()
+    gauges.append(('finguard_reaper_rows_deleted', 'Rows deleted by the reaper since start.', [({}, reaper['rows_deleted'])]))
+    return gauges
+
+# Prometheus scrape endpoint
+@app.route('/api/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/metrics/profiles', methods=['GET'])
+def profiles_endpoint():
+    if not app.config['PROFILING_ENABLED']:
+        return jsonify({'success': False, 'message': 'Profiling is disabled'}), 404
+    return jsonify({'success': True, 'data': {'profiles': list(recent_profiles)}})
+
 # Health check endpoint
 @app.route('/api/health', methods=['GET'])
 def health_check():
-    return jsonify({'status': 'healthy', 'timestamp': datetime.datetime.now().isoformat()})
+    return jsonify({
+        'status': 'healthy',
+        'timestamp': datetime.datetime.now().isoformat(),
+        'db_pool': get_pool().stats(),
+        'shards': shard_router.stats(),
+        'user_cache': get_user_cache().stats(),
+        'mail': mail_dispatcher.stats(),
+        'reaper': get_reaper_stats(),
+        'revocations': revocations.stats(),
+        'fraud': get_fraud_stats(),
+        'audit': audit_log.stats(),
+        'backups': get_backup_stats()
+    })
+
+# Production server settings
+app.config['SERVER_WORKERS'] = int(os.environ.get('SERVER_WORKERS', (os.cpu_count() or 1) * 2))
+app.config['SERVER_THREADS'] = int(os.environ.get('SERVER_THREADS', 16))
 
-# Initialize database and start cleanup scheduler
-def initialize_app():
+# Background services settings
+app.config['SCHEDULER_ENABLED'] = os.environ.get('SCHEDULER_ENABLED') == '1'   # opt in to running the reaper
+app.config['SCHEDULER_LOCK_FILE'] = None  # defaults to <DATABASE>.scheduler.lock
+app.config['LEADER_RETRY_SECONDS'] = 30   # how often non-leaders try to take over the reaper
+
+# One-time database preparation for a deployment: apply migrations and requeue
+# outbox rows orphaned by a crash. Run it before any worker starts serving
+# (flask migrate-db, flask serve and python app.py all do).
+def prepare_database():
     init_db()
+    mail_dispatcher.release_stale_claims()
+
+_services_lock = Lock()
+_services_started = False
+_scheduler = None
+_leader_lock_file = None
+
+# Try to take the deployment-wide scheduler lock without blocking. Only the
+# holder runs the reaper, the nightly fraud batch and backups, so several
+# workers sharing one database never run them concurrently; the lock is
+# released when its process exits.
+def acquire_leader_lock():
+    global _leader_lock_file
+    if _leader_lock_file is not None:
+        return True
+    try:
+        import fcntl
+    except ImportError:
+        # No flock on this platform: every process with the scheduler enabled leads
+        return True
+    path = app.config['SCHEDULER_LOCK_FILE'] or app.config['DATABASE'] + '.scheduler.lock'
+    lock_file = open(path, 'a+')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _leader_lock_file = lock_file
+    return True
+
+def _elect_scheduler_leader():
+    if _scheduler is None or _scheduler.get_job('reaper') is not None:
+        return
+    if acquire_leader_lock():
+        _scheduler.add_job(func=instrument_job('reaper', cleanup_expired_tokens), trigger="interval",
+                           minutes=app.config['REAPER_INTERVAL_MINUTES'], id='reaper',
+                           max_instances=1, coalesce=True)
+        if app.config['FRAUD_BATCH_ENABLED']:
+            _scheduler.add_job(func=instrument_job('fraud_batch', run_fraud_batch), trigger="cron",
+                               hour=app.config['FRAUD_BATCH_HOUR'], id='fraud_batch',
+                               max_instances=1, coalesce=True)
+        if app.config['BACKUP_ENABLED']:
+            _scheduler.add_job(func=instrument_job('backup', run_backup), trigger="interval",
+                               minutes=app.config['BACKUP_INTERVAL_MINUTES'], id='backup',
+                               max_instances=1, coalesce=True)
+
+# Per-process background work, started on the first request rather than at
+# import: the revocation filter sync, the changed-user sync, rate-limit
+# eviction, the mail dispatcher and, when SCHEDULER_ENABLED, a bid for the
+# reaper leader lock.
+def start_background_services():
+    global _services_started, _scheduler
+    if _services_started:
+        return
+    with _services_lock:
+        if _services_started:
+            return
+        from apscheduler.schedulers.background import BackgroundScheduler
+        
+        sync_revocations()
+        sync_user_changes()
+        
+        scheduler = BackgroundScheduler()
+        scheduler.add_job(func=instrument_job('revocation_sync', sync_revocations), trigger="interval",
+                          seconds=app.config['REVOCATION_SYNC_SECONDS'],
+                          max_instances=1, coalesce=True)
+        scheduler.add_job(func=instrument_job('user_sync', sync_user_changes), trigger="interval",
+                          seconds=app.config['USER_SYNC_SECONDS'],
+                          max_instances=1, coalesce=True)
+        scheduler.add_job(func=instrument_job('rate_limit_eviction', evict_rate_limits), trigger="interval",
+                          seconds=app.config['RATE_LIMIT_EVICT_SECONDS'],
+                          max_instances=1, coalesce=True)
+        if app.config['SCHEDULER_ENABLED']:
+            scheduler.add_job(func=_elect_scheduler_leader, trigger="interval",
+                              seconds=app.config['LEADER_RETRY_SECONDS'],
+                              next_run_time=datetime.datetime.now(),
+                              max_instances=1, coalesce=True)
+        scheduler.start()
+        _scheduler = scheduler
+        
+        # Start draining the outbound email queue and the audit buffer
+        mail_dispatcher.start()
+        audit_log.start()
+        
+        # Shut everything down when exiting the app
+        atexit.register(lambda: scheduler.shutdown(wait=False))
+        atexit.register(mail_dispatcher.stop)
+        atexit.register(audit_log.stop)
+        atexit.register(close_pools)
+        atexit.register(shutdown_hash_executor)
+        _services_started = True
+
+@app.before_request
+def _start_services_on_first_request():
+    if not _services_started:
+        start_background_services()
+
+def create_app(config=None):
+    """Return the application, applying any config overrides.
+
+    Creating the app has no side effects: it neither touches the database nor
+    starts threads. Schema setup is explicit (prepare_database or
+    'flask migrate-db') and background services start with the first request.
+    Routes and background jobs share this module's single app object, so
+    repeated calls configure and return the same instance.
+    """
+    if config:
+        app.config.update(config)
+    return app
+
+# A worker forked from a preloaded parent inherits its SQLite connections,
+# hashing pool, locks and thread objects, none of which are safe to reuse.
+# Drop them so the worker lazily builds its own.
+def reset_after_fork():
+    global _pools_lock, _user_cache, _user_cache_lock, _hash_executor, _hash_slots, _hash_lock
+    global _stores, _stores_lock, _reaper_stats_lock, _fraud_stats_lock, _backup_stats_lock
+    global _rate_limiter, _rate_limiter_lock
+    global _services_lock, _services_started, _scheduler, _leader_lock_file
+    _pools.clear()
+    _pools_lock = Lock()
+    _user_cache = None
+    _user_cache_lock = Lock()
+    _hash_executor = None
+    _hash_slots = None
+    _hash_lock = Lock()
+    _stores = {}
+    _stores_lock = Lock()
+    _reaper_stats_lock = Lock()
+    _fraud_stats_lock = Lock()
+    _backup_stats_lock = Lock()
+    _rate_limiter = None
+    _rate_limiter_lock = Lock()
+    _services_lock = Lock()
+    _services_started = False
+    _scheduler = None
+    _leader_lock_file = None
+    revocations.reset_after_fork()
+    mail_dispatcher.reset_after_fork()
+    audit_log.reset_after_fork()
+    shard_router.reset_after_fork()
+
+def _post_fork(server, worker):
+    reset_after_fork()
+
+# Multi-process server: the master prepares the database once and preloads the
+# app, and each forked gthread worker serves requests with its own connection
+# pool, hashing pool and background services. Workers compete for the
+# scheduler lock so exactly one of them runs the reaper.
+def run_production_server(host='0.0.0.0', port=5000, workers=None, threads=None):
+    from gunicorn.app.base import BaseApplication
+    
+    create_app({'SCHEDULER_ENABLED': True})
+    prepare_database()
+    workers = workers or app.config['SERVER_WORKERS']
+    share_hashing_pool(workers)
     
-    # Schedule token cleanup to run every hour
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(func=cleanup_expired_tokens, trigger="interval", hours=1)
-    scheduler.start()
+    options = {
+        'bind': f'{host}:{port}',
+        'workers': workers,
+        'threads': threads or app.config['SERVER_THREADS'],
+        'worker_class': 'gthread',
+        'preload_app': True,
+        'post_fork': _post_fork,
+        'keepalive': 5,
+    }
+    
+    class FinGuardServer(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+        
+        def load(self):
+            return create_app()
     
-    # Shut down the scheduler when exiting the app
-    atexit.register(lambda: scheduler.shutdown())
+    FinGuardServer().run()
+
+class PooledAsgiAdapter:
+    """Serve a WSGI app over ASGI, each request on a thread of `executor`.
+
+    The request body is spooled before the app runs. The response is
+    streamed: every chunk the app yields is handed to the event loop as it
+    is produced, so long downloads keep memory flat.
+    """
+
+    def __init__(self, wsgi_app, executor):
+        self.wsgi_app = wsgi_app
+        self.executor = executor
+
+    async def __call__(self, scope, receive, send):
+        import asyncio
+        from tempfile import SpooledTemporaryFile
+        
+        if scope['type'] == 'lifespan':
+            # Nothing to set up: services start with the first request
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            raise ValueError(f"Unsupported ASGI scope type {scope['type']!r}")
+        
+        loop = asyncio.get_running_loop()
+        
+        def send_from_thread(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+        
+        with SpooledTemporaryFile(max_size=65536) as body:
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                body.write(message.get('body', b''))
+                if not message.get('more_body'):
+                    break
+            body.seek(0)
+            await loop.run_in_executor(self.executor, self._run, scope, body, send_from_thread)
+
+    @staticmethod
+    def build_environ(scope, body):
+        script_name = scope.get('root_path', '').encode('utf-8').decode('latin-1')
+        path_info = scope['path'].encode('utf-8').decode('latin-1')
+        if path_info.startswith(script_name):
+            path_info = path_info[len(script_name):]
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': script_name,
+            'PATH_INFO': path_info,
+            'QUERY_STRING': scope['query_string'].decode('ascii'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            key = name if name in ('CONTENT_LENGTH', 'CONTENT_TYPE') else f'HTTP_{name}'
+            value = value.decode('latin-1')
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+        return environ
+
+    def _run(self, scope, body, send):
+        response = {}
+        
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response.get('started'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['start'] = {
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+            }
+        
+        def begin():
+            if not response.get('started'):
+                response['started'] = True
+                send(response['start'])
+        
+        result = self.wsgi_app(self.build_environ(scope, body), start_response)
+        try:
+            for chunk in result:
+                if chunk:
+                    begin()
+                    send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            begin()
+            send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+# ASGI entry point for uvicorn/hypercorn, e.g.
+#   flask migrate-db && uvicorn app:create_asgi_app --factory --workers 4
+# Routes stay synchronous and run on a pool of SERVER_THREADS threads per
+# process, so each process serves that many requests at once; the slow parts
+# (bcrypt, SMTP) are already off the request thread. Unlike `flask serve`,
+# this does not prepare the database: `flask migrate-db` applies migrations
+# and requeues emails a crash left claimed, and must run before the workers
+# start. The hashing pool is split between WEB_CONCURRENCY processes, which is
+# also uvicorn's default for --workers.
+def create_asgi_app():
+    share_hashing_pool(int(os.environ.get('WEB_CONCURRENCY', 1)))
+    executor = ThreadPoolExecutor(max_workers=app.config['SERVER_THREADS'], thread_name_prefix='asgi-request')
+    atexit.register(executor.shutdown, wait=False)
+    return PooledAsgiAdapter(create_app(), executor)
 
-# Initialize the application
-initialize_app()
+@app.cli.command('serve')
+@click.option('--host', default='0.0.0.0')
+@click.option('--port', default=5000, type=int)
+@click.option('--workers', default=None, type=int, help='Worker processes (default SERVER_WORKERS).')
+@click.option('--threads', default=None, type=int, help='Threads per worker (default SERVER_THREADS).')
+def serve_command(host, port, workers, threads):
+    """Run the API under gunicorn with preloaded, multi-threaded workers."""
+    run_production_server(host, port, workers, threads)
 
 if __name__ == '__main__':
+    create_app({'SCHEDULER_ENABLED': True})
+    prepare_database()
     app.run(debug=True, port=5000, threaded=True)
\ No newline at end of file
@@ -0,0 +1,529 @@
+"""Load and latency benchmark for the FinGuard /api endpoints.
+
+Seeds a scratch database with users, sessions and OTP rows, drives the Flask
+app with concurrent clients and reports per-endpoint latency percentiles,
+throughput and connection-pool wait time. Results are written as JSON and can
+be compared against an earlier run:
+
+    python benchmark.py --users 100000 --sessions 1000000 --output run.json
+    python benchmark.py --baseline run.json --output new.json
+
+With --fraud-users N it also seeds transaction histories for N users and
+reports the per-user cost of fraud scoring, both online and in the pooled
+nightly batch.
+
+With --shards N the seeded users are spread over N shard files, and with
+--shard-scaling 1,2,4,8 it reports ledger write throughput at each shard
+count under the same concurrent load. --provision N bulk-creates N accounts
+through the provisioning path and reports users per second.
+
+Outbound SMTP is stubbed, so forgot-password measures the enqueue path only.
+"""
+import argparse
+import datetime
+import http.client
+import json
+import logging
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+PASSWORD = 'Benchmark-Pass-123!'
+SEED_BATCH = 10000
+
+ENDPOINTS = ['health', 'login', 'signup', 'user', 'logout',
+             'forgot_password', 'verify_otp', 'reset_password']
+
+class StubSMTP:
+    """Stands in for smtplib.SMTP; accepts and drops every message."""
+
+    def send_message(self, msg):
+        pass
+
+    def quit(self):
+        pass
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def seed_database(finguard, users, sessions, otps, rounds):
+    """Insert synthetic rows in large executemany batches.
+
+    Every seeded user shares one precomputed hash, since hashing millions of
+    passwords would dominate setup time.
+    """
+    hashed = finguard._hash_password(PASSWORD, rounds)
+    now = finguard.epoch_now()
+    started = time.perf_counter()
+    user_ids = [str(uuid.uuid4()) for _ in range(users)]
+
+    def insert(sql, owned_rows):
+        # Each (user_id, row) goes to its user's shard; the directory lives in DATABASE
+        shards = {}
+        for user_id, row in owned_rows:
+            shards.setdefault(finguard.shard_router.database(user_id), []).append(row)
+        for database, shard_rows in shards.items():
+            with finguard.get_db(write=True, database=database) as conn:
+                conn.executemany(sql, shard_rows)
+
+    for start in range(0, users, SEED_BATCH):
+        batch = range(start, min(users, start + SEED_BATCH))
+        with finguard.get_db(write=True) as conn:
+            conn.executemany("INSERT INTO user_directory (email, user_id) VALUES (?, ?)",
+                             [(f'bench{i}@example.com', user_ids[i]) for i in batch])
+        insert("INSERT INTO users (id, name, email, password) VALUES (?, ?, ?, ?)",
+               [(user_ids[i], (user_ids[i], f'Bench User {i}', f'bench{i}@example.com', hashed))
+                for i in batch])
+
+    for start in range(0, sessions, SEED_BATCH):
+        insert("INSERT INTO sessions (user_id, token, expires_at) VALUES (?, ?, ?)",
+               [(user_ids[i % users], (user_ids[i % users], uuid.uuid4().hex, now + (3600 if i % 2 else -3600)))
+                for i in range(start, min(sessions, start + SEED_BATCH))])
+
+    for start in range(0, otps, SEED_BATCH):
+        insert("INSERT INTO password_reset_tokens (email, token, expires_at) VALUES (?, ?, ?)",
+               [(user_ids[i % users], (f'bench{i % users}@example.com', f'{i:06X}'[-6:], now - 60))
+                for i in range(start, min(otps, start + SEED_BATCH))])
+
+    return time.perf_counter() - started
+
+def seed_transactions(finguard, users, per_user):
+    """Give the first `users` seeded users `per_user` transactions over the last 90 days."""
+    now = finguard.epoch_now()
+    span = 90 * 86400
+    merchants = [f'Merchant {i}' for i in range(40)]
+    with finguard.get_db() as conn:
+        user_ids = [row[0] for row in conn.execute("SELECT user_id FROM user_directory LIMIT ?", (users,))]
+    for offset, user_id in enumerate(user_ids):
+        with finguard.get_db(write=True, user_id=user_id) as conn:
+            conn.executemany("""INSERT INTO transactions
+                                (user_id, posted_at, amount_cents, merchant, created_at)
+                                VALUES (?, ?, ?, ?, ?)""",
+                             [(user_id, now - span + (i * span) // per_user,
+                               -(1000 + (i * 7919 + offset) % 9000), merchants[(i * 31 + offset) % len(merchants)], now)
+                              for i in range(per_user)])
+    return user_ids
+
+def run_fraud(finguard, user_ids, per_user):
+    """Per-user scoring cost online (one user on this thread) and in the pooled batch."""
+    params = finguard.fraud_params()
+    since = finguard.epoch_now() - finguard.app.config['FRAUD_BATCH_LOOKBACK_DAYS'] * 86400
+    latencies = []
+    for user_id in user_ids:
+        with finguard.get_db(user_id=user_id) as conn:
+            started = time.perf_counter()
+            finguard.score_user(conn, user_id, since, params)
+            latencies.append(time.perf_counter() - started)
+    latencies.sort()
+
+    run = finguard.run_fraud_batch(since, user_ids)
+    to_ms = 1000.0
+    return {
+        'users': len(user_ids),
+        'transactions_per_user': per_user,
+        'workers': finguard.app.config['FRAUD_WORKERS'],
+        'online_p50_ms': percentile(latencies, 50) * to_ms,
+        'online_p95_ms': percentile(latencies, 95) * to_ms,
+        'batch_seconds': run['duration_seconds'],
+        'batch_ms_per_user': run['duration_seconds'] / len(user_ids) * to_ms if user_ids else 0.0,
+        'batch_users_per_second': len(user_ids) / run['duration_seconds'] if run['duration_seconds'] else 0.0,
+        'alerts': run['alerts'],
+    }
+
+def run_provision(finguard, count):
+    """Bulk-provision `count` fresh accounts and report users per second."""
+    run_id = uuid.uuid4().hex[:8]
+    records = ((i + 1, {'name': f'Provisioned {i}', 'email': f'provision-{run_id}-{i}@example.com',
+                        'password': PASSWORD}) for i in range(count))
+    started = time.perf_counter()
+    result = finguard.provision_users(records)
+    elapsed = time.perf_counter() - started
+    return {
+        'users': count,
+        'created': result['created'],
+        'failed': result['failed'],
+        'workers': finguard.app.config['PROVISION_WORKERS'],
+        'batch_size': finguard.app.config['PROVISION_BATCH_SIZE'],
+        'seconds': elapsed,
+        'users_per_second': result['created'] / elapsed if elapsed else 0.0,
+    }
+
+def run_shard_scaling(finguard, counts, writers, seconds, users):
+    """Ledger write throughput with the same load spread over 1..N shard files.
+
+    Each count gets a fresh DATABASE plus that many shard files; `writers`
+    threads then insert one transaction at a time for random users, each a
+    write transaction on the user's shard, for `seconds`.
+    """
+    config = finguard.app.config
+    saved = config['DATABASE'], config['DATABASE_SHARDS']
+    results = []
+    # Buffered audit events belong to the endpoint run's database
+    finguard.audit_log.flush()
+    try:
+        for count in counts:
+            workdir = tempfile.mkdtemp(prefix='finguard-shards-')
+            config['DATABASE'] = os.path.join(workdir, 'main.db')
+            config['DATABASE_SHARDS'] = [os.path.join(workdir, f'shard{i}.db') for i in range(count)]
+            finguard.init_db()
+            finguard.reshard(config['DATABASE_SHARDS'])
+
+            user_ids = [str(uuid.uuid4()) for _ in range(users)]
+            for database, group in finguard.shard_router.group(user_ids).items():
+                with finguard.get_db(write=True, database=database) as conn:
+                    conn.executemany("INSERT INTO users (id, name, email, password) VALUES (?, ?, ?, '')",
+                                     [(user_id, 'Shard Bench', f'{user_id}@example.com') for user_id in group])
+
+            row = (finguard.epoch_now(), -1250, 'USD', 'bench', 'uncategorized', 'Merchant')
+            deadline = time.perf_counter() + seconds
+            latencies = [[] for _ in range(writers)]
+
+            def write(slot):
+                i = slot
+                while time.perf_counter() < deadline:
+                    user_id = user_ids[(i * 7919) % users]
+                    started = time.perf_counter()
+                    with finguard.get_db(write=True, user_id=user_id) as conn:
+                        finguard.insert_transactions(conn, user_id, [row])
+                    finguard.invalidate_cached_users([user_id])
+                    latencies[slot].append(time.perf_counter() - started)
+                    i += writers
+
+            started = time.perf_counter()
+            threads = [threading.Thread(target=write, args=(slot,)) for slot in range(writers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+
+            merged = sorted(value for values in latencies for value in values)
+            results.append({
+                'shards': count,
+                'writers': writers,
+                'writes': len(merged),
+                'writes_per_second': len(merged) / elapsed,
+                'p50_ms': percentile(merged, 50) * 1000.0,
+                'p95_ms': percentile(merged, 95) * 1000.0,
+            })
+    finally:
+        config['DATABASE'], config['DATABASE_SHARDS'] = saved
+        finguard.shard_router.reload()
+    return results
+
+class InProcessClient:
+    def __init__(self, app):
+        self._client = app.test_client()
+
+    def request(self, method, path, body=None, token=None):
+        headers = {'Authorization': f'Bearer {token}'} if token else {}
+        response = self._client.open(path, method=method, json=body, headers=headers)
+        return response.status_code
+
+class SocketClient:
+    """One keep-alive HTTP connection per benchmark thread."""
+
+    def __init__(self, host, port):
+        self._host = host
+        self._port = port
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(self._host, self._port, timeout=30)
+        return conn
+
+    def request(self, method, path, body=None, token=None):
+        headers = {'Content-Type': 'application/json'}
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
+        payload = json.dumps(body) if body is not None else None
+        try:
+            conn = self._connection()
+            conn.request(method, path, body=payload, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            return response.status
+        except (http.client.HTTPException, OSError):
+            self._local.conn = None
+            raise
+
+def start_socket_server(app):
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def build_scenarios(finguard, users):
+    """Return endpoint -> (prepare(n) -> list of args, call(client, args) -> status)."""
+    config = finguard.app.config
+    counter = iter(range(10 ** 12))
+    counter_lock = threading.Lock()
+    run_id = uuid.uuid4().hex[:8]
+
+    def next_index():
+        with counter_lock:
+            return next(counter)
+
+    def user_email(i):
+        return f'bench{i % max(1, users)}@example.com'
+
+    def tokens(n):
+        with finguard.get_db() as conn:
+            ids = [row[0] for row in conn.execute("SELECT user_id FROM user_directory LIMIT ?", (min(n, 1000),))]
+        return [finguard.generate_token(ids[i % len(ids)]) for i in range(n)]
+
+    def otp_codes(n):
+        # Fresh single-use codes, inserted before the timed run
+        rows = [(user_email(i), f'{i:06X}'[-6:]) for i in range(n)]
+        store = finguard.get_otp_store()
+        for email, code in rows:
+            store.add(email, code, config['OTP_TTL_SECONDS'])
+        return rows
+
+    def reset_tokens(n):
+        import jwt
+        exp = datetime.datetime.utcnow() + datetime.timedelta(minutes=15)
+        return [jwt.encode({'email': user_email(i), 'purpose': 'password_reset', 'exp': exp},
+                           config['SECRET_KEY'], algorithm='HS256') for i in range(n)]
+
+    return {
+        'health': (lambda n: [None] * n,
+                   lambda client, _: client.request('GET', '/api/health')),
+        'login': (lambda n: [user_email(i) for i in range(n)],
+                  lambda client, email: client.request('POST', '/api/login',
+                                                       {'email': email, 'password': PASSWORD})),
+        'signup': (lambda n: [None] * n,
+                   lambda client, _: client.request('POST', '/api/signup', {
+                       'name': 'Bench Signup',
+                       'email': f'signup-{run_id}-{next_index()}@example.com',
+                       'password': PASSWORD})),
+        'user': (tokens,
+                 lambda client, token: client.request('GET', '/api/user', token=token)),
+        'logout': (tokens,
+                   lambda client, token: client.request('POST', '/api/logout', {}, token=token)),
+        'forgot_password': (lambda n: [user_email(i) for i in range(n)],
+                            lambda client, email: client.request('POST', '/api/forgot-password',
+                                                                 {'email': email})),
+        'verify_otp': (otp_codes,
+                       lambda client, row: client.request('POST', '/api/verify-otp',
+                                                          {'email': row[0], 'otp': row[1]})),
+        'reset_password': (reset_tokens,
+                           lambda client, token: client.request('POST', '/api/reset-password',
+                                                                {'token': token, 'newPassword': PASSWORD})),
+    }
+
+def run_endpoint(finguard, client, prepare, call, requests, concurrency):
+    args = prepare(requests)
+    latencies = []
+    statuses = {}
+    errors = 0
+    rejected = 0
+    lock = threading.Lock()
+    pool_before = finguard.get_pool().stats()
+
+    def one(arg):
+        nonlocal errors, rejected
+        started = time.perf_counter()
+        try:
+            status = call(client, arg)
+        except Exception:
+            status = 'error'
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if status == 503:
+                # Shed by admission control rather than failed
+                rejected += 1
+            elif status == 'error' or (isinstance(status, int) and status >= 500):
+                errors += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, args))
+    wall = time.perf_counter() - started
+    pool_after = finguard.get_pool().stats()
+
+    latencies.sort()
+    to_ms = 1000.0
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rejected': rejected,
+        'status_counts': statuses,
+        'wall_seconds': wall,
+        'requests_per_second': len(latencies) / wall if wall else 0.0,
+        'mean_ms': sum(latencies) / len(latencies) * to_ms if latencies else 0.0,
+        'p50_ms': percentile(latencies, 50) * to_ms,
+        'p95_ms': percentile(latencies, 95) * to_ms,
+        'p99_ms': percentile(latencies, 99) * to_ms,
+        'max_ms': latencies[-1] * to_ms if latencies else 0.0,
+        # In-process only: a remote server's pool is not visible from here
+        'read_wait_ms': (pool_after['read_wait_seconds'] - pool_before['read_wait_seconds']) * to_ms,
+        'write_wait_ms': (pool_after['write_wait_seconds'] - pool_before['write_wait_seconds']) * to_ms,
+    }
+
+def compare(results, baseline, max_regression):
+    """Print per-endpoint deltas; return the endpoints that regressed."""
+    regressed = []
+    print(f"\n{'endpoint':<16}{'p95 ms':>12}{'base':>10}{'delta':>9}{'req/s':>12}{'base':>10}{'delta':>9}")
+    for name, current in results['endpoints'].items():
+        previous = baseline.get('endpoints', {}).get(name)
+        if not previous:
+            continue
+        p95_delta = (current['p95_ms'] / previous['p95_ms'] - 1) * 100 if previous['p95_ms'] else 0.0
+        rps_delta = (current['requests_per_second'] / previous['requests_per_second'] - 1) * 100 \
+            if previous['requests_per_second'] else 0.0
+        print(f"{name:<16}{current['p95_ms']:>12.2f}{previous['p95_ms']:>10.2f}{p95_delta:>8.1f}%"
+              f"{current['requests_per_second']:>12.1f}{previous['requests_per_second']:>10.1f}{rps_delta:>8.1f}%")
+        if p95_delta > max_regression or rps_delta < -max_regression:
+            regressed.append(name)
+    return regressed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--sessions', type=int, default=10000)
+    parser.add_argument('--otps', type=int, default=10000, help='expired OTP rows to seed as history')
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS))
+    parser.add_argument('--mode', choices=['inprocess', 'socket'], default='inprocess')
+    parser.add_argument('--bcrypt-rounds', type=int, default=None,
+                        help='override BCRYPT_ROUNDS (seeded hashes use the same cost)')
+    parser.add_argument('--rate-limits', action='store_true',
+                        help='keep per-IP/email rate limiting on (all clients share one IP)')
+    parser.add_argument('--fraud-users', type=int, default=0,
+                        help='also measure fraud scoring for this many seeded users')
+    parser.add_argument('--fraud-transactions', type=int, default=500,
+                        help='transactions seeded per fraud-scored user')
+    parser.add_argument('--provision', type=int, default=0,
+                        help='also bulk-provision this many accounts and report users/s')
+    parser.add_argument('--shards', type=int, default=0,
+                        help='spread the seeded users over this many shard files')
+    parser.add_argument('--shard-scaling', default=None,
+                        help='also measure write throughput at these shard counts, e.g. 1,2,4,8')
+    parser.add_argument('--shard-writers', type=int, default=16,
+                        help='concurrent writer threads for --shard-scaling')
+    parser.add_argument('--shard-seconds', type=float, default=5.0,
+                        help='seconds of writes per shard count for --shard-scaling')
+    parser.add_argument('--database', default=None, help='database file (default: a new temp file)')
+    parser.add_argument('--output', default=None, help='write results JSON here')
+    parser.add_argument('--baseline', default=None, help='compare against an earlier results JSON')
+    parser.add_argument('--max-regression', type=float, default=20.0,
+                        help='percent p95/throughput change treated as a regression')
+    args = parser.parse_args(argv)
+
+    workdir = None
+    if args.database is None:
+        workdir = tempfile.mkdtemp(prefix='finguard-bench-')
+        args.database = os.path.join(workdir, 'bench.db')
+    os.environ['DATABASE'] = args.database
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as finguard
+
+    finguard.open_smtp_connection = StubSMTP
+    finguard.create_app({'RATE_LIMIT_ENABLED': args.rate_limits})
+    if args.bcrypt_rounds:
+        finguard.app.config['BCRYPT_ROUNDS'] = args.bcrypt_rounds
+    finguard.prepare_database()
+    if args.shards:
+        finguard.reshard([f'{args.database}.shard{i}' for i in range(args.shards)])
+    rounds = finguard.app.config['BCRYPT_ROUNDS']
+
+    seed_seconds = seed_database(finguard, args.users, args.sessions, args.otps, rounds)
+    print(f"Seeded {args.users} users, {args.sessions} sessions, {args.otps} OTPs in {seed_seconds:.1f}s")
+
+    server = None
+    if args.mode == 'socket':
+        server = start_socket_server(finguard.app)
+        client = SocketClient('127.0.0.1', server.server_port)
+    else:
+        client = InProcessClient(finguard.app)
+
+    scenarios = build_scenarios(finguard, args.users)
+    results = {
+        'meta': {
+            'timestamp': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'cpus': os.cpu_count(),
+            'mode': args.mode,
+            'users': args.users,
+            'sessions': args.sessions,
+            'otps': args.otps,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'bcrypt_rounds': rounds,
+            'rate_limits': args.rate_limits,
+            'shards': args.shards,
+            'seed_seconds': seed_seconds,
+        },
+        'endpoints': {},
+    }
+
+    print(f"\n{'endpoint':<16}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+          f"{'errors':>8}{'503s':>8}{'wait ms':>10}")
+    for name in [n.strip() for n in args.endpoints.split(',') if n.strip()]:
+        prepare, call = scenarios[name]
+        stats = run_endpoint(finguard, client, prepare, call, args.requests, args.concurrency)
+        results['endpoints'][name] = stats
+        print(f"{name:<16}{stats['requests_per_second']:>10.1f}{stats['p50_ms']:>10.2f}"
+              f"{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}{stats['errors']:>8}{stats['rejected']:>8}"
+              f"{stats['read_wait_ms'] + stats['write_wait_ms']:>10.1f}")
+
+    if server is not None:
+        server.shutdown()
+
+    if args.fraud_users:
+        user_ids = seed_transactions(finguard, min(args.fraud_users, args.users), args.fraud_transactions)
+        fraud = results['fraud'] = run_fraud(finguard, user_ids, args.fraud_transactions)
+        print(f"\nfraud scoring: {fraud['users']} users x {fraud['transactions_per_user']} transactions, "
+              f"online p50 {fraud['online_p50_ms']:.2f} ms p95 {fraud['online_p95_ms']:.2f} ms per user, "
+              f"batch {fraud['batch_ms_per_user']:.2f} ms per user ({fraud['batch_users_per_second']:.0f} users/s "
+              f"on {fraud['workers']} workers)")
+
+    if args.provision:
+        provision = results['provision'] = run_provision(finguard, args.provision)
+        print(f"\nbulk provisioning: {provision['created']} of {provision['users']} users in "
+              f"{provision['seconds']:.2f}s ({provision['users_per_second']:.0f} users/s on "
+              f"{provision['workers']} workers, batches of {provision['batch_size']})")
+
+    if args.shard_scaling:
+        counts = [int(n) for n in args.shard_scaling.split(',') if n.strip()]
+        scaling = results['shard_scaling'] = run_shard_scaling(
+            finguard, counts, args.shard_writers, args.shard_seconds, max(1, args.users))
+        print(f"\n{'shards':<8}{'writes/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'speedup':>10}")
+        for run in scaling:
+            print(f"{run['shards']:<8}{run['writes_per_second']:>10.0f}{run['p50_ms']:>10.2f}{run['p95_ms']:>10.2f}"
+                  f"{run['writes_per_second'] / scaling[0]['writes_per_second']:>9.2f}x")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressed = compare(results, baseline, args.max_regression)
+        if regressed:
+            print(f"\nRegressed beyond {args.max_regression:.0f}%: {', '.join(regressed)}")
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,41 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as finguard
+
+
+@pytest.fixture
+def database(tmp_path):
+    """Point the app at a fresh database file for one test."""
+    path = str(tmp_path / 'finguard.db')
+    saved = {key: finguard.app.config[key] for key in ('DATABASE', 'DATABASE_SHARDS')}
+    finguard.close_pools()
+    finguard.create_app({'DATABASE': path, 'DATABASE_SHARDS': []})
+    finguard.shard_router.reload()
+    yield path
+    finguard.close_pools()
+    finguard.app.config.update(saved)
+    finguard.shard_router.reload()
+
+
+@pytest.fixture
+def migrated_database(database):
+    """A fresh database at the current schema version."""
+    with finguard.get_db(write=True) as conn:
+        finguard.migrate(conn)
+    return database
+
+
+@pytest.fixture
+def client(migrated_database, monkeypatch):
+    """A test client for a signed-up user, without the background services."""
+    monkeypatch.setattr(finguard, '_services_started', True)
+    monkeypatch.setitem(finguard.app.config, 'SECRET_KEY', 'test-secret-key-' + 'x' * 32)
+    finguard.create_user('u1', 'Ada', 'ada@example.com', 'x')
+    client = finguard.app.test_client()
+    client.environ_base['HTTP_AUTHORIZATION'] = 'Bearer ' + finguard.generate_token('u1')
+    return client
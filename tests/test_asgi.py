@@ -0,0 +1,70 @@
+import json
+import socket
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import uvicorn
+
+import app as finguard
+
+
+@pytest.fixture
+def serve():
+    """Run an ASGI app under uvicorn in a thread; yields a function returning its base URL."""
+    servers = []
+
+    def start(asgi_app):
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        server = uvicorn.Server(uvicorn.Config(asgi_app, host='127.0.0.1', port=port, log_level='warning'))
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        deadline = time.monotonic() + 5
+        while not server.started and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert server.started
+        servers.append((server, thread))
+        return f'http://127.0.0.1:{port}'
+
+    yield start
+    for server, thread in servers:
+        server.should_exit = True
+        thread.join(5)
+
+
+def test_requests_run_concurrently(serve):
+    def slow_app(environ, start_response):
+        time.sleep(0.3)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [environ['PATH_INFO'].encode('utf-8')]
+
+    with ThreadPoolExecutor(4) as executor:
+        url = serve(finguard.PooledAsgiAdapter(slow_app, executor))
+        started = time.perf_counter()
+        with ThreadPoolExecutor(4) as clients:
+            bodies = list(clients.map(lambda i: urllib.request.urlopen(f'{url}/{i}').read(), range(4)))
+        elapsed = time.perf_counter() - started
+
+    assert bodies == [b'/0', b'/1', b'/2', b'/3']
+    assert elapsed < 0.9, elapsed
+
+
+def test_create_asgi_app_serves_the_api(client, serve):
+    url = serve(finguard.create_asgi_app())
+    authorization = client.environ_base['HTTP_AUTHORIZATION']
+
+    with urllib.request.urlopen(urllib.request.Request(f'{url}/api/user',
+                                                      headers={'Authorization': authorization})) as response:
+        assert response.status == 200
+        assert json.load(response)['data']['user']['email'] == 'ada@example.com'
+
+    request = urllib.request.Request(f'{url}/api/transactions', method='POST',
+                                     data=json.dumps({'transactions': [{'postedAt': 1700000000, 'amount': '-4.50'}]}).encode(),
+                                     headers={'Authorization': authorization, 'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        assert response.status == 201
+        assert json.load(response)['data']['inserted'] == 1
@@ -0,0 +1,50 @@
+import sqlite3
+
+import app as finguard
+
+
+def test_requeue_on_full_buffer_counts_dropped_events(migrated_database, monkeypatch):
+    monkeypatch.setitem(finguard.app.config, 'AUDIT_BUFFER_SIZE', 4)
+    monkeypatch.setitem(finguard.app.config, 'AUDIT_BATCH_SIZE', 2)
+    audit = finguard.AuditLog()
+    for index in range(4):
+        audit.record('login', email=f'user{index}@example.com')
+
+    get_db = finguard.get_db
+
+    def locked(*args, **kwargs):
+        # Requests keep recording while the write fails
+        audit.record('login', email='user4@example.com')
+        audit.record('login', email='user5@example.com')
+        raise sqlite3.OperationalError('database is locked')
+
+    monkeypatch.setattr(finguard, 'get_db', locked)
+    audit.flush()
+    monkeypatch.setattr(finguard, 'get_db', get_db)
+
+    # The failed batch (the two oldest events) no longer fits and is counted
+    assert audit.stats()['dropped'] == 2
+    audit.flush()
+    emails = [row['email'] for row in reversed(audit.query())]
+    assert emails == [f'user{index}@example.com' for index in range(2, 6)]
+    assert audit.stats()['written'] == 4
+
+
+def test_requeue_with_room_keeps_every_event(migrated_database, monkeypatch):
+    monkeypatch.setitem(finguard.app.config, 'AUDIT_BATCH_SIZE', 2)
+    audit = finguard.AuditLog()
+    for index in range(3):
+        audit.record('login', email=f'user{index}@example.com')
+
+    get_db = finguard.get_db
+
+    def locked(*args, **kwargs):
+        raise sqlite3.OperationalError('database is locked')
+
+    monkeypatch.setattr(finguard, 'get_db', locked)
+    audit.flush()
+    monkeypatch.setattr(finguard, 'get_db', get_db)
+
+    audit.flush()
+    assert [row['email'] for row in reversed(audit.query())] == [f'user{index}@example.com' for index in range(3)]
+    assert audit.stats()['dropped'] == 0
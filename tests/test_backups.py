@@ -0,0 +1,35 @@
+import json
+import os
+
+import app as finguard
+
+
+def test_restore_uses_absolute_paths(database, tmp_path, monkeypatch):
+    deployment = tmp_path / 'deployment'
+    deployment.mkdir()
+    monkeypatch.chdir(deployment)
+    monkeypatch.setitem(finguard.app.config, 'DATABASE', 'finguard.db')
+    monkeypatch.setitem(finguard.app.config, 'BACKUP_DIR', None)
+    monkeypatch.setitem(finguard.app.config, 'BACKUP_STEP_PAUSE', 0)
+    with finguard.get_db(write=True) as conn:
+        finguard.migrate(conn)
+    finguard.create_user('u1', 'Ada', 'ada@example.com', 'x')
+
+    run = finguard.run_backup()
+    assert run['error'] is None
+    snapshot = os.path.abspath(run['snapshot'])
+    with open(os.path.join(snapshot, 'manifest.json')) as f:
+        entry = json.load(f)['databases'][0]
+    assert entry['database'] == 'finguard.db'
+    assert entry['path'] == str(deployment / 'finguard.db')
+
+    finguard.create_user('u2', 'Grace', 'grace@example.com', 'x')
+    finguard.close_pools()
+    monkeypatch.chdir(tmp_path)
+    assert finguard.restore_snapshot(snapshot) == [str(deployment / 'finguard.db')]
+    assert not (tmp_path / 'finguard.db').exists()
+    assert (deployment / 'finguard.db.pre-restore').exists()
+
+    monkeypatch.chdir(deployment)
+    assert finguard.lookup_user_id('ada@example.com') == 'u1'
+    assert finguard.lookup_user_id('grace@example.com') is None
@@ -0,0 +1,35 @@
+import pytest
+
+import app as finguard
+
+
+@pytest.fixture
+def orphan(migrated_database):
+    finguard.create_user('u1', 'Ada', 'ada@example.com', 'x')
+    # A signup that died after claiming its email
+    with finguard.get_db(write=True) as conn:
+        conn.execute("INSERT INTO user_directory (email, user_id) VALUES ('grace@example.com', 'u2')")
+    return 'grace@example.com', 'u2'
+
+
+def test_repair_releases_only_orphaned_claims(orphan):
+    with pytest.raises(finguard.sqlite3.IntegrityError):
+        finguard.create_user('u3', 'Grace', 'grace@example.com', 'x')
+
+    assert finguard.repair_user_directory(grace=0, dry_run=True) == [orphan]
+    assert finguard.lookup_user_id('grace@example.com') == 'u2'
+
+    assert finguard.repair_user_directory(grace=0) == [orphan]
+    assert finguard.lookup_user_id('grace@example.com') is None
+    assert finguard.lookup_user_id('ada@example.com') == 'u1'
+
+    finguard.create_user('u3', 'Grace', 'grace@example.com', 'x')
+    assert finguard.lookup_user_id('grace@example.com') == 'u3'
+    assert finguard.repair_user_directory(grace=0) == []
+
+
+def test_repair_directory_command(orphan):
+    result = finguard.app.test_cli_runner().invoke(args=['repair-directory', '--grace', '0'])
+    assert result.exit_code == 0, result.output
+    assert 'grace@example.com: u2' in result.output
+    assert '1 orphaned claims released' in result.output
@@ -0,0 +1,28 @@
+import gzip
+
+import pytest
+
+import app as finguard
+
+
+@pytest.fixture
+def ledger(client):
+    with finguard.get_db(write=True, user_id='u1') as conn:
+        conn.execute("""INSERT INTO transactions (user_id, posted_at, amount_cents, description, created_at)
+                        VALUES ('u1', 1700000000, -450, 'Coffee', 1700000000)""")
+    return client
+
+
+@pytest.mark.parametrize('accept, gzipped', [
+    ('gzip', True),
+    ('gzip, deflate', True),
+    ('gzip;q=0, identity', False),
+    ('*;q=0.5, gzip;q=0', False),
+    ('identity', False),
+])
+def test_export_honours_gzip_quality(ledger, accept, gzipped):
+    response = ledger.get('/api/transactions/export', headers={'Accept-Encoding': accept})
+    assert response.status_code == 200
+    assert (response.headers.get('Content-Encoding') == 'gzip') is gzipped
+    body = gzip.decompress(response.data) if gzipped else response.data
+    assert b'Coffee' in body
@@ -0,0 +1,68 @@
+import pytest
+
+import app as finguard
+
+
+@pytest.fixture
+def user(migrated_database):
+    finguard.create_user('u1', 'Ada', 'ada@example.com', 'x')
+    return 'u1'
+
+
+def add_burst(user_id, posted_at, count=10):
+    # More than FRAUD_VELOCITY_LIMIT payments in a few minutes trips the velocity signal
+    rows = [(posted_at + 60 * i, -1000, 'USD', 'Card', 'shopping', None) for i in range(count)]
+    with finguard.get_db(write=True, user_id=user_id) as conn:
+        finguard.insert_transactions(conn, user_id, rows)
+    return posted_at
+
+
+def row_version(user_id):
+    with finguard.get_db(user_id=user_id) as conn:
+        return conn.execute("SELECT row_version FROM users WHERE id=?", (user_id,)).fetchone()[0]
+
+
+def alert_count(user_id):
+    with finguard.get_db(user_id=user_id) as conn:
+        return conn.execute("SELECT COUNT(*) FROM transaction_alerts WHERE user_id=?", (user_id,)).fetchone()[0]
+
+
+def test_rescoring_unchanged_alerts_keeps_row_version(user):
+    since = add_burst(user, finguard.epoch_now() - 3600)
+    assert finguard.score_user_online(user, since) > 0
+    version = row_version(user)
+
+    finguard.score_user_online(user, since)
+    assert row_version(user) == version
+    with finguard.get_db(write=True, user_id=user) as conn:
+        assert finguard.save_alerts(conn, [(user, since)], []) == [user]
+    assert row_version(user) == version + 1
+
+
+def test_backdated_rows_are_left_to_the_batch(user):
+    since = add_burst(user, finguard.epoch_now() - 30 * 86400)
+    assert finguard.score_user_online(user, since) == 0
+    assert alert_count(user) == 0
+
+    run = finguard.run_fraud_batch()
+    assert run['users'] == 1
+    assert alert_count(user) == run['alerts'] > 0
+
+
+def test_cached_users_are_dropped_after_the_write_commits(client, monkeypatch):
+    # A row re-cached between the drop and the commit would keep serving the old ETag
+    seen = []
+    invalidate_user = finguard.UserCache.invalidate_user
+
+    def record(cache, user_id):
+        seen.append(row_version(user_id))
+        invalidate_user(cache, user_id)
+
+    monkeypatch.setattr(finguard.UserCache, 'invalidate_user', record)
+    now = finguard.epoch_now()
+    response = client.post('/api/transactions', json={'transactions': [
+        {'postedAt': now - 60 * i, 'amount': '-10.00', 'description': 'Card'} for i in range(10)]})
+    assert response.status_code == 201
+    assert seen and seen == sorted(seen)
+    assert seen[-1] == row_version('u1')
+    assert seen[0] == 2
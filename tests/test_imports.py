@@ -0,0 +1,61 @@
+import tracemalloc
+
+import app as finguard
+
+
+def start_import(user_id):
+    now = finguard.epoch_now()
+    with finguard.get_db(write=True, user_id=user_id) as conn:
+        return conn.execute("""INSERT INTO statement_imports (user_id, format, started_at, updated_at)
+                               VALUES (?, 'csv', ?, ?)""", (user_id, now, now)).lastrowid
+
+
+def run_import(user_id, lines):
+    records = [(number, {'postedAt': date, 'amount': amount, 'description': description})
+               for number, (date, amount, description) in enumerate(lines, 2)]
+    import_id = start_import(user_id)
+    errors = finguard.import_statement(user_id, import_id, records, finguard.csv_date_parser('%Y-%m-%d'))
+    assert errors == []
+    return finguard.get_import(user_id, import_id)
+
+
+def test_unsorted_identical_lines_are_kept(migrated_database):
+    finguard.create_user('u1', 'Ada', 'ada@example.com', 'x')
+    lines = [
+        ('2024-03-01', '-4.50', 'Coffee'),
+        ('2024-03-02', '-12.00', 'Lunch'),
+        ('2024-03-01', '-4.50', 'Coffee'),
+    ]
+
+    first = run_import('u1', lines)
+    assert (first['rows_inserted'], first['rows_duplicate']) == (3, 0)
+
+    # Re-uploading the same statement, in another order, inserts nothing
+    again = run_import('u1', list(reversed(lines)))
+    assert (again['rows_inserted'], again['rows_duplicate']) == (0, 3)
+
+
+def import_peak_memory(user_id, rows):
+    def records():
+        # Reference-less lines, as in most CSV statements
+        for number in range(rows):
+            yield number + 2, {'postedAt': str(1_600_000_000 + number * 60),
+                               'amount': f'-{number % 5000 + 1}.00', 'description': 'Card payment'}
+
+    import_id = start_import(user_id)
+    tracemalloc.start()
+    try:
+        finguard.import_statement(user_id, import_id, records(), finguard.csv_date_parser())
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_import_memory_is_flat(migrated_database, monkeypatch):
+    monkeypatch.setattr(finguard, 'score_user_online', lambda user_id, since: 0)
+    finguard.create_user('u1', 'Ada', 'ada@example.com', 'x')
+    finguard.create_user('u2', 'Grace', 'grace@example.com', 'x')
+
+    small = import_peak_memory('u1', 2_000)
+    large = import_peak_memory('u2', 20_000)
+    assert large < small * 1.5, (small, large)
@@ -0,0 +1,162 @@
+import socket
+import sqlite3
+import threading
+import time
+
+import pytest
+from aiosmtpd.controller import Controller
+
+import app as finguard
+
+
+class RecordingHandler:
+    def __init__(self):
+        self.messages = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope)
+        return '250 OK'
+
+
+@pytest.fixture
+def smtp_server(migrated_database):
+    handler = RecordingHandler()
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    controller = Controller(handler, hostname='127.0.0.1', port=port)
+    controller.start()
+    saved = {key: finguard.app.config[key] for key in
+             ('MAIL_SERVER', 'MAIL_PORT', 'MAIL_USE_TLS', 'MAIL_USERNAME', 'MAIL_PASSWORD', 'MAIL_POLL_INTERVAL')}
+    finguard.app.config.update({
+        'MAIL_SERVER': controller.hostname,
+        'MAIL_PORT': port,
+        'MAIL_USE_TLS': False,
+        'MAIL_USERNAME': 'alerts@example.com',
+        'MAIL_PASSWORD': '',
+        'MAIL_POLL_INTERVAL': 0.05,
+    })
+    yield handler
+    finguard.app.config.update(saved)
+    controller.stop()
+
+
+@pytest.fixture
+def dispatcher():
+    dispatcher = finguard.MailDispatcher()
+    yield dispatcher
+    dispatcher.stop()
+
+
+def enqueue(recipient='ada@example.com'):
+    with finguard.get_db(write=True) as conn:
+        finguard.enqueue_email(conn, recipient, 'Hello', '<p>Hi</p>')
+
+
+def outbox_statuses():
+    with finguard.get_db() as conn:
+        return [row['status'] for row in conn.execute("SELECT status FROM email_outbox ORDER BY id")]
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_dispatcher_delivers_outbox(smtp_server, dispatcher):
+    enqueue('ada@example.com')
+    enqueue('grace@example.com')
+    dispatcher.start()
+
+    assert wait_for(lambda: outbox_statuses() == ['sent', 'sent'])
+    assert sorted(envelope.rcpt_tos[0] for envelope in smtp_server.messages) == ['ada@example.com', 'grace@example.com']
+    assert all(envelope.mail_from == 'alerts@example.com' for envelope in smtp_server.messages)
+    assert dispatcher.stats()['sent'] == 2
+
+
+def test_dispatcher_survives_outbox_write_errors(smtp_server, dispatcher, monkeypatch):
+    enqueue()
+    calls = []
+
+    def locked(row, error):
+        calls.append(row['id'])
+        raise sqlite3.OperationalError('database is locked')
+
+    def refuse(msg):
+        raise ConnectionRefusedError('smtp down')
+
+    monkeypatch.setattr(dispatcher, '_send', refuse)
+    monkeypatch.setattr(dispatcher, '_record_failure', locked)
+    dispatcher.start()
+
+    # The failed bookkeeping requeues the row, and the thread keeps retrying it
+    assert wait_for(lambda: len(calls) >= 2)
+    assert dispatcher._thread.is_alive()
+    dispatcher.stop()
+    assert outbox_statuses() == ['pending']
+
+    monkeypatch.undo()
+    dispatcher.start()
+    assert wait_for(lambda: outbox_statuses() == ['sent'])
+
+
+def test_sender_is_separate_from_login(smtp_server, dispatcher, monkeypatch):
+    monkeypatch.setitem(finguard.app.config, 'MAIL_USERNAME', '')
+    monkeypatch.setitem(finguard.app.config, 'MAIL_SENDER', 'no-reply@example.com')
+    enqueue()
+    dispatcher.start()
+
+    assert wait_for(lambda: outbox_statuses() == ['sent'])
+    assert smtp_server.messages[0].mail_from == 'no-reply@example.com'
+
+
+def test_missing_sender_fails_the_message(smtp_server, dispatcher, monkeypatch):
+    monkeypatch.setitem(finguard.app.config, 'MAIL_USERNAME', '')
+    monkeypatch.setitem(finguard.app.config, 'MAIL_SENDER', '')
+    enqueue()
+    dispatcher.start()
+
+    def last_error():
+        with finguard.get_db() as conn:
+            return conn.execute("SELECT last_error FROM email_outbox").fetchone()[0]
+
+    assert wait_for(lambda: last_error() is not None)
+    assert 'MAIL_SENDER' in last_error()
+    assert smtp_server.messages == []
+
+
+def test_concurrent_dispatchers_never_claim_the_same_row(migrated_database, monkeypatch):
+    # Two pools on one file stand in for two worker processes
+    pools = [finguard.ConnectionPool(migrated_database) for _ in range(2)]
+    local = threading.local()
+
+    def get_db(write=False, user_id=None, database=None):
+        return local.pool.write() if write else local.pool.read()
+
+    monkeypatch.setattr(finguard, 'get_db', get_db)
+    dispatchers = [finguard.MailDispatcher() for _ in range(2)]
+    try:
+        for _ in range(200):
+            local.pool = pools[0]
+            enqueue()
+            barrier = threading.Barrier(2)
+            claimed = [None, None]
+
+            def claim(index):
+                local.pool = pools[index]
+                barrier.wait()
+                claimed[index] = dispatchers[index]._claim_batch()
+
+            threads = [threading.Thread(target=claim, args=(index,)) for index in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert len(claimed[0]) + len(claimed[1]) == 1
+    finally:
+        for pool in pools:
+            pool.close()
@@ -0,0 +1,79 @@
+import datetime
+import os
+import shutil
+import sqlite3
+
+import pytest
+
+import app as finguard
+
+BASELINE_DATABASE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'mavrick.db')
+
+
+@pytest.fixture
+def baseline_database(database):
+    """A copy of the database file shipped before migrations existed."""
+    shutil.copyfile(BASELINE_DATABASE, database)
+    return database
+
+
+def local_timestamp(epoch):
+    # The pre-migration code stored datetime.now() strings
+    return datetime.datetime.fromtimestamp(epoch).strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+def test_baseline_database_matches_pre_migration_schema(baseline_database):
+    conn = sqlite3.connect(baseline_database)
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(users)")]
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == 0
+    assert 'sessions' not in tables
+    assert 'avatar' in columns
+    conn.close()
+
+
+def test_migrates_baseline_database(baseline_database):
+    expires = 1_760_000_000
+    conn = sqlite3.connect(baseline_database)
+    conn.execute("INSERT INTO users (id, name, email, password, avatar) VALUES ('u1', 'Ada', 'ada@example.com', 'x', 'a.png')")
+    conn.execute("INSERT INTO password_reset_tokens (email, token, expires_at, used) VALUES (?, ?, ?, NULL)",
+                 ('ada@example.com', 'ABCDEF', local_timestamp(expires)))
+    conn.commit()
+    conn.close()
+
+    with finguard.get_db(write=True) as conn:
+        applied = finguard.migrate(conn)
+        assert [version for version, _ in applied] == [version for version, *_ in finguard.MIGRATIONS]
+        assert finguard.schema_version(conn) == finguard.MIGRATIONS[-1][0] == 13
+
+        token = conn.execute("SELECT expires_at, used FROM password_reset_tokens").fetchone()
+        assert tuple(token) == (expires, 0)
+        assert conn.execute("SELECT typeof(expires_at) FROM password_reset_tokens").fetchone()[0] == 'integer'
+        assert conn.execute("SELECT avatar FROM users WHERE id='u1'").fetchone()[0] == 'a.png'
+        assert [tuple(row) for row in conn.execute("SELECT email, user_id FROM user_directory")] == [('ada@example.com', 'u1')]
+        assert conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] == 0
+
+        # A second run is a no-op
+        assert finguard.migrate(conn) == []
+
+
+def test_auth_queries_use_their_indexes(baseline_database):
+    with finguard.get_db(write=True) as conn:
+        finguard.migrate(conn)
+    with finguard.get_db() as conn:
+        results = finguard.explain_auth_queries(conn)
+    assert len(results) == len(finguard.AUTH_QUERY_PLANS)
+    for sql, plan, uses_index in results:
+        assert uses_index, f"{sql} -> {plan}"
+
+
+def test_migrate_db_command_requeues_stale_claims(migrated_database):
+    with finguard.get_db(write=True) as conn:
+        finguard.enqueue_email(conn, 'ada@example.com', 'Hello', '<p>Hi</p>')
+        conn.execute("UPDATE email_outbox SET status='sending'")
+
+    result = finguard.app.test_cli_runner().invoke(args=['migrate-db'])
+    assert result.exit_code == 0, result.output
+    assert "Requeued 1 emails left in 'sending'" in result.output
+    with finguard.get_db() as conn:
+        assert conn.execute("SELECT status FROM email_outbox").fetchone()[0] == 'pending'
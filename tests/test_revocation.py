@@ -0,0 +1,40 @@
+import pytest
+
+import app as finguard
+
+
+@pytest.fixture
+def signed_in(client):
+    # The revocation filter is per process; start it from this test's database
+    finguard.revocations.load()
+    finguard.get_user_cache().clear()
+    return client
+
+
+def test_logout_rejects_the_token(signed_in):
+    assert signed_in.get('/api/user').status_code == 200
+    assert signed_in.post('/api/logout').status_code == 200
+
+    # Logout dropped the cached entry, so this decodes the token again
+    response = signed_in.get('/api/user')
+    assert response.status_code == 401
+    assert response.get_json()['message'] == 'Token has been revoked'
+
+
+def test_revocation_from_another_worker_beats_the_cache(signed_in):
+    assert signed_in.get('/api/user').status_code == 200
+    token = signed_in.environ_base['HTTP_AUTHORIZATION'][len('Bearer '):]
+    payload = finguard.jwt.decode(token, options={'verify_signature': False})
+
+    # Revoked elsewhere: this worker's cache still holds the token
+    finguard.revocations.revoke(payload['jti'], payload['exp'])
+    response = signed_in.get('/api/user')
+    assert response.status_code == 401
+    assert response.get_json()['message'] == 'Token has been revoked'
+
+
+def test_reload_keeps_revocations(signed_in):
+    finguard.revocations.revoke('jti-1', finguard.epoch_now() + 60)
+    finguard.revocations.load()
+    assert finguard.revocations.is_revoked('jti-1')
+    assert not finguard.revocations.is_revoked('jti-2')
@@ -0,0 +1,130 @@
+import os
+
+import pytest
+
+import app as finguard
+
+USERS = 60
+
+
+@pytest.fixture
+def ledgers(migrated_database):
+    """60 users with a few months of transactions each, all in DATABASE."""
+    start = finguard.epoch_now() - 120 * 86400
+    for n in range(USERS):
+        user_id = f'user-{n}'
+        finguard.create_user(user_id, f'User {n}', f'user{n}@example.com', 'x')
+        rows = [(start + 86400 * (n + 7 * i), -100 * (n + 1) - i, 'USD', f'Payment {i}',
+                 ('groceries', 'transport', 'rent')[i % 3], f'Merchant {i % 4}') for i in range(n % 5 + 3)]
+        with finguard.get_db(write=True, user_id=user_id) as conn:
+            finguard.insert_transactions(conn, user_id, rows)
+    return migrated_database
+
+
+def table_count(table):
+    total = 0
+    for database in finguard.known_databases():
+        with finguard.get_db(database=database) as conn:
+            total += conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    return total
+
+
+def snapshot():
+    """Everything a user reads back, looked up the way requests do."""
+    users = {}
+    for n in range(USERS):
+        email = f'user{n}@example.com'
+        user_id = finguard.lookup_user_id(email)
+        with finguard.get_db(user_id=user_id) as conn:
+            user = conn.execute("SELECT id, email FROM users WHERE id=?", (user_id,)).fetchone()
+            ledger = conn.execute("""SELECT id, posted_at, amount_cents, category FROM transactions
+                                     WHERE user_id=? ORDER BY id""", (user_id,)).fetchall()
+            summary = conn.execute("""SELECT month, category, currency, total_cents, txn_count
+                                      FROM transaction_summaries WHERE user_id=?
+                                      ORDER BY month, category""", (user_id,)).fetchall()
+        users[email] = (tuple(user), [tuple(row) for row in ledger], [tuple(row) for row in summary])
+    counts = {table: table_count(table) for table in ('users', 'transactions', 'transaction_summaries')}
+    return users, counts
+
+
+def users_per_database():
+    counts = {}
+    for database in finguard.known_databases():
+        with finguard.get_db(database=database) as conn:
+            counts[database] = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    return counts
+
+
+def use_shards(tmp_path, count):
+    shards = [str(tmp_path / f'shard{i}.db') for i in range(count)]
+    finguard.app.config['DATABASE_SHARDS'] = shards
+    return shards
+
+
+def test_reshard_keeps_every_user_readable(ledgers, tmp_path):
+    before = snapshot()
+    assert before[1]['users'] == USERS
+
+    for count in (3, 4):
+        shards = use_shards(tmp_path, count)
+        planned = finguard.reshard(shards, dry_run=True)
+        assert sum(planned.values()) > 0
+        assert not os.path.exists(shards[-1])
+
+        assert finguard.reshard(shards) == planned
+        assert snapshot() == before
+        per_database = users_per_database()
+        assert per_database[ledgers] == 0
+        assert sum(per_database[shard] for shard in shards) == USERS
+        assert all(per_database[shard] for shard in shards)
+        assert set(finguard.shard_router.buckets()) == set(shards)
+
+        # Nothing is left to move
+        assert sum(finguard.reshard(shards).values()) == 0
+
+
+def test_reshard_finishes_a_partial_move(ledgers, tmp_path, monkeypatch):
+    before = snapshot()
+    shards = use_shards(tmp_path, 3)
+    move_buckets = finguard._move_buckets
+
+    def crash_after_one_bucket(source, target, buckets):
+        bucket = next(iter(buckets))
+        move_buckets(source, target, {bucket: buckets[bucket]})
+        raise RuntimeError('killed mid-move')
+
+    monkeypatch.setattr(finguard, '_move_buckets', crash_after_one_bucket)
+    with pytest.raises(RuntimeError):
+        finguard.reshard(shards)
+    # The moved bucket is already mapped to its shard
+    finguard.shard_router.reload()
+    assert snapshot() == before
+    assert 0 < sum(users_per_database()[shard] for shard in shards) < USERS
+
+    monkeypatch.setattr(finguard, '_move_buckets', move_buckets)
+    finguard.reshard(shards)
+    assert snapshot() == before
+    assert users_per_database()[ledgers] == 0
+
+
+def test_reshard_finishes_a_bucket_copied_to_both_sides(ledgers, tmp_path):
+    # A crash between the two files' commits leaves the bucket's rows on both
+    before = snapshot()
+    shards = use_shards(tmp_path, 3)
+    for shard in shards:
+        finguard._prepare_shard(shard)
+    user_id = finguard.lookup_user_id('user0@example.com')
+    target = finguard.plan_shards(finguard.shard_router.buckets(), shards)[finguard.user_bucket(user_id)]
+    conn = finguard.sqlite3.connect(ledgers)
+    try:
+        conn.execute("ATTACH DATABASE ? AS dest", (target,))
+        with conn:
+            for table in ('users', 'transactions'):
+                conn.execute(f"INSERT INTO dest.{table} SELECT * FROM main.{table} WHERE "
+                             f"{'id' if table == 'users' else 'user_id'}=?", (user_id,))
+    finally:
+        conn.close()
+
+    finguard.reshard(shards)
+    assert snapshot() == before
+    assert users_per_database()[ledgers] == 0
@@ -0,0 +1,116 @@
+import threading
+
+import fakeredis
+import jwt
+import pytest
+import redis
+
+import app as finguard
+
+
+@pytest.fixture(params=['sqlite', 'memory', 'redis'])
+def backend(request, migrated_database, monkeypatch):
+    if request.param == 'redis':
+        server = fakeredis.FakeServer()
+        monkeypatch.setattr(redis.Redis, 'from_url',
+                            lambda url, **kwargs: fakeredis.FakeRedis(server=server, **kwargs))
+    finguard.create_user('u1', 'Ada', 'ada@example.com', 'x')
+    return request.param
+
+
+def session_token(user_id='u1'):
+    return jwt.encode({'user_id': user_id, 'jti': finguard.uuid.uuid4().hex}, 'test-secret-' + 'x' * 32, algorithm='HS256')
+
+
+def live_sessions(backend, store):
+    if backend == 'sqlite':
+        with finguard.get_db(user_id='u1') as conn:
+            return conn.execute("SELECT COUNT(*) FROM sessions WHERE expires_at > ?",
+                                (finguard.epoch_now(),)).fetchone()[0]
+    if backend == 'memory':
+        return len(store._sessions)
+    return len(store._redis.keys(store._prefix + '*'))
+
+
+def test_stores_are_abstract():
+    with pytest.raises(TypeError):
+        finguard.SessionStore()
+    with pytest.raises(TypeError):
+        finguard.OtpStore()
+
+
+def test_session_add_and_delete(backend):
+    sessions, _ = finguard._build_stores(backend)
+    first, second = session_token(), session_token()
+    sessions.add(first, 'u1', 60)
+    sessions.add(second, 'u1', 60)
+    assert live_sessions(backend, sessions) == 2
+
+    sessions.delete(first)
+    sessions.delete(first)
+    assert live_sessions(backend, sessions) == 1
+
+
+def test_otp_is_single_use(backend):
+    _, otps = finguard._build_stores(backend)
+    otps.add('ada@example.com', 'ABCDEF', 60)
+
+    assert not otps.consume('ada@example.com', 'ZZZZZZ')
+    assert not otps.consume('grace@example.com', 'ABCDEF')
+    assert otps.consume('ada@example.com', 'ABCDEF')
+    assert not otps.consume('ada@example.com', 'ABCDEF')
+
+
+def test_redis_keys_expire():
+    server = fakeredis.FakeServer()
+    client = fakeredis.FakeRedis(server=server)
+    sessions = finguard.RedisSessionStore(client, 'test:')
+    otps = finguard.RedisOtpStore(client, 'test:')
+    sessions.add('token', 'u1', 30)
+    otps.add('ada@example.com', 'ABCDEF', 600)
+
+    assert 0 < client.ttl('test:session:token') <= 30
+    assert 0 < client.ttl('test:otp:ada@example.com:ABCDEF') <= 600
+
+
+@pytest.mark.parametrize('backend_name', ['sqlite', 'memory'])
+def test_expired_otp_is_rejected(backend_name, migrated_database):
+    finguard.create_user('u1', 'Ada', 'ada@example.com', 'x')
+    _, otps = finguard._build_stores(backend_name)
+    otps.add('ada@example.com', 'ABCDEF', 0)
+    assert not otps.consume('ada@example.com', 'ABCDEF')
+
+
+def test_concurrent_workers_accept_a_code_once(migrated_database, monkeypatch):
+    finguard.create_user('u1', 'Ada', 'ada@example.com', 'x')
+    # Two pools on one file stand in for two worker processes
+    pools = [finguard.ConnectionPool(migrated_database) for _ in range(2)]
+    local = threading.local()
+
+    def get_db(write=False, user_id=None, database=None):
+        return local.pool.write() if write else local.pool.read()
+
+    monkeypatch.setattr(finguard, 'get_db', get_db)
+    stores = [finguard.SqliteOtpStore() for _ in range(2)]
+    try:
+        for trial in range(200):
+            code = f'{trial:06d}'
+            local.pool = pools[0]
+            stores[0].add('ada@example.com', code, 60)
+            barrier = threading.Barrier(2)
+            accepted = [None, None]
+
+            def consume(index):
+                local.pool = pools[index]
+                barrier.wait()
+                accepted[index] = stores[index].consume('ada@example.com', code)
+
+            threads = [threading.Thread(target=consume, args=(index,)) for index in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert accepted.count(True) == 1
+    finally:
+        for pool in pools:
+            pool.close()
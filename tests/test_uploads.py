@@ -0,0 +1,57 @@
+import io
+
+import pytest
+
+import app as finguard
+
+
+def upload(data):
+    return io.BufferedReader(io.BytesIO(data))
+
+
+@pytest.mark.parametrize('data, content_type, requested, expected', [
+    (b'date,amount\n', None, 'OFX', 'ofx'),
+    (b'date,amount\n', 'application/x-ofx', None, 'ofx'),
+    (b'<OFX>', 'text/csv', None, 'csv'),
+    (b'\xef\xbb\xbf  OFXHEADER:100\n', None, None, 'ofx'),
+    (b'<?xml version="1.0"?>', None, None, 'ofx'),
+    (b'date,amount\n', None, None, 'csv'),
+])
+def test_detect_statement_format(data, content_type, requested, expected):
+    assert finguard.detect_statement_format(upload(data), content_type, requested) == expected
+
+
+@pytest.mark.parametrize('data, content_type, requested, expected', [
+    (b'name,email,password\n', None, 'NDJSON', 'ndjson'),
+    (b'name,email,password\n', 'application/x-ndjson', None, 'ndjson'),
+    (b'{"name": "Ada"}\n', 'text/csv', None, 'csv'),
+    (b'\xef\xbb\xbf\n {"name": "Ada"}\n', None, None, 'ndjson'),
+    (b'name,email,password\n', None, None, 'csv'),
+])
+def test_detect_provision_format(data, content_type, requested, expected):
+    assert finguard.detect_provision_format(upload(data), content_type, requested) == expected
+
+
+def test_unknown_format_is_rejected():
+    with pytest.raises(ValueError, match='format must be csv or ofx'):
+        finguard.detect_statement_format(upload(b''), None, 'json')
+    with pytest.raises(ValueError, match='format must be csv or ndjson'):
+        finguard.detect_provision_format(upload(b''), None, 'ofx')
+
+
+def test_csv_uploads_skip_blank_rows_and_keep_line_numbers():
+    body = upload(b'\xef\xbb\xbfDate,Amount,Memo\n2024-03-01,-4.50,Coffee\n,,\n\n2024-03-02,-12.00,Lunch\n')
+    records = list(finguard.iter_csv_statement(body))
+    assert records == [
+        (2, {'postedAt': '2024-03-01', 'amount': '-4.50', 'description': 'Coffee'}),
+        (5, {'postedAt': '2024-03-02', 'amount': '-12.00', 'description': 'Lunch'}),
+    ]
+    assert not body.closed
+
+    body = upload(b'Name,E-mail,Password\nAda,ada@example.com,pw\n\nGrace,grace@example.com,pw\n')
+    assert [number for number, _ in finguard.iter_provision_records(body, 'csv')] == [2, 4]
+
+
+def test_ndjson_provisioning_reports_bad_lines():
+    body = upload(b'{"name": "Ada"}\n\nnot json\n[1]\n')
+    assert list(finguard.iter_provision_records(body, 'ndjson')) == [(1, {'name': 'Ada'}), (3, None), (4, None)]